@@ -0,0 +1,72 @@
+""" Signatures per second of QtradeAuth against the implementation it
+replaced, signing prepared requests the way requests does.
+
+    python -m benchmarks.bench_auth
+"""
+import base64
+import time
+import timeit
+from hashlib import sha256
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import requests
+
+from qtrade_client.api import QtradeAuth
+
+
+class LegacyQtradeAuth(requests.auth.AuthBase):
+    """ QtradeAuth before signing was reworked, kept for comparison """
+
+    def __init__(self, key):
+        self.key_id, self.key = key.split(":")
+
+    def __call__(self, req):
+        timestamp = str(int(time.time()))
+        url_obj = urlparse(req.url)
+
+        request_details = req.method + "\n"
+        uri = url_obj.path
+        if url_obj.query:
+            uri += "?" + url_obj.query
+        request_details += uri + "\n"
+        request_details += timestamp + "\n"
+        if req.body:
+            if isinstance(req.body, str):
+                request_details += req.body + "\n"
+            else:
+                request_details += req.body.decode('utf8') + "\n"
+        else:
+            request_details += "\n"
+        request_details += self.key
+        hsh = sha256(request_details.encode("utf8")).digest()
+        signature = base64.b64encode(hsh)
+        req.headers.update({
+            "Authorization": "HMAC-SHA256 {}:{}".format(self.key_id, signature.decode("utf8")),
+            "HMAC-Timestamp": timestamp
+        })
+        return req
+
+
+KEY = "256:vwj043jtrw4o5igw4oi5jwoi45g"
+
+
+def main(number=100000):
+    session = requests.Session()
+    reqs = [
+        ("GET", session.prepare_request(requests.Request(
+            "GET", "https://api.qtrade.io/v1/user/orders?open=true&older_than=8980901"))),
+        ("POST", session.prepare_request(requests.Request(
+            "POST", "https://api.qtrade.io/v1/user/sell_limit",
+            json={"amount": "0.01000000", "price": "0.00707017", "market_id": 1}))),
+    ]
+    for name, req in reqs:
+        for label, auth in (("legacy", LegacyQtradeAuth(KEY)), ("current", QtradeAuth(KEY))):
+            best = min(timeit.repeat(lambda: auth(req), number=number, repeat=5))
+            print("{:<5} {:<8} {:>10,.0f} signatures/s".format(name, label, number / best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+""" Wall time of `qtapi contexts` with a config dir of many context files,
+with a cold and with a warm config cache.
+
+    python -m benchmarks.bench_cli [--files 30] [--runs 10]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from qtrade_client.cli import CONFIG_CACHE
+
+
+def run(config_dir, runs, cold):
+    times = []
+    for _ in range(runs):
+        if cold and os.path.exists(os.path.join(config_dir, CONFIG_CACHE)):
+            os.remove(os.path.join(config_dir, CONFIG_CACHE))
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-m", "qtrade_client.cli", "-d", config_dir, "contexts"],
+                              stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times), sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    config_dir = tempfile.mkdtemp()
+    try:
+        for i in range(args.files):
+            with open(os.path.join(config_dir, "account{}.yml".format(i)), "w") as f:
+                f.write("account{0}:\n  endpoint: https://api.qtrade.io\n  key: '{0}:{1}'\n"
+                        "  email: ops{0}@example.com\n".format(i, "a" * 64))
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", "pass"])
+        interpreter = time.perf_counter() - start
+        print("{} config files, interpreter startup {:.0f}ms".format(args.files, interpreter * 1e3))
+        for name, cold in (("cold config cache", True), ("warm config cache", False)):
+            best, median = run(config_dir, args.runs, cold)
+            print("{:<20} best {:6.0f}ms  median {:6.0f}ms".format(name, best * 1e3, median * 1e3))
+    finally:
+        shutil.rmtree(config_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+""" Decode and encode time of the available JSON codecs on API sized
+payloads, and the cost of building the market and ticker models on top.
+
+    python -m benchmarks.bench_codec [recorded.json ...]
+
+Recorded response bodies (eg saved from a replay file) can be passed as
+arguments, otherwise payloads shaped like production /v1/common, /v1/tickers
+and /v1/user/orders responses are generated.
+"""
+import json
+import sys
+import timeit
+
+from qtrade_client.api import QtradeAPI
+from qtrade_client.codec import JSONCodec, OrjsonCodec, orjson
+
+
+def common_payload(markets=150):
+    codes = ["C{}".format(i) for i in range(markets)] + ["BTC"]
+    return {"data": {
+        "currencies": [{"code": c, "long_name": c, "type": "bitcoin_like", "precision": 8,
+                        "status": "ok", "can_withdraw": True,
+                        "config": {"price": 0.1, "withdraw_fee": "0.0001", "min_withdraw": "0.001",
+                                   "required_confirmations": 6, "explorerAddressURL": "https://x/{}"},
+                        "metadata": {}} for c in codes],
+        "markets": [{"id": i, "market_currency": "C{}".format(i), "base_currency": "BTC",
+                     "maker_fee": "0.0025", "taker_fee": "0.0025", "metadata": {},
+                     "can_trade": True, "can_cancel": True, "can_view": True}
+                    for i in range(markets)],
+    }}
+
+
+def tickers_payload(markets=150):
+    return {"data": {"markets": [
+        {"id": i, "id_hr": "C{}_BTC".format(i), "ask": "0.00012345", "bid": "0.00012300",
+         "last": "0.00012301", "day_avg_price": "0.00012222", "day_change": "0.0123",
+         "day_high": "0.00012500", "day_low": "0.00012000", "day_open": "0.00012100",
+         "day_volume_base": "1.23456789", "day_volume_market": "10000.12345678"}
+        for i in range(markets)]}}
+
+
+def orders_payload(orders=100):
+    return {"data": {"orders": [
+        {"id": 9000000 + i, "market_amount": "1.00000000", "market_amount_remaining": "0.50000000",
+         "created_at": "2019-11-14T16:34:20.424601Z", "price": "0.00651044",
+         "base_amount": "0.00651044", "order_type": "buy_limit", "market_id": 1, "open": True,
+         "trades": [{"id": 100 + i, "market_amount": "0.50000000", "price": "0.00651044",
+                     "base_amount": "0.00325522", "base_fee": "0.00000814",
+                     "created_at": "2019-11-14T16:35:20.424601Z"}]}
+        for i in range(orders)]}}
+
+
+def run(name, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print("{:<40} {:10.1f} us".format(name, best / number * 1e6))
+
+
+def main(paths):
+    if paths:
+        payloads = [(p, open(p, 'rb').read()) for p in paths]
+    else:
+        payloads = [(name, json.dumps(p).encode('utf8')) for name, p in [
+            ("/v1/common", common_payload()),
+            ("/v1/tickers", tickers_payload()),
+            ("/v1/user/orders", orders_payload()),
+        ]]
+    codecs = [JSONCodec()]
+    if orjson is not None:
+        codecs.append(OrjsonCodec())
+    else:
+        print("orjson is not installed, only measuring the stdlib codec")
+
+    for name, raw in payloads:
+        print("{} ({} bytes)".format(name, len(raw)))
+        for codec in codecs:
+            data = codec.loads(raw)
+            run("  loads  " + codec.name, lambda: codec.loads(raw), 200)
+            run("  dumps  " + codec.name, lambda: codec.dumps(data), 200)
+
+    if not paths:
+        api = QtradeAPI("http://localhost:9898/")
+        common, tickers = payloads[0][1], payloads[1][1]
+        print("decode and build models")
+        for codec in codecs:
+            run("  /v1/common  " + codec.name,
+                lambda: api._index_common(codec.loads(common)['data']), 100)
+            run("  /v1/tickers " + codec.name,
+                lambda: api._index_tickers(codec.loads(tickers)['data']), 100)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
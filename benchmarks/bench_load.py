@@ -0,0 +1,96 @@
+""" End to end load benchmark of the blocking client against the bundled
+fake server: requests/sec, latency percentiles and how much of the rate limit
+the client managed to use without being rejected.
+
+    python -m benchmarks.bench_load [--threads 8] [--duration 5] [--ratelimit 100000]
+
+Each thread runs a mix of balance and order history reads, order placement
+and cancels through one shared QtradeAPI. With a tight --ratelimit (eg 120
+per --window 10) the numbers show how close the client's limiter gets to the
+server's budget: ideally no 429s and a utilisation near 100%.
+"""
+import argparse
+import math
+import threading
+import time
+
+from qtrade_client.api import QtradeAPI
+from qtrade_client.fakeserver import FakeQtradeServer
+from qtrade_client.metrics import Metrics
+
+KEY = "1:1111111111111111111111111111111111111111111111111111111111111111"
+
+
+def worker(api, stop, latencies, errors):
+    i = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            step = i % 4
+            if step == 0:
+                api.balances()
+            elif step == 1:
+                api.orders(open=True)
+            elif step == 2:
+                order = api.order("buy_limit", "0.00001", amount="1", market_id=1)["order"]
+            else:
+                api.post("/v1/user/cancel_order", id=order["id"])
+        except Exception:
+            errors.append(1)
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--ratelimit", type=int, default=100000)
+    parser.add_argument("--window", type=float, default=60)
+    parser.add_argument("--latency", type=float, default=0, help="server side delay in seconds")
+    args = parser.parse_args()
+
+    with FakeQtradeServer(keys=dict([KEY.split(":")]), ratelimit=args.ratelimit,
+                          ratelimit_window=args.window, latency=args.latency) as server:
+        api = QtradeAPI(server.url, key=KEY, pool_maxsize=args.threads, timeout=10)
+        api.rl_limit = api.rl_remaining = args.ratelimit
+        api.metrics = Metrics()
+        api.markets
+
+        stop = threading.Event()
+        latencies, errors = [], []
+        threads = [threading.Thread(target=worker, args=(api, stop, latencies, errors))
+                   for _ in range(args.threads)]
+        started = time.time()
+        for t in threads:
+            t.start()
+        stop.wait(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - started
+        api.close()
+
+    snap = api.metrics.snapshot()['endpoints']
+    sleeps = sum(e['ratelimit']['total'] for e in snap.values())
+    # Every window the run touched, including the last partial one
+    budget = args.ratelimit * math.ceil(elapsed / args.window)
+    print("threads           {}".format(args.threads))
+    print("calls             {} in {:.1f}s, {:.0f}/s".format(
+        len(latencies), elapsed, len(latencies) / elapsed))
+    print("latency           p50 {:.2f}ms  p99 {:.2f}ms".format(
+        percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3))
+    print("errors            {}".format(len(errors)))
+    print("server            {} requests served, {} rejected with 429".format(
+        server.ratelimit.served, server.ratelimit.rejected))
+    print("ratelimit         {:.0f}% of the budget used, {:.1f}s spent waiting in the limiter".format(
+        100.0 * server.ratelimit.served / budget, sleeps))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,28 @@
 import requests
+import requests.adapters
 import requests.auth
 import time
 import json as _json
 try:
-    from urllib.parse import urlparse, urljoin
+    from urllib.parse import urljoin
 except ImportError:
-     from urlparse import urlparse, urljoin
+     from urlparse import urljoin
 import logging
 import base64
+import contextlib
+import os
+import socket
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.exceptions import NewConnectionError
+
+from .codec import default_codec
+from .fixedpoint import COIN_SATS, div_round, from_sats, to_sats
+from .metrics import endpoint_template
+from .models import Currency, Market, Ticker
+from .ratelimit import RateLimiter, RateLimitExceeded, URGENT, NORMAL, LOW
+from .retry import CircuitBreaker, default_policies, request_class
 
 from hashlib import sha256
 from decimal import Decimal
@@ -16,6 +31,102 @@ log = logging.getLogger("qtrade")
 
 COIN = Decimal('.00000001')
 
+# Error codes the backend answers a cancel with when the order is no longer
+# open, ie it was filled or cancelled before our request got there
+ORDER_CLOSED_ERRORS = frozenset(['order_not_open', 'order_already_closed'])
+
+# Rate limiter priority by endpoint prefix, anything else is NORMAL
+ENDPOINT_PRIORITIES = [
+    ('/v1/user/cancel_order', URGENT),
+    ('/v1/user/buy_limit', URGENT),
+    ('/v1/user/sell_limit', URGENT),
+    ('/v1/common', LOW),
+    ('/v1/currencies', LOW),
+    ('/v1/markets', LOW),
+    ('/v1/market/', LOW),
+    ('/v1/tickers', LOW),
+    ('/v1/ticker/', LOW),
+    ('/v1/orderbook/', LOW),
+    ('/v1/user/trades', LOW),
+    ('/v1/user/transfers', LOW),
+    ('/v1/user/deposits', LOW),
+    ('/v1/user/withdraws', LOW),
+]
+
+# Bump when the layout of the processed /v1/common cache changes
+COMMON_CACHE_VERSION = 3
+
+# Keyword arguments of _req that are passed through to Session.request
+_REQUESTS_KWARGS = frozenset(['data', 'cookies', 'files', 'auth', 'timeout', 'allow_redirects',
+                              'proxies', 'hooks', 'stream', 'verify', 'cert'])
+
+# A stream that fails with one of these is reopened by QtradeAPI.stream
+_STREAM_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                  requests.exceptions.Timeout)
+
+
+def _budget_timeout(timeout, remaining):
+    """ Caps a requests timeout (None, seconds or a (connect, read) tuple)
+    to the remaining seconds. Returns it and whether the cap applied. """
+    if timeout is None:
+        return remaining, True
+    if isinstance(timeout, tuple):
+        capped = tuple(remaining if t is None else min(t, remaining) for t in timeout)
+        return capped, capped != tuple(timeout)
+    return min(timeout, remaining), remaining < timeout
+
+
+# Marks a response body that could not be decoded as JSON
+_UNDECODED = object()
+_clock = time.perf_counter
+
+
+class _Flight(object):
+    """ A GET request in flight, awaited by every caller that asked for it """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        # Held by the caller making the request until it completes. A bare
+        # lock is much cheaper to create than an Event.
+        self.done = threading.Lock()
+        self.done.acquire()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """ Returns False if the request is still running after timeout
+        seconds """
+        if not self.done.acquire(True, -1 if timeout is None else max(0, timeout)):
+            return False
+        self.done.release()
+        return True
+
+
+class _Call(object):
+    """ A request across its attempts, see BaseQtradeAPI._start_call """
+    __slots__ = ('method', 'endpoint', 'priority', 'policy', 'expires', 'metrics', 'first',
+                 'attempt', 'admitted', 'holding', 'capped', 'started', 'reserved', 'slept',
+                 'sent', 'received')
+
+    def __init__(self, method, endpoint, priority, policy, expires, metrics):
+        self.method = method
+        self.endpoint = endpoint
+        self.priority = priority
+        self.policy = policy
+        # _clock() by which the call must be done, None without deadline
+        self.expires = expires
+        self.metrics = metrics
+        # _clock() of the first attempt, only taken if the policy needs it
+        self.first = None
+        self.attempt = 0
+        # Let through by the circuit breaker, outcome not yet reported
+        self.admitted = False
+        # Took a rate limit token, response not yet received
+        self.holding = False
+        # The network timeout of the attempt was cut to fit the deadline
+        self.capped = False
+        self.started = self.reserved = self.slept = self.sent = self.received = None
+
 
 class APIException(Exception):
 
@@ -25,185 +136,1061 @@ class APIException(Exception):
         self.errors = errors
 
 
+class CircuitOpenError(APIException):
+    """ Raised without making a request while the circuit breaker of the
+    endpoint is open """
+
+
+class DeadlineExceeded(APIException):
+    """ Raised when a request can't complete within its deadline """
+
+
 class QtradeAuth(requests.auth.AuthBase):
 
     def __init__(self, key):
         self.key_id, self.key = key.split(":")
+        # Everything that doesn't change between requests is encoded once
+        self._key_bytes = self.key.encode("utf8")
+        self._header_prefix = "HMAC-SHA256 {}:".format(self.key_id)
 
-    def __call__(self, req):
-        # modify and return the request
+    def sign(self, method, uri, body=None):
+        """ Returns the headers that authenticate a request. uri is the path
+        plus query string, body the raw request body. uri and body may be
+        bytes, which are signed as is, or str. Shared by the requests hook
+        below and the asyncio client. """
         timestamp = str(int(time.time()))
-        url_obj = urlparse(req.url)
-
-        request_details = req.method + "\n"
-        uri = url_obj.path
-        if url_obj.query:
-            uri += "?" + url_obj.query
-        request_details += uri + "\n"
-        request_details += timestamp + "\n"
-        if req.body:
-            if isinstance(req.body, str):
-                request_details += req.body + "\n"
-            else:
-                request_details += req.body.decode('utf8') + "\n"
-        else:
-            request_details += "\n"
-        request_details += self.key
-        hsh = sha256(request_details.encode("utf8")).digest()
-        signature = base64.b64encode(hsh)
-        req.headers.update({
-            "Authorization": "HMAC-SHA256 {}:{}".format(self.key_id, signature.decode("utf8")),
+        if not isinstance(uri, bytes):
+            uri = uri.encode("utf8")
+        if not body:
+            body = b""
+        elif not isinstance(body, bytes):
+            body = body.encode("utf8")
+        request_details = b"\n".join((
+            method.encode("ascii"), uri, timestamp.encode("ascii"), body, self._key_bytes))
+        signature = base64.b64encode(sha256(request_details).digest())
+        return {
+            "Authorization": self._header_prefix + signature.decode("ascii"),
             "HMAC-Timestamp": timestamp
-        })
+        }
+
+    def __call__(self, req):
+        # modify and return the request
+        req.headers.update(self.sign(req.method, _uri(req.url), req.body))
         return req
 
 
-class QtradeAPI(object):
+class TransportAdapter(requests.adapters.HTTPAdapter):
+    """ HTTPAdapter that also sets socket options on the connections of its
+    pools, eg TCP keepalive """
+
+    __attrs__ = requests.adapters.HTTPAdapter.__attrs__ + ['socket_options']
+
+    def __init__(self, socket_options=None, **kwargs):
+        self.socket_options = socket_options
+        super(TransportAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super(TransportAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def _socket_options(tcp_keepalive):
+    # urllib3 sets TCP_NODELAY by default, keep it
+    opts = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+    if tcp_keepalive:
+        opts.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    return opts
+
+
+def _uri(url):
+    """ Path and query string of an absolute URL, cheaper than urlparse for
+    the prepared URLs requests hands us (which never have a fragment) """
+    start = url.find("/", url.find("//") + 2)
+    return url[start:] if start >= 0 else "/"
+
+
+class BaseQtradeAPI(object):
+    """ Transport independent client state and logic. Rate limit bookkeeping,
+    order preparation and response handling live here so the blocking
+    QtradeAPI and the asyncio AsyncQtradeAPI behave identically. """
 
-    def __init__(self, endpoint, origin=None, email='Unk', key=None):
+    def __init__(self, endpoint, origin=None, email='Unk', key=None, ratelimiter=None,
+                 common_cache_path=None):
         self.user_id = None
         self.email = email
         self.endpoint = endpoint
         self.origin = origin
         self.token = None
-        self.rs = requests.Session()
+        self.auth = None
         if key is not None:
             self.set_hmac(key)
 
         self.tickers_update_interval = 180
         self.market_update_interval = 180
+        # Do order and balance math on ints of 1e-8 units instead of Decimal.
+        # order() then takes ints as 1e-8 units and balances are returned as
+        # ints.
+        self.fixed_point = False
+        # Once expired, serve the cached markets and tickers right away and
+        # reload them in the background instead of blocking the caller
+        self.background_refresh = False
+        # prevent_taker orders are not placed if the tickers are older than
+        # this many seconds. None for twice tickers_update_interval with
+        # background_refresh, and no limit without.
+        self.tickers_max_staleness = None
+        self._refresh_lock = threading.Lock()
+        self._refreshing = set()
+        # Held while the tickers or markets are reloaded in the foreground,
+        # so threads finding them expired together load them once
+        self._tickers_lock = threading.Lock()
+        self._common_lock = threading.Lock()
+        # Identical GETs issued while one is in flight wait for it and share
+        # its result instead of making their own request. Shared results
+        # must not be modified by the caller.
+        self.coalesce_gets = True
+        self._inflight = {}
+        self._urls = {}
+        # Streaming responses are read in chunks of stream_chunk_size bytes,
+        # and a single record may not exceed stream_max_line bytes
+        self.stream_chunk_size = 8192
+        self.stream_max_line = 1 << 20
+        # Keep the /v1/common response in this file so new clients can skip
+        # fetching it
+        self.common_cache_path = common_cache_path
+        self.common_cache_ttl = 3600
 
         self._markets_map = None
+        self._currencies_map = None
         self._markets_age = 0
         self._tickers = None
         self._tickers_age = 0
         self.honor_ratelimit = True
-        self.rl_remaining = 99
-        self.rl_reset_at = time.time()
-        self.rl_limit = 120
-        # Set to 1 to disable soft threshold, 0 will always sleep between calls
-        # if needed (no burst at all)
-        self.rl_soft_threshold = 0.5
+        # Set to a qtrade_client.metrics.Metrics to collect per endpoint
+        # timings and counters
+        self.metrics = None
+        # Encodes request bodies and decodes responses, see qtrade_client.codec
+        self.codec = default_codec()
+        # Pass a SharedRateLimiter to share one budget between processes
+        # using the same key
+        self.ratelimiter = ratelimiter if ratelimiter is not None else RateLimiter()
+        # A qtrade_client.retry.RetryPolicy per idempotency class, and the
+        # circuit breaker failing requests to broken endpoints fast (None to
+        # disable it)
+        self.retry_policies = default_policies()
+        self.circuit_breaker = CircuitBreaker()
+        # Seconds a request may take at most, rate limit waits and retries
+        # included, unless it passes its own deadline. None for no limit.
+        self.default_deadline = None
+        self._scope = threading.local()
+
+    # Rate limit state lives on the limiter, these remain for compatibility
+    rl_remaining = property(lambda self: self.ratelimiter.remaining,
+                            lambda self, v: setattr(self.ratelimiter, 'remaining', v))
+    rl_reset_at = property(lambda self: self.ratelimiter.reset_at,
+                           lambda self, v: setattr(self.ratelimiter, 'reset_at', v))
+    rl_limit = property(lambda self: self.ratelimiter.limit,
+                        lambda self, v: setattr(self.ratelimiter, 'limit', v))
+    rl_soft_threshold = property(lambda self: self.ratelimiter.soft_threshold,
+                                 lambda self, v: setattr(self.ratelimiter, 'soft_threshold', v))
 
     def clone(self):
         """ Returns a new QtradeAPI instance with stripped auth but the same
         endpoint configuration. Useful for testing toolchains that might point
         at multiple testing endpoints and 'inherit' from some base endpoint
         config """
-        return type(self)(self.endpoint)
+        c = type(self)(self.endpoint, **self._clone_kwargs())
+        # Public market data doesn't depend on auth, so share what we have
+        if self._markets_map is not None:
+            c._currencies_map = self._currencies_map
+            c._markets_map = self._markets_map
+            c._markets_age = self._markets_age
+        c._tickers = self._tickers
+        c._tickers_age = self._tickers_age
+        return c
 
-    def login(self, email, password):
-        """ Login with username and password to get a JWT token.
-        Intended for internal testing only. """
-        resp = self._req('post', "/v1/login", json={
-            "email": email,
-            "password": password,
-        })
-        self.user_id = resp['user_id']
-        self.token = resp['token']
+    def _clone_kwargs(self):
+        """ Constructor arguments a clone inherits """
+        return {'common_cache_path': self.common_cache_path}
 
     def set_hmac(self, hmac_pair):
         """ hmac_pair should be in "1:11111..." format, with keyid then key """
-        self.rs.auth = QtradeAuth(hmac_pair)
+        self.auth = QtradeAuth(hmac_pair)
 
-    def balances(self):
-        return {b['currency']: Decimal(b['balance']) for b in self.get("/v1/user/balances")['balances']}
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """ Requests made within this block by the current thread (task
+        for the asyncio client), and by the workers of the batch methods it
+        calls, must finish within `seconds` of entering it, or raise
+        DeadlineExceeded. Nested blocks can only shorten the deadline. """
+        outer = self._scope_expires()
+        expires = _clock() + seconds
+        self._set_scope_expires(expires if outer is None else min(outer, expires))
+        try:
+            yield
+        finally:
+            self._set_scope_expires(outer)
 
-    def get(self, endpoint, *args, **kwargs):
-        return self._req('get', endpoint, *args, **kwargs)
+    def _scope_expires(self):
+        return getattr(self._scope, 'expires', None)
 
-    def post(self, endpoint, *args, **kwargs):
-        return self._req('post', endpoint, *args, **kwargs)
+    def _set_scope_expires(self, expires):
+        self._scope.expires = expires
 
-    def orders(self, open=None, older_than=None, newer_than=None):
-        if isinstance(open, bool):
-            open = str(open).lower()
-        return self.get("/v1/user/orders", open=open, older_than=older_than, newer_than=newer_than)['orders']
+    def _in_scope(self, func):
+        """ Wraps func to run within the deadline scope of the calling
+        thread, for handing it to another thread """
+        expires = self._scope_expires()
+        if expires is None:
+            return func
 
-    def order(self, order_type, price, value=None, amount=None, market_id=None, market_string=None, prevent_taker=False):
-        """ Place an order with the given parameters.
-        value = amount * price """
+        def run(*args, **kwargs):
+            outer = self._scope_expires()
+            self._set_scope_expires(expires)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._set_scope_expires(outer)
+        return run
+
+    def _expires(self, deadline=None):
+        """ The _clock() by which a request given `deadline` seconds must be
+        done, None if it has no deadline """
+        expires = self._scope_expires()
+        if deadline is None:
+            deadline = self.default_deadline
+        if deadline is not None:
+            own = _clock() + deadline
+            if expires is None or own < expires:
+                expires = own
+        return expires
+
+    @staticmethod
+    def _budget_error(error):
+        """ Whether error only says that the caller which made the request
+        ran out of its deadline or its share of the rate limit. A caller
+        that joined the request may still have budget for it. """
+        return isinstance(error, (DeadlineExceeded, RateLimitExceeded))
+
+    @staticmethod
+    def _deadline_error(method, endpoint, why):
+        return DeadlineExceeded("{} {} can't finish within its deadline: {}".format(
+            method.upper(), endpoint, why), None, [])
+
+    def _time_left(self, expires, method, endpoint):
+        """ Seconds left until expires, raises DeadlineExceeded if none """
+        left = expires - _clock()
+        if left <= 0:
+            raise self._deadline_error(method, endpoint, "no time left")
+        return left
+
+    def _check_wait(self, expires, delay, priority, method, endpoint):
+        """ Raises DeadlineExceeded, giving up the rate limit reservation,
+        if waiting delay seconds for it would leave no time for the request """
+        if expires - _clock() <= delay:
+            self._cancel_ratelimit(priority)
+            raise self._deadline_error(method, endpoint, "rate limit wait of {:.2f}s".format(delay))
+
+    def _reserve_ratelimit(self, priority=NORMAL):
+        """ Returns how many seconds to wait before the next request to stay
+        within the rate limit, taking one request off the shared budget. If
+        the delay is non zero, call _consume_ratelimit after waiting, and
+        wait again for as long as it says. """
+        if not self.honor_ratelimit:
+            return 0
+        return self.ratelimiter.reserve(priority)
+
+    def _consume_ratelimit(self, priority=NORMAL):
+        return self.ratelimiter.consume(priority)
+
+    def _cancel_ratelimit(self, priority=NORMAL):
+        self.ratelimiter.cancel(priority)
+
+    @staticmethod
+    def _priority(endpoint):
+        for prefix, priority in ENDPOINT_PRIORITIES:
+            if endpoint.startswith(prefix):
+                return priority
+        return NORMAL
+
+    def _url(self, endpoint):
+        """ urljoin the endpoint onto our base URL, memoized """
+        key = (self.endpoint, endpoint)
+        url = self._urls.get(key)
+        if url is None:
+            url = urljoin(self.endpoint, endpoint)
+            # Endpoints with ids in them would grow this forever
+            if len(self._urls) < 512:
+                self._urls[key] = url
+        return url
+
+    @staticmethod
+    def _flight_key(endpoint, args, kwargs):
+        """ Identifies a GET for coalescing, None if it can't be shared """
+        if args or kwargs.get('stream'):
+            return None
+        try:
+            return endpoint, frozenset(kwargs.items())
+        except TypeError:
+            return None
+
+    def _record(self, method, endpoint, status, attempt, queue, ratelimit, network, decode):
+        metrics = self.metrics
+        metrics.record({
+            'method': method, 'endpoint': endpoint_template(endpoint), 'status': status,
+            'attempt': attempt, 'retry': attempt > 1, 'queue': queue, 'ratelimit': ratelimit,
+            'network': network, 'decode': decode,
+        })
+        if status is not None:
+            metrics.record_ratelimit(self.ratelimiter.remaining)
+
+    # Exceptions the transport raises for failed requests, those after
+    # which a request may be retried, and those raised when it timed out
+    _transport_errors = ()
+    _retry_errors = ()
+    _timeout_errors = ()
+
+    @staticmethod
+    def _unsent(error):
+        """ Whether the request that failed with error certainly never
+        reached the server """
+        return False
+
+    def _retry_policy(self, method, endpoint):
+        return self.retry_policies.get(request_class(method, endpoint))
+
+    # The attempts of a request, shared by the _req of both clients. Per
+    # attempt _req calls _start_attempt, then sleeps for the delay it returns
+    # and calls _waited until that returns no delay, then _admit right before
+    # sending and _responded with the headers of the response. _attempt_failed or
+    # _attempt_done tell whether and after how long to try again. _end_call
+    # must run however the call ends.
+
+    def _start_call(self, method, endpoint, priority, policy, expires):
+        call = _Call(method, endpoint, priority, policy, expires, self.metrics)
+        if policy is not None and policy.deadline is not None:
+            call.first = _clock()
+        return call
+
+    def _start_attempt(self, call):
+        """ Checks the deadline and circuit breaker and takes a rate limit
+        reservation. Returns the seconds to wait before sending. """
+        call.attempt += 1
+        if call.expires is not None:
+            self._time_left(call.expires, call.method, call.endpoint)
+        self._check_circuit(call)
+        if call.metrics is not None:
+            call.started = _clock()
+        delay = self._reserve_ratelimit(call.priority)
+        call.holding = not delay and self.honor_ratelimit
+        if call.metrics is not None:
+            call.reserved = call.slept = _clock()
+        if delay and call.expires is not None:
+            self._check_wait(call.expires, delay, call.priority, call.method, call.endpoint)
+        return delay
+
+    def _waited(self, call):
+        """ Takes the rate limit token after waiting. Returns the seconds to
+        wait on if the bucket is still empty. """
+        delay = self._consume_ratelimit(call.priority)
+        call.holding = not delay
+        if call.metrics is not None:
+            call.slept = _clock()
+        if delay and call.expires is not None:
+            self._check_wait(call.expires, delay, call.priority, call.method, call.endpoint)
+        return delay
+
+    def _admit(self, call):
+        """ Returns the seconds left for sending the attempt, None if the
+        call has no deadline """
+        left = None
+        if call.expires is not None:
+            left = self._time_left(call.expires, call.method, call.endpoint)
+        if call.metrics is not None:
+            call.sent = _clock()
+        return left
+
+    def _responded(self, call, headers):
+        """ The attempt got a response with headers """
+        call.holding = False
+        self._update_ratelimit(headers)
+
+    def _release_token(self, call):
+        if call.holding:
+            call.holding = False
+            self.ratelimiter.release()
+
+    def _attempt_failed(self, call, error):
+        """ The attempt raised error. Returns the seconds to wait before
+        retrying, or None to raise it. """
+        self._release_token(call)
+        if call.metrics is not None:
+            call.received = _clock()
+            self._record_attempt(call, None)
+        if call.capped and isinstance(error, self._timeout_errors):
+            # Still a failure of the endpoint, eg of a half open circuit's trial
+            self._report_outcome(call, None)
+            raise self._deadline_error(call.method, call.endpoint, "timed out")
+        return self._retry_delay(call, error=error)
+
+    def _attempt_done(self, call, status):
+        """ The attempt got a response with status. Returns the seconds to
+        wait before retrying, or None if the response is final. """
+        if call.metrics is not None:
+            call.received = _clock()
+        delay = self._retry_delay(call, status=status)
+        if delay is not None and call.metrics is not None:
+            self._record_attempt(call, status)
+        return delay
+
+    def _end_call(self, call):
+        # An attempt that ended without a response, eg past its deadline
+        # before it was sent, doesn't count as in flight
+        self._release_token(call)
+        # An attempt let through by the circuit breaker that ended without
+        # an outcome, eg interrupted, mustn't hold up its trial
+        if call.admitted:
+            self.circuit_breaker.release(endpoint_template(call.endpoint))
+
+    def _record_attempt(self, call, status, decoded=False):
+        """ Records the last attempt of call, with the time since the
+        response was received as its decode time if decoded """
+        self._record(call.method, call.endpoint, status, call.attempt, call.reserved - call.started,
+                     call.slept - call.reserved, call.received - call.sent,
+                     _clock() - call.received if decoded else None)
+
+    def _check_circuit(self, call):
+        breaker = self.circuit_breaker
+        if breaker is not None and breaker.failing:
+            key = endpoint_template(call.endpoint)
+            if not breaker.allow(key):
+                if call.metrics is not None:
+                    call.metrics.record_circuit_open(key)
+                raise CircuitOpenError(
+                    "Circuit breaker open for {}, not sending request".format(key), None, [])
+            call.admitted = True
+
+    def _report_outcome(self, call, status):
+        """ Tells the circuit breaker how the attempt went, status is None
+        if it raised. Returns True if this opened the circuit. """
+        call.admitted = False
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return False
+        if status is None or status >= 500:
+            key = endpoint_template(call.endpoint)
+            if breaker.failure(key):
+                log.warning("%s keeps failing, circuit breaker open for %ss", key, breaker.reset_timeout)
+                return True
+        elif breaker.failing:
+            breaker.success(endpoint_template(call.endpoint))
+        return False
+
+    def _retry_delay(self, call, status=None, error=None):
+        """ Books the outcome of an attempt with the circuit breaker and
+        returns the seconds to wait before trying again, or None if the
+        request is done. status is None if the attempt raised error. No
+        retry is made that would start after the deadline. """
+        method, endpoint, policy = call.method, call.endpoint, call.policy
+        if self._report_outcome(call, status):
+            # Report this failure rather than the open circuit
+            return None
+        if policy is None or (status is not None and status < 429):
+            return None
+        if error is not None and not isinstance(error, self._retry_errors):
+            return None
+        elapsed = 0 if call.first is None else _clock() - call.first
+        delay = policy.retry_delay(call.attempt, elapsed, status,
+                                   unsent=error is not None and self._unsent(error))
+        if delay is not None and call.expires is not None and _clock() + delay >= call.expires:
+            log.debug("%s %s not retried, past its deadline", method, endpoint)
+            return None
+        if delay is not None:
+            cause = 'connection' if status is None else str(status)
+            log.debug("%s %s failed (%s), retry %s in %.2fs", method, endpoint,
+                      cause if error is None else error, call.attempt, delay)
+            if call.metrics is not None:
+                call.metrics.record_retry(endpoint_template(endpoint), cause)
+        return delay
+
+    def _update_ratelimit(self, headers):
+        """ Learn the rate limit state from the response headers """
+        self.ratelimiter.update(headers)
+
+    def _handle_response(self, method, url, status_code, ret, get_text, json, silent_codes):
+        """ Raise APIException for error responses, otherwise return the
+        payload. ret is the decoded body or _UNDECODED if decoding failed,
+        get_text returns the raw body and json is the request body. Both are
+        only serialized if they are logged. """
+        if ret is _UNDECODED:
+            if status_code > 299:
+                log.warning("%s %s %s req=%s res=\n%s",
+                            method, url, status_code, _json.dumps(json, default=str), get_text())
+                raise APIException(
+                    "Invalid return code from backend", status_code, [])
+            else:
+                return True
+
+        if status_code > 299:
+            if status_code not in silent_codes:
+                log.warning("%s %s %s req=%s res=\n%s",
+                            method, url, status_code, _json.dumps(json, default=str), get_text())
+            errors = [e['code'] for e in ret['errors']]
+            raise APIException(
+                "Invalid return code from backend", status_code, errors)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s %s req=%s res=%s", method, url, _json.dumps(json, default=str), ret)
+        return ret['data']
+
+    @staticmethod
+    def _cancel_result(order_id, exc=None):
+        """ Builds the per order result reported by the bulk cancel methods.
+        exc is an APIException, or a transport exception which is included
+        as `error`. """
+        if exc is None:
+            return {'id': order_id, 'result': 'cancelled'}
+        if not isinstance(exc, APIException):
+            return {'id': order_id, 'result': 'failed', 'code': None, 'errors': [], 'error': exc}
+        result = 'failed'
+        if ORDER_CLOSED_ERRORS.intersection(exc.errors):
+            result = 'closed'
+        return {'id': order_id, 'result': result, 'code': exc.code, 'errors': exc.errors}
+
+    @staticmethod
+    def _check_market_args(market_id, market_string):
         if market_id is not None and market_string is not None:
             raise ValueError(
                 "market_id and market_string are mutually exclusive")
         elif market_id is None and market_string is None:
             raise ValueError("either market_id or market_string are required")
+
+    @staticmethod
+    def _check_order_args(value, amount, market_id, market_string):
+        BaseQtradeAPI._check_market_args(market_id, market_string)
         if value is not None and amount is not None:
             raise ValueError("value and amount are mutually exclusive")
         elif value is None and amount is None:
             raise ValueError("either value or amount are required")
 
-        if market_string is not None:
-            market_id = self.markets[market_string]['id']
-        price = Decimal(price).quantize(COIN)
-        if prevent_taker is True:
-            ticker = self.tickers[market_id]
-            if ticker['ask'] and order_type == "buy_limit" and price > Decimal(ticker['ask']):
+    def _prepare_order(self, markets, tickers, order_type, price, value=None, amount=None,
+                       market_id=None, market_string=None):
+        """ Quantize and fee adjust an order. Returns the (endpoint, payload)
+        to post, or None if prevent_taker (signalled by passing tickers)
+        stopped the order. """
+        market = markets[market_string if market_string is not None else market_id]
+        market_id = market.id
+        if self.fixed_point:
+            price = to_sats(price)
+        else:
+            price = Decimal(price).quantize(COIN)
+        if tickers is not None:
+            if self._tickers_stale():
+                log.info("%s %s at %s was not placed.  Tickers are %ss old, so it might have been a taker order.",
+                         market_id, order_type, price, int(time.time() - self._tickers_age))
+                return None
+            ticker = tickers[market_id]
+            ask, bid = (ticker.ask_sats, ticker.bid_sats) if self.fixed_point else (ticker.ask, ticker.bid)
+            if ask and order_type == "buy_limit" and price > ask:
                 log.info("%s %s at %s was not placed.  Ask price is %s, so it would have been a taker order.",
-                         market_id, order_type, price, ticker['ask'])
-                return "order not placed"
-            elif ticker['bid'] and order_type == 'sell_limit' and price < Decimal(ticker['bid']):
+                         market_id, order_type, price, ticker.ask)
+                return None
+            elif bid and order_type == 'sell_limit' and price < bid:
                 log.info("%s %s at %s was not placed.  Bid price is %s, so it would have been a taker order.",
-                         market_id, order_type, price, ticker['bid'])
-                return "order not placed"
+                         market_id, order_type, price, ticker.bid)
+                return None
+        if self.fixed_point:
+            price, amount = self._size_order_sats(market, order_type, price, value, amount)
         # convert value to amount if necessary
-        if order_type == 'buy_limit' and value is not None:
-            fee_perc = max(Decimal(self.markets[market_id]['taker_fee']), Decimal(
-                self.markets[market_id]['maker_fee']))
-            fee_mult = Decimal(fee_perc+1)
-            amount = (Decimal(value) / (fee_mult * price)).quantize(COIN)
+        elif order_type == 'buy_limit' and value is not None:
+            amount = (Decimal(value) / (market.fee_mult * price)).quantize(COIN)
         elif order_type == 'sell_limit' and value is not None:
             amount = (Decimal(value) / price).quantize(COIN)
         logging.debug("Placing %s on %s market for %s at %s",
-                      order_type, self.markets[market_id]['string'], amount, price)
-        return self.post('/v1/user/{}'.format(order_type), amount=str(amount),
-                         price=str(price), market_id=market_id)
+                      order_type, market.string, amount, price)
+        return '/v1/user/{}'.format(order_type), dict(
+            amount=str(amount), price=str(price), market_id=market_id)
 
-    def balances_merged(self):
-        """ Get total balances including order balances """
-        bals = self.balances_all()
+    @staticmethod
+    def _size_order_sats(market, order_type, price, value, amount):
+        """ Fixed point version of the value to amount conversion, returning
+        price and amount as strings. Rounds exactly, where the Decimal version
+        first rounds the quotient to 28 digits, so results agree except for
+        quotients within 1e-28 of a rounding tie. """
+        if value is None:
+            amount = to_sats(amount)
+        elif order_type == 'buy_limit':
+            # amount = value / (fee_mult * price) with fee_mult = num / den
+            num, den = market.fee_ratio
+            amount = div_round(to_sats(value) * den * COIN_SATS, num * price)
+        elif order_type == 'sell_limit':
+            amount = div_round(to_sats(value) * COIN_SATS, price)
+        return from_sats(price), from_sats(amount)
+
+    def _prepare_batch(self, markets, tickers, orders):
+        """ Prepares a list of order specs, see QtradeAPI.order_batch """
+        prepared = []
+        for spec in orders:
+            spec = dict(spec)
+            prevent_taker = spec.pop('prevent_taker', False)
+            prepared.append(self._prepare_order(
+                markets, tickers if prevent_taker is True else None, **spec))
+        return prepared
+
+    @staticmethod
+    def _check_batch(orders):
+        """ Validates every order spec before anything is sent. Returns
+        whether any spec asks for prevent_taker """
+        for spec in orders:
+            BaseQtradeAPI._check_order_args(spec.get('value'), spec.get('amount'),
+                                            spec.get('market_id'), spec.get('market_string'))
+        return any(spec.get('prevent_taker') is True for spec in orders)
+
+    def _parse_balances(self, balances):
+        parse = to_sats if self.fixed_point else Decimal
+        return {b['currency']: parse(b['balance']) for b in balances}
+
+    def _parse_balances_all(self, all_bal):
+        return {
+            "spendable": self._parse_balances(all_bal['balances']),
+            "in_orders": self._parse_balances(all_bal['order_balances']),
+        }
+
+    @staticmethod
+    def _merge_balances(bals):
         merged = {}
         for k, v in list(bals['spendable'].items()) + list(bals['in_orders'].items()):
             merged.setdefault(k, 0)
-            merged[k] += Decimal(v)
+            # Both parsers already return Decimal or int values
+            merged[k] += v
         return merged
 
+    @staticmethod
+    def _orders_params(open, older_than, newer_than):
+        if isinstance(open, bool):
+            open = str(open).lower()
+        return dict(open=open, older_than=older_than, newer_than=newer_than)
+
+    def _tickers_stale(self):
+        max_staleness = self.tickers_max_staleness
+        if max_staleness is None and self.background_refresh:
+            # Failing background refreshes would serve the same tickers
+            # forever
+            max_staleness = 2 * self.tickers_update_interval
+        return max_staleness is not None and time.time() - self._tickers_age > max_staleness
+
+    def _start_refresh(self, name):
+        """ Returns False if a background refresh of `name` is running
+        already, otherwise marks it as running """
+        with self._refresh_lock:
+            if name in self._refreshing:
+                return False
+            self._refreshing.add(name)
+            return True
+
+    def _finish_refresh(self, name):
+        with self._refresh_lock:
+            self._refreshing.discard(name)
+
+    def _tickers_expired(self):
+        return self._tickers is None or (time.time() - self._tickers_age) > self.tickers_update_interval
+
+    def _index_tickers(self, res):
+        # Both indexes share the same Ticker objects
+        tickers = [Ticker.from_json(t) for t in res['markets']]
+        index = {t.id: t for t in tickers}
+        index.update({t.id_hr: t for t in tickers})
+        # Only publish the complete index, other threads may be reading
+        self._tickers = index
+        self._tickers_age = time.time()
+
+    def _common_expired(self):
+        return self._markets_map is None or (time.time() - self._markets_age) > self.market_update_interval
+
+    def _index_common(self, common, save=True):
+        currencies = {c['code']: Currency.from_json(c) for c in common['currencies']}
+        # Index our market information by market string and id, both
+        # indexes share the same Market objects
+        # The response is left as it is, coalesced GETs share it
+        markets = [Market.from_json(m, currencies) for m in common['markets']]
+        if save:
+            self._save_common_cache(common)
+        self._currencies_map = currencies
+        index = {m.string: m for m in markets}
+        index.update({m.id: m for m in markets})
+        self._markets_map = index
+        self._markets_age = time.time()
+
+    def _load_common_cache(self):
+        """ Load markets and currencies from the /v1/common response saved
+        in common_cache_path. Returns False if there is no usable cache. A
+        snapshot younger than common_cache_ttl counts as freshly loaded. """
+        if self.common_cache_path is None:
+            return False
+        try:
+            with open(self.common_cache_path, 'rb') as f:
+                cached = self.codec.loads(f.read())
+            if cached['version'] != COMMON_CACHE_VERSION or cached['endpoint'] != self.endpoint:
+                return False
+            if not 0 <= time.time() - cached['saved_at'] <= self.common_cache_ttl:
+                return False
+            self._index_common(cached['common'], save=False)
+        except Exception as e:
+            log.debug("Not using common cache %s: %s", self.common_cache_path, e)
+            return False
+        return True
+
+    def _save_common_cache(self, common):
+        """ Saves the /v1/common response as JSON, only readable by us """
+        if self.common_cache_path is None:
+            return
+        tmp = "{}.{}.tmp".format(self.common_cache_path, os.getpid())
+        try:
+            data = self.codec.dumps({
+                'version': COMMON_CACHE_VERSION,
+                'endpoint': self.endpoint,
+                'saved_at': time.time(),
+                'common': common,
+            })
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(data)
+            # Readers never see a partially written file
+            os.rename(tmp, self.common_cache_path)
+        except Exception as e:
+            log.warning("Failed to write common cache %s: %s", self.common_cache_path, e)
+
+
+class QtradeAPI(BaseQtradeAPI):
+    """ Blocking client built on a requests Session.
+
+    The session keeps up to `pool_maxsize` keep-alive connections per host
+    (`pool_connections` hosts are pooled). Size it to the number of threads
+    sharing the client; with `pool_block=True` threads wait for a free
+    connection instead of opening a throwaway one when the pool is used up.
+    `timeout` (seconds, or a (connect, read) tuple) applies to every request
+    that doesn't pass its own. """
+
+    _transport_errors = (requests.exceptions.RequestException,)
+    _retry_errors = _STREAM_ERRORS
+    _timeout_errors = requests.exceptions.Timeout
+
+    @staticmethod
+    def _unsent(error):
+        # Failing to connect at all ends up as a ConnectionError wrapping
+        # urllib3's MaxRetryError(reason=NewConnectionError)
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def __init__(self, endpoint, origin=None, email='Unk', key=None, ratelimiter=None,
+                 common_cache_path=None, pool_connections=10, pool_maxsize=16, pool_block=False,
+                 timeout=None, tcp_keepalive=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.timeout = timeout
+        self.tcp_keepalive = tcp_keepalive
+        self.rs = requests.Session()
+        adapter = TransportAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block,
+            socket_options=_socket_options(tcp_keepalive))
+        self.rs.mount('https://', adapter)
+        self.rs.mount('http://', adapter)
+        super(QtradeAPI, self).__init__(endpoint, origin=origin, email=email, key=key,
+                                        ratelimiter=ratelimiter, common_cache_path=common_cache_path)
+
+    def _clone_kwargs(self):
+        kwargs = super(QtradeAPI, self)._clone_kwargs()
+        kwargs.update(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                      pool_block=self.pool_block, timeout=self.timeout, tcp_keepalive=self.tcp_keepalive)
+        return kwargs
+
+    def clone(self, share_pool=False):
+        """ See BaseQtradeAPI.clone. With share_pool the clone uses the same
+        connection pools as this client, so it starts with warm connections
+        and both count against one pool size. """
+        c = super(QtradeAPI, self).clone()
+        if share_pool:
+            for prefix, adapter in self.rs.adapters.items():
+                c.rs.mount(prefix, adapter)
+        return c
+
+    def close(self):
+        """ Closes the pooled connections """
+        self.rs.close()
+
+    def login(self, email, password):
+        """ Login with username and password to get a JWT token.
+        Intended for internal testing only. """
+        resp = self._req('post', "/v1/login", json={
+            "email": email,
+            "password": password,
+        })
+        self.user_id = resp['user_id']
+        self.token = resp['token']
+
+    def set_hmac(self, hmac_pair):
+        super(QtradeAPI, self).set_hmac(hmac_pair)
+        self.rs.auth = self.auth
+
+    def balances(self):
+        return self._parse_balances(self.get("/v1/user/balances")['balances'])
+
+    def get(self, endpoint, *args, **kwargs):
+        key = self._flight_key(endpoint, args, kwargs) if self.coalesce_gets else None
+        if key is None:
+            return self._req('get', endpoint, *args, **kwargs)
+        return self._single_flight(key, self._req, 'get', endpoint, *args, **kwargs)
+
+    def _single_flight(self, key, func, *args, **kwargs):
+        """ Runs func, unless a call with the same key is running already, in
+        which case its result is awaited and returned (or its exception
+        raised) instead, within the deadline of the call. If the running
+        call ran out of its own deadline or rate limit budget, func is run
+        again within this call's. """
+        # setdefault and pop are atomic for keys of builtin types, so the
+        # registry needs no lock of its own
+        mine = _Flight()
+        flight = self._inflight.setdefault(key, mine)
+        if flight is not mine:
+            expires = self._expires(kwargs.get('deadline'))
+            if not flight.wait(None if expires is None else expires - _clock()):
+                raise self._deadline_error('get', key[0], "waiting for the same request in flight")
+            if flight.error is None:
+                return flight.result
+            if not self._budget_error(flight.error):
+                raise flight.error
+            # The deadline scope keeps the time spent waiting off the budget
+            # of the new attempt
+            outer = self._scope_expires()
+            self._set_scope_expires(expires)
+            try:
+                return self._single_flight(key, func, *args, **kwargs)
+            finally:
+                self._set_scope_expires(outer)
+        try:
+            flight.result = func(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._inflight.pop(key, None)
+            flight.done.release()
+
+    def post(self, endpoint, *args, **kwargs):
+        return self._req('post', endpoint, *args, **kwargs)
+
+    def orders(self, open=None, older_than=None, newer_than=None):
+        return self.get("/v1/user/orders", **self._orders_params(open, older_than, newer_than))['orders']
+
+    def iter_orders(self, open=None, older_than=None, prefetch=True):
+        """ Lazily yields orders, newest first, across all pages of
+        orders(). With prefetch the next page is requested on a background
+        thread while the current one is consumed. At most two pages are held
+        in memory. History requests run at LOW rate limit priority. """
+        def fetch(older_than):
+            return self.get("/v1/user/orders", priority=LOW,
+                            **self._orders_params(open, older_than, None))['orders']
+
+        pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = fetch(older_than)
+            while page:
+                oldest = min(o['id'] for o in page)
+                if older_than is not None and oldest >= older_than:
+                    # The backend ignored older_than, don't loop forever
+                    break
+                older_than = oldest
+                next_page = pool.submit(self._in_scope(fetch), oldest) if pool else None
+                for o in page:
+                    yield o
+                page = next_page.result() if next_page else fetch(oldest)
+        finally:
+            if pool:
+                pool.shutdown(wait=False)
+
+    def order(self, order_type, price, value=None, amount=None, market_id=None, market_string=None, prevent_taker=False):
+        """ Place an order with the given parameters.
+        value = amount * price """
+        self._check_order_args(value, amount, market_id, market_string)
+        # Data reloaded on the way to an order is as urgent as the order
+        tickers = self._get_tickers(URGENT) if prevent_taker is True else None
+        prepared = self._prepare_order(self._get_markets(URGENT), tickers, order_type, price, value=value,
+                                       amount=amount, market_id=market_id, market_string=market_string)
+        if prepared is None:
+            return "order not placed"
+        endpoint, payload = prepared
+        return self.post(endpoint, **payload)
+
+    def order_batch(self, orders, workers=8):
+        """ Place many orders at once. orders is a list of dicts holding the
+        keyword arguments of order(), eg
+        {'order_type': 'buy_limit', 'price': '0.01', 'value': 1, 'market_id': 1}.
+
+        All orders are validated, quantized and fee adjusted before the first
+        one is sent, then submitted in parallel over at most `workers` threads
+        under the rate limiter. Returns one dict per order in input order:
+        {'result': <response or "order not placed">, 'error': <the exception
+        placing it raised, eg an APIException, or None>, 'elapsed': <seconds
+        spent submitting>} """
+        need_tickers = self._check_batch(orders)
+        prepared = self._prepare_batch(self._get_markets(URGENT),
+                                       self._get_tickers(URGENT) if need_tickers else None, orders)
+        return self._parallel(self._submit_order, prepared, workers)
+
+    def _submit_order(self, prepared):
+        if prepared is None:
+            return {'result': "order not placed", 'error': None, 'elapsed': 0}
+        endpoint, payload = prepared
+        start = time.time()
+        try:
+            result, error = self.post(endpoint, **payload), None
+        except Exception as e:
+            # Whatever fails, the responses of the other orders must reach
+            # the caller
+            result, error = None, e
+        return {'result': result, 'error': error, 'elapsed': time.time() - start}
+
+    def balances_merged(self):
+        """ Get total balances including order balances """
+        return self._merge_balances(self.balances_all())
+
     def balances_all(self):
-        all_bal = self.get("/v1/user/balances_all")
-        return {
-            "spendable": {b['currency']: Decimal(b['balance']) for b in all_bal['balances']},
-            "in_orders": {b['currency']: Decimal(b['balance']) for b in all_bal['order_balances']},
-        }
+        return self._parse_balances_all(self.get("/v1/user/balances_all"))
 
-    def cancel_all_orders(self):
-        for o in self.orders(open=True):
-            self.post('/v1/user/cancel_order', json={'id': o['id']})
+    def cancel_orders(self, order_ids, workers=8):
+        """ Cancel many orders in parallel over at most `workers` threads.
+        Never raises for a single order, instead returns one result per order
+        id, in input order, eg {'id': 1, 'result': 'cancelled'}. result is
+        'closed' if the order was filled or cancelled already, and 'failed'
+        otherwise, with the APIException code and errors included, or the
+        exception as 'error' if the request failed in transport. """
+        return self._parallel(self._cancel_one, order_ids, workers)
 
-    def cancel_market_orders(self, market_string=None, market_id=None):
-        if market_id is not None and market_string is not None:
-            raise ValueError(
-                "market_id and market_string are mutually exclusive")
-        elif market_id is None and market_string is None:
-            raise ValueError("either market_id or market_string are required")
+    def _cancel_one(self, order_id):
+        try:
+            self.post('/v1/user/cancel_order', json={'id': order_id})
+        except (APIException,) + self._transport_errors as e:
+            return self._cancel_result(order_id, e)
+        return self._cancel_result(order_id)
+
+    def _parallel(self, func, items, workers):
+        """ Map func over items on a bounded thread pool, keeping input
+        order. Rate limit reservations in _req keep the workers within the
+        shared request budget, and the workers inherit the deadline scope. """
+        items = list(items)
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+            return list(pool.map(self._in_scope(func), items))
+
+    def cancel_all_orders(self, bulk=False, workers=8):
+        """ Cancel all open orders. With bulk=True cancels are sent in
+        parallel and per order results are returned, see cancel_orders. """
+        ids = [o['id'] for o in self.orders(open=True)]
+        if bulk:
+            return self.cancel_orders(ids, workers=workers)
+        for order_id in ids:
+            self.post('/v1/user/cancel_order', json={'id': order_id})
+
+    def cancel_market_orders(self, market_string=None, market_id=None, bulk=False, workers=8):
+        """ Cancel all open orders on one market. See cancel_all_orders for
+        bulk mode. """
+        self._check_market_args(market_id, market_string)
         if market_id is None:
-            market_id = self.markets[market_string]['id']
-        for o in self.orders(open=True):
-            if o['market_id'] == market_id:
-                self.post('/v1/user/cancel_order', json={'id': o['id']})
+            market_id = self._get_markets(URGENT)[market_string]['id']
+        ids = [o['id'] for o in self.orders(open=True) if o['market_id'] == market_id]
+        if bulk:
+            return self.cancel_orders(ids, workers=workers)
+        for order_id in ids:
+            self.post('/v1/user/cancel_order', json={'id': order_id})
+
+    def stream(self, endpoint, resume=None, max_reconnects=5, reconnect_delay=1, **params):
+        """ Yields the records of a newline delimited JSON endpoint as they
+        arrive. Only one chunk of the response is buffered at a time and
+        nothing is read until the consumer asks for the next record.
+
+        If the connection drops the stream is reopened, up to max_reconnects
+        times in a row with a growing delay. To pick up where it left off,
+        pass resume, a function of the last record returning the params of
+        the new request, eg `lambda rec: {'newer_than': rec['id']}`. """
+        last = None
+        failures = 0
+        while True:
+            req_params = dict(params)
+            if last is not None and resume is not None:
+                req_params.update(resume(last))
+            try:
+                for record in self.get(endpoint, stream=True, **req_params):
+                    last = record
+                    failures = 0
+                    yield record
+                return
+            except _STREAM_ERRORS as e:
+                failures += 1
+                if failures > max_reconnects:
+                    raise
+                log.warning("Stream %s interrupted (%s), reconnecting", endpoint, e)
+                time.sleep(reconnect_delay * failures)
+
+    def _iter_records(self, res):
+        """ Parse a streaming response into JSON records, one per line """
+        loads = self.codec.loads
+        pending = b""
+        try:
+            for chunk in res.iter_content(chunk_size=self.stream_chunk_size):
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for ln in lines:
+                    if ln.strip():
+                        yield loads(ln)
+                if len(pending) > self.stream_max_line:
+                    raise APIException("Streamed record exceeds stream_max_line", res.status_code, [])
+            if pending.strip():
+                yield loads(pending)
+        finally:
+            res.close()
 
     @property
     def tickers(self):
         """ Tickers may be indexed either by market id or market string """
-        self._refresh_tickers()
+        return self._get_tickers()
+
+    def _get_tickers(self, priority=NORMAL):
+        self._refresh_tickers(priority)
         return self._tickers
 
-    def _refresh_tickers(self):
-        """ Lazy load and reload every tickers_update_interval. """
-        if self._tickers is None or (time.time() - self._tickers_age) > self.tickers_update_interval:
-            res = self.get('/v1/tickers')
-            self._tickers = {m['id']: m for m in res['markets']}
-            self._tickers.update({m['id_hr']: m for m in res['markets']})
-            self._tickers_age = time.time()
+    def _refresh_tickers(self, priority=NORMAL):
+        """ Lazy load and reload every tickers_update_interval. A reload
+        the caller waits for runs at its `priority`, background ones at LOW. """
+        if self._tickers_expired():
+            if self.background_refresh and self._tickers is not None:
+                self._refresh_in_background('tickers', self._load_tickers)
+            else:
+                with self._tickers_lock:
+                    # Another thread may have loaded them while we waited
+                    if self._tickers_expired():
+                        self._load_tickers(priority)
+
+    def _load_tickers(self, priority=LOW):
+        self._index_tickers(self.get('/v1/tickers', priority=priority))
+
+    def _refresh_in_background(self, name, load):
+        if not self._start_refresh(name):
+            return
+
+        def run():
+            try:
+                load()
+            except Exception:
+                log.exception("Background refresh of %s failed", name)
+            finally:
+                self._finish_refresh(name)
+        t = threading.Thread(target=run, name="qtrade-refresh-{}".format(name))
+        t.daemon = True
+        t.start()
 
     @property
     def currencies(self):
@@ -213,98 +1200,113 @@ class QtradeAPI(object):
     @property
     def markets(self):
         """ Markets may be indexed either by id or string """
-        self._refresh_common()
+        return self._get_markets()
+
+    def _get_markets(self, priority=NORMAL):
+        self._refresh_common(priority)
         return self._markets_map
 
-    def _refresh_common(self):
-        """ Lazy load and reload every market_update_interval. """
-        if self._markets_map is None or (time.time() - self._markets_age) > self.market_update_interval:
-            # Index our market information by market string
-            common = self.get("/v1/common")
-            self._currencies_map = {c['code']: c for c in common['currencies']}
-            # Set some convenience keys so we can pass around just the dict
-            for m in common['markets']:
-                m['string'] = "{market_currency}_{base_currency}".format(**m)
-                m['base_currency'] = self._currencies_map[m['base_currency']]
-                m['market_currency'] = self._currencies_map[m['market_currency']]
-            self._markets_map = {m['string']: m for m in common['markets']}
-            self._markets_map.update({m['id']: m for m in common['markets']})
-            self._markets_age = time.time()
-
-    def _req(self, method, endpoint, silent_codes=[], headers={}, json=None, params=None, is_retry=False, **kwargs):
-        soft_limit = int(self.rl_limit * (1 - self.rl_soft_threshold))
-        # If limit is completely exhausted, sleep until full reset. Clamp to
-        # min 0 to not bomb out if reset_at is in past
-        if self.honor_ratelimit and self.rl_remaining <= 0:
-            must_wait = max(0, self.rl_reset_at - time.time())
-            if must_wait >= 5:
-                log.info("Ratelimit hit, sleeping for {:,}".format(must_wait))
-            time.sleep(must_wait)
-
-        # If limit is >self.rl_soft_threshold % used, sleep the appropriate
-        # amount to avoid hitting a big wait
-        elif self.honor_ratelimit and self.rl_remaining <= soft_limit:
-            sec_to_reset = self.rl_reset_at - time.time()
-            must_wait = max(0, sec_to_reset / float(self.rl_remaining))
-            time.sleep(must_wait)
-
-        # Inject the auth token header if applicable
-        if self.token:
-            headers['Authorization'] = "Bearer {}".format(self.token)
+    def _refresh_common(self, priority=NORMAL):
+        """ Lazy load and reload every market_update_interval. A reload
+        the caller waits for runs at its `priority`, background ones at LOW. """
+        if self._common_expired():
+            if self.background_refresh and self._markets_map is not None:
+                self._refresh_in_background('common', self._load_common)
+                return
+            with self._common_lock:
+                if not self._common_expired():
+                    return
+                if self._markets_map is None and self._load_common_cache():
+                    return
+                self._load_common(priority)
+
+    def _load_common(self, priority=LOW):
+        self._index_common(self.get("/v1/common", priority=priority))
+
+    def _req(self, method, endpoint, silent_codes=(), headers=None, json=None, params=None, is_retry=False,
+             priority=None, deadline=None, **kwargs):
+        if priority is None:
+            priority = self._priority(endpoint)
 
         # We remove all kwargs that might be intended for our session.request
-        requests_kwarg_keys = ['data', 'cookies', 'files', 'auth', 'timeout',
-                               'allow_redirects', 'proxies', 'hooks', 'stream', 'verify', 'cert']
         requests_kwargs = {}
-        for key in requests_kwarg_keys:
-            requests_kwargs[key] = kwargs.pop(key, None)
+        if kwargs:
+            for key in _REQUESTS_KWARGS.intersection(kwargs):
+                requests_kwargs[key] = kwargs.pop(key)
+
+        if self.timeout is not None and 'timeout' not in requests_kwargs:
+            requests_kwargs['timeout'] = self.timeout
 
-        url = urljoin(self.endpoint, endpoint)
+        url = self._url(endpoint)
 
         # Support legacy usage of the json parameter, but prefer passing POST
         # params as kwargs
-        if method.lower() == "post" and json is None:
+        method_l = method.lower()
+        if method_l == "post" and json is None:
             json = kwargs
-        req_json = _json.dumps(json)
 
         # Support passing params just because...
-        if method.lower() == "get" and params is None:
+        elif method_l == "get" and params is None:
             params = kwargs
 
-        res = self.rs.request(method, url, headers=headers,
-                              json=json, params=params, **requests_kwargs)
-        self.rl_reset_at = time.time() + int(res.headers.get('X-Ratelimit-Reset', 0))
-        self.rl_limit = int(res.headers.get('X-Ratelimit-Limit', 100))
-        self.rl_remaining = int(res.headers.get('X-Ratelimit-Remaining', 99))
-        if requests_kwargs.get('stream') is True:
-            log.debug("GET streaming {}".format(url))
-            for ln in res.iter_lines():
-                print(ln.decode('utf8'))
-            return
-
-        # We've hit the rate limit, so retry. Code at beginning of call
-        # will proc now that we've populated rl_limit, etc
-        if res.status_code == 429 and is_retry is False:
-            return self._req(method, endpoint, silent_codes=silent_codes, headers=headers, json=json, params=params, is_retry=True, **kwargs)
+        # Encode the body ourselves, with the client's codec
+        encode = json is not None and 'data' not in requests_kwargs
+        if encode or self.token:
+            headers = dict(headers or {})
+            if encode:
+                requests_kwargs['data'] = self.codec.dumps(json)
+                headers['Content-Type'] = 'application/json'
+            # Inject the auth token header if applicable
+            if self.token:
+                headers['Authorization'] = "Bearer {}".format(self.token)
 
+        # Streams reconnect on their own, see stream(), and run for as long
+        # as they are read, so neither retries nor deadlines apply
+        stream = requests_kwargs.get('stream') is True
+        call = self._start_call(method, endpoint, priority,
+                                None if is_retry or stream else self._retry_policy(method, endpoint),
+                                None if stream else self._expires(deadline))
         try:
-            ret = res.json()
-        except Exception:
-            if res.status_code > 299:
-                log.warning("{} {} {} req={} res=\n{}".format(
-                    method, url, res.status_code, req_json, res.text))
-                raise APIException(
-                    "Invalid return code from backend", res.status_code, [])
-            else:
-                return True
+            while True:
+                delay = self._start_attempt(call)
+                while delay:
+                    time.sleep(delay)
+                    delay = self._waited(call)
+                left = self._admit(call)
+                send_kwargs = requests_kwargs
+                if left is not None:
+                    # The network timeout is what is left of the budget
+                    send_kwargs = dict(requests_kwargs)
+                    send_kwargs['timeout'], call.capped = _budget_timeout(requests_kwargs.get('timeout'), left)
+                try:
+                    res = self.rs.request(method, url, headers=headers, params=params, **send_kwargs)
+                except Exception as e:
+                    delay = self._attempt_failed(call, e)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    continue
+                self._responded(call, res.headers)
+                # A 429 is retried right away, the rate limiter knows how
+                # long to wait from the headers we just got
+                delay = self._attempt_done(call, res.status_code)
+                if delay is None:
+                    break
+                if delay:
+                    time.sleep(delay)
+        finally:
+            self._end_call(call)
 
-        if res.status_code > 299:
-            if res.status_code not in silent_codes:
-                log.warning("{} {} {} req={} res=\n{}".format(
-                    method, url, res.status_code, req_json, res.text))
-            errors = [e['code'] for e in ret['errors']]
-            raise APIException(
-                "Invalid return code from backend", res.status_code, errors)
+        if stream and res.status_code < 300:
+            log.debug("%s streaming %s", method, url)
+            if call.metrics is not None:
+                self._record_attempt(call, res.status_code)
+            return self._iter_records(res)
 
-        log.debug("GET {} req={} res={}".format(url, req_json, ret))
-        return ret['data']
+        try:
+            ret = self.codec.loads(res.content)
+        except Exception:
+            ret = _UNDECODED
+        if call.metrics is not None:
+            self._record_attempt(call, res.status_code, decoded=True)
+        return self._handle_response(method, url, res.status_code, ret, lambda: res.text, json, silent_codes)
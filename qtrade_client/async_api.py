@@ -0,0 +1,378 @@
+import asyncio
+import contextvars
+import time
+import aiohttp
+from yarl import URL
+
+from .api import APIException, BaseQtradeAPI, LOW, NORMAL, URGENT, _UNDECODED, _clock, log
+
+
+class AsyncQtradeAPI(BaseQtradeAPI):
+    """ asyncio version of QtradeAPI. Every request method is a coroutine and
+    all requests share one pooled keep-alive connector, so a single event
+    loop can drive many markets concurrently.
+
+    The lazily loaded `markets`, `currencies` and `tickers` properties return
+    awaitables, ie `markets = await api.markets`. Call `close()` (or use the
+    client as an async context manager) when done. """
+
+    _transport_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+    _retry_errors = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+    _timeout_errors = asyncio.TimeoutError
+
+    @staticmethod
+    def _unsent(error):
+        return isinstance(error, aiohttp.ClientConnectorError)
+
+    def __init__(self, endpoint, origin=None, email='Unk', key=None, ratelimiter=None,
+                 common_cache_path=None, connection_limit=100, keepalive_timeout=30, timeout=None):
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session = None
+        super(AsyncQtradeAPI, self).__init__(endpoint, origin=origin, email=email, key=key,
+                                             ratelimiter=ratelimiter, common_cache_path=common_cache_path)
+        # Deadline scopes follow the task, and the tasks it starts
+        self._scope = contextvars.ContextVar('qtrade_deadline', default=None)
+        # Running background refreshes by name. The event loop only keeps
+        # weak references to tasks.
+        self._refresh_tasks = {}
+
+    def _scope_expires(self):
+        return self._scope.get()
+
+    def _set_scope_expires(self, expires):
+        self._scope.set(expires)
+
+    def _clone_kwargs(self):
+        kwargs = super(AsyncQtradeAPI, self)._clone_kwargs()
+        kwargs.update(connection_limit=self.connection_limit,
+                      keepalive_timeout=self.keepalive_timeout, timeout=self.timeout)
+        return kwargs
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self):
+        """ The aiohttp session, created on first use so that it binds to
+        the running event loop """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def login(self, email, password):
+        """ Login with username and password to get a JWT token.
+        Intended for internal testing only. """
+        resp = await self._req('post', "/v1/login", json={
+            "email": email,
+            "password": password,
+        })
+        self.user_id = resp['user_id']
+        self.token = resp['token']
+
+    async def balances(self):
+        return self._parse_balances((await self.get("/v1/user/balances"))['balances'])
+
+    def get(self, endpoint, *args, **kwargs):
+        key = self._flight_key(endpoint, args, kwargs) if self.coalesce_gets else None
+        if key is None:
+            return self._req('get', endpoint, *args, **kwargs)
+        return self._single_flight(key, self._req, 'get', endpoint, *args, **kwargs)
+
+    async def _single_flight(self, key, func, *args, **kwargs):
+        """ Awaits func, or the running request with the same key instead,
+        within the deadline of the call. The request is shielded, so a
+        cancelled caller doesn't cancel it for the others. If the running
+        request ran out of its own deadline or rate limit budget, func is
+        awaited again within this call's. """
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = self._inflight[key] = asyncio.ensure_future(func(*args, **kwargs))
+            fut.add_done_callback(lambda f: self._inflight.pop(key, None))
+            return await asyncio.shield(fut)
+        expires = self._expires(kwargs.get('deadline'))
+        try:
+            if expires is None:
+                return await asyncio.shield(fut)
+            return await asyncio.wait_for(asyncio.shield(fut), max(0, expires - _clock()))
+        except asyncio.TimeoutError:
+            if fut.done():
+                raise
+            raise self._deadline_error('get', key[0], "waiting for the same request in flight")
+        except Exception as e:
+            if not fut.done() or not self._budget_error(e):
+                raise
+        # The deadline scope keeps the time spent waiting off the budget of
+        # the new attempt
+        outer = self._scope_expires()
+        self._set_scope_expires(expires)
+        try:
+            return await self._single_flight(key, func, *args, **kwargs)
+        finally:
+            self._set_scope_expires(outer)
+
+    def post(self, endpoint, *args, **kwargs):
+        return self._req('post', endpoint, *args, **kwargs)
+
+    async def orders(self, open=None, older_than=None, newer_than=None):
+        return (await self.get("/v1/user/orders", **self._orders_params(open, older_than, newer_than)))['orders']
+
+    async def iter_orders(self, open=None, older_than=None, prefetch=True):
+        """ Lazily yields orders across all pages, see QtradeAPI.iter_orders.
+        Use with `async for`. """
+        async def fetch(older_than):
+            return (await self.get("/v1/user/orders", priority=LOW,
+                                   **self._orders_params(open, older_than, None)))['orders']
+
+        page = await fetch(older_than)
+        next_page = None
+        try:
+            while page:
+                oldest = min(o['id'] for o in page)
+                if older_than is not None and oldest >= older_than:
+                    break
+                older_than = oldest
+                if prefetch:
+                    next_page = asyncio.ensure_future(fetch(oldest))
+                for o in page:
+                    yield o
+                page = await (next_page if prefetch else fetch(oldest))
+                next_page = None
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def order(self, order_type, price, value=None, amount=None, market_id=None, market_string=None,
+                    prevent_taker=False):
+        """ Place an order with the given parameters.
+        value = amount * price """
+        self._check_order_args(value, amount, market_id, market_string)
+        # Data reloaded on the way to an order is as urgent as the order
+        tickers = (await self._get_tickers(URGENT)) if prevent_taker is True else None
+        prepared = self._prepare_order(await self._get_markets(URGENT), tickers, order_type, price, value=value,
+                                       amount=amount, market_id=market_id, market_string=market_string)
+        if prepared is None:
+            return "order not placed"
+        endpoint, payload = prepared
+        return await self.post(endpoint, **payload)
+
+    async def order_batch(self, orders, concurrency=8):
+        """ Place many orders at once, see QtradeAPI.order_batch. At most
+        `concurrency` orders are in flight at a time. """
+        need_tickers = self._check_batch(orders)
+        tickers = (await self._get_tickers(URGENT)) if need_tickers else None
+        prepared = self._prepare_batch(await self._get_markets(URGENT), tickers, orders)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def submit(prepared):
+            if prepared is None:
+                return {'result': "order not placed", 'error': None, 'elapsed': 0}
+            endpoint, payload = prepared
+            async with semaphore:
+                start = time.time()
+                try:
+                    result, error = await self.post(endpoint, **payload), None
+                except Exception as e:
+                    result, error = None, e
+                return {'result': result, 'error': error, 'elapsed': time.time() - start}
+        return list(await asyncio.gather(*[submit(p) for p in prepared]))
+
+    async def balances_merged(self):
+        """ Get total balances including order balances """
+        return self._merge_balances(await self.balances_all())
+
+    async def balances_all(self):
+        return self._parse_balances_all(await self.get("/v1/user/balances_all"))
+
+    async def cancel_orders(self, order_ids, concurrency=8):
+        """ Cancel many orders concurrently, at most `concurrency` in flight.
+        Returns per order results like QtradeAPI.cancel_orders. """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def cancel(order_id):
+            async with semaphore:
+                try:
+                    await self.post('/v1/user/cancel_order', json={'id': order_id})
+                except (APIException,) + self._transport_errors as e:
+                    return self._cancel_result(order_id, e)
+                return self._cancel_result(order_id)
+        return list(await asyncio.gather(*[cancel(i) for i in order_ids]))
+
+    async def cancel_all_orders(self, bulk=False, concurrency=8):
+        """ Cancel all open orders. With bulk=True cancels are sent
+        concurrently and per order results are returned. """
+        ids = [o['id'] for o in await self.orders(open=True)]
+        if bulk:
+            return await self.cancel_orders(ids, concurrency=concurrency)
+        for order_id in ids:
+            await self.post('/v1/user/cancel_order', json={'id': order_id})
+
+    async def cancel_market_orders(self, market_string=None, market_id=None, bulk=False, concurrency=8):
+        self._check_market_args(market_id, market_string)
+        if market_id is None:
+            market_id = (await self._get_markets(URGENT))[market_string]['id']
+        ids = [o['id'] for o in await self.orders(open=True) if o['market_id'] == market_id]
+        if bulk:
+            return await self.cancel_orders(ids, concurrency=concurrency)
+        for order_id in ids:
+            await self.post('/v1/user/cancel_order', json={'id': order_id})
+
+    @property
+    def tickers(self):
+        """ Tickers may be indexed either by market id or market string """
+        return self._get_tickers()
+
+    async def _get_tickers(self, priority=NORMAL):
+        await self._refresh_tickers(priority)
+        return self._tickers
+
+    async def _refresh_tickers(self, priority=NORMAL):
+        """ Lazy load and reload every tickers_update_interval. A reload
+        the caller waits for runs at its `priority`, background ones at LOW. """
+        if self._tickers_expired():
+            if self.background_refresh and self._tickers is not None:
+                self._refresh_in_background('tickers', self._load_tickers)
+            else:
+                await self._load_tickers(priority)
+
+    async def _load_tickers(self, priority=LOW):
+        self._index_tickers(await self.get('/v1/tickers', priority=priority))
+
+    def _refresh_in_background(self, name, load):
+        if not self._start_refresh(name):
+            return
+
+        async def run():
+            try:
+                await load()
+            except Exception:
+                log.exception("Background refresh of %s failed", name)
+            finally:
+                self._finish_refresh(name)
+        task = self._refresh_tasks[name] = asyncio.ensure_future(run())
+        task.add_done_callback(lambda t: self._refresh_tasks.pop(name, None))
+
+    @property
+    def currencies(self):
+        return self._get_currencies()
+
+    async def _get_currencies(self):
+        await self._refresh_common()
+        return self._currencies_map
+
+    @property
+    def markets(self):
+        """ Markets may be indexed either by id or string """
+        return self._get_markets()
+
+    async def _get_markets(self, priority=NORMAL):
+        await self._refresh_common(priority)
+        return self._markets_map
+
+    async def _refresh_common(self, priority=NORMAL):
+        """ Lazy load and reload every market_update_interval. A reload
+        the caller waits for runs at its `priority`, background ones at LOW. """
+        if self._common_expired():
+            if self._markets_map is None and self._load_common_cache():
+                return
+            if self.background_refresh and self._markets_map is not None:
+                self._refresh_in_background('common', self._load_common)
+            else:
+                await self._load_common(priority)
+
+    async def _load_common(self, priority=LOW):
+        self._index_common(await self.get("/v1/common", priority=priority))
+
+    async def _req(self, method, endpoint, silent_codes=(), headers=None, json=None, params=None,
+                   is_retry=False, timeout=None, priority=None, deadline=None, **kwargs):
+        if priority is None:
+            priority = self._priority(endpoint)
+
+        headers = dict(headers or {})
+        # Inject the auth token header if applicable
+        if self.token:
+            headers['Authorization'] = "Bearer {}".format(self.token)
+
+        # Support legacy usage of the json parameter, but prefer passing POST
+        # params as kwargs
+        if method.lower() == "post" and json is None:
+            json = kwargs
+        body = None
+        if json is not None:
+            body = self.codec.dumps(json)
+            headers['Content-Type'] = 'application/json'
+
+        # Support passing params just because...
+        if method.lower() == "get" and params is None:
+            params = kwargs
+
+        # Build the final URL up front so the exact path and query we send
+        # is what gets signed. Like requests, drop params that are None.
+        url = URL(self._url(endpoint))
+        if params:
+            url = url.update_query({k: v for k, v in params.items() if v is not None})
+
+        if timeout is None:
+            timeout = self.timeout
+        session_kwargs = {}
+        if timeout is not None:
+            session_kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+        call = self._start_call(method, endpoint, priority,
+                                None if is_retry else self._retry_policy(method, endpoint),
+                                self._expires(deadline))
+        try:
+            while True:
+                delay = self._start_attempt(call)
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = self._waited(call)
+                # Signed per attempt, the signature carries a timestamp
+                if self.auth is not None:
+                    headers.update(self.auth.sign(method.upper(), url.raw_path_qs, body))
+                left = self._admit(call)
+                if left is not None:
+                    # The network timeout is what is left of the budget
+                    call.capped = timeout is None or left < timeout
+                    session_kwargs['timeout'] = aiohttp.ClientTimeout(total=min(left, timeout or left))
+                try:
+                    async with self.session.request(method, url, headers=headers, data=body,
+                                                    **session_kwargs) as res:
+                        self._responded(call, res.headers)
+                        status_code = res.status
+                        content = await res.read()
+                except Exception as e:
+                    delay = self._attempt_failed(call, e)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                # A 429 is retried right away, the rate limiter knows how
+                # long to wait from the headers we just got
+                delay = self._attempt_done(call, status_code)
+                if delay is None:
+                    break
+                if delay:
+                    await asyncio.sleep(delay)
+        finally:
+            self._end_call(call)
+
+        try:
+            ret = self.codec.loads(content)
+        except Exception:
+            ret = _UNDECODED
+        if call.metrics is not None:
+            self._record_attempt(call, status_code, decoded=True)
+        return self._handle_response(method, url, status_code, ret,
+                                     lambda: content.decode('utf8', 'replace'), json, silent_codes)
@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
-import yaml
+import json
 import os
 import os.path
 import click
 import sys
 import logging
 
-from pkg_resources import iter_entry_points
-from click_plugins import with_plugins
-
-from ..api import Qtrade
+from .daemon import daemon, forward, shell
+from .fanout import fanout
 
 log = logging.getLogger("qtrade-cli")
 
+# Parsed contents of the config dir, reused while no file in it changes
+CONFIG_CACHE = ".contexts.cache"
+CONFIG_CACHE_VERSION = 1
+
+BUILTIN_CONTEXTS = {
+    "dev_root": {
+        "origin": "builtin",
+        "config": {
+            "endpoint": 'http://localhost:9898',
+            "key": '1:1111111111111111111111111111111111111111111111111111111111111111',
+        },
+    },
+}
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -25,44 +37,193 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-@with_plugins(iter_entry_points('qtrade.plugins'))
-@click.group()
+def _entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        from pkg_resources import iter_entry_points
+        return list(iter_entry_points(group))
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+    return list(eps.get(group, ()))
+
+
+class LazyPluginGroup(click.Group):
+    """ Group whose plugin commands, from the `qtrade.plugins` entry points,
+    are only imported when invoked, or all of them when listed for --help """
+
+    plugin_group = 'qtrade.plugins'
+
+    def __init__(self, *args, **kwargs):
+        super(LazyPluginGroup, self).__init__(*args, **kwargs)
+        self._plugins = None
+
+    def _load(self, ep):
+        try:
+            cmd = ep.load()
+        except Exception as e:
+            log.warning("Failed to load plugin %s: %s", ep.name, e)
+            return None
+        self.add_command(cmd, ep.name)
+        return cmd
+
+    def _plugin_entry_points(self):
+        if self._plugins is None:
+            self._plugins = dict((ep.name, ep) for ep in _entry_points(self.plugin_group))
+        return self._plugins
+
+    def get_command(self, ctx, name):
+        cmd = super(LazyPluginGroup, self).get_command(ctx, name)
+        if cmd is None and name in self._plugin_entry_points():
+            cmd = self._load(self._plugins.pop(name))
+        return cmd
+
+    def list_commands(self, ctx):
+        for name in list(self._plugin_entry_points()):
+            self._load(self._plugins.pop(name))
+        return super(LazyPluginGroup, self).list_commands(ctx)
+
+
+def _config_stamp(cfg_root):
+    """ Name, mtime and size of every config file, which changes whenever
+    one is added, removed or edited """
+    stamp = []
+    for e in os.scandir(cfg_root):
+        if not e.name.startswith(".") or e.name == ".default_context":
+            st = e.stat()
+            stamp.append([e.name, st.st_mtime_ns, st.st_size])
+    return sorted(stamp)
+
+
+def _parse_config_dir(cfg_root):
+    import yaml
+    contexts = {}
+    default_context = None
+    for filename in os.scandir(cfg_root):
+        if filename.name == ".default_context":
+            with open(filename.path) as f:
+                default_context = f.read().strip()
+        if filename.name.startswith("."):  # Ignore "hidden" files
+            continue
+        try:
+            with open(filename.path) as f:
+                cfgs = yaml.safe_load(f)
+            assert isinstance(cfgs, dict)
+            for key, cfg in cfgs.items():
+                assert isinstance(cfg, dict)
+                contexts[key] = {"origin": filename.path, "config": cfg}
+        except Exception as e:
+            log.warning("Failed to parse config {}: {}".format(filename.path, e))
+            continue
+    return contexts, default_context
+
+
+def load_contexts(cfg_root):
+    """ Returns ({name: {"origin": path, "config": kwargs}}, default context)
+    for the config dir. The parsed result is cached in the dir and only
+    parsed again when a file in it changes. The cache holds the API keys,
+    so it is only readable by its owner. """
+    contexts = dict(BUILTIN_CONTEXTS)
+    if not os.path.isdir(cfg_root):
+        return contexts, None
+    cache_path = os.path.join(cfg_root, CONFIG_CACHE)
+    stamp = _config_stamp(cfg_root)
+    try:
+        with open(cache_path) as f:
+            # A cache others can read is replaced by a private one
+            if os.fstat(f.fileno()).st_mode & 0o077:
+                raise ValueError("cache readable by others")
+            cache = json.load(f)
+        if cache["version"] == CONFIG_CACHE_VERSION and cache["stamp"] == stamp:
+            contexts.update(cache["contexts"])
+            return contexts, cache["default_context"]
+    except Exception:
+        pass
+
+    parsed, default_context = _parse_config_dir(cfg_root)
+    tmp = "{}.{}.tmp".format(cache_path, os.getpid())
+    try:
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({"version": CONFIG_CACHE_VERSION, "stamp": stamp,
+                       "contexts": parsed, "default_context": default_context}, f)
+        os.rename(tmp, cache_path)
+    except Exception as e:
+        # eg YAML values JSON can't hold, the config is just parsed every time
+        log.debug("Not caching config dir {}: {}".format(cfg_root, e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    contexts.update(parsed)
+    return contexts, default_context
+
+
+def build_client(context, cache=None):
+    """ Creates the QtradeAPI for one context from load_contexts(). With a
+    cache dict, a client made earlier for the same configuration is reused. """
+    from ..api import QtradeAPI
+    if cache is None:
+        return QtradeAPI(origin=context["origin"], **context["config"])
+    key = json.dumps(context, sort_keys=True)
+    client = cache.get(key)
+    if client is None:
+        client = cache[key] = QtradeAPI(origin=context["origin"], **context["config"])
+    return client
+
+
+class ClientObj(dict):
+    """ ctx.obj of the CLI. `client` is created on first access, so commands
+    that don't talk to the API don't pay for importing and setting it up.
+    In the daemon, `clients` holds the warm clients to reuse. """
+
+    def __init__(self, context, metrics=False, **kwargs):
+        super(ClientObj, self).__init__(**kwargs)
+        self.context = context
+        self.metrics = metrics
+
+    def __missing__(self, key):
+        if key != 'client':
+            raise KeyError(key)
+        client = self['client'] = build_client(self.context, self.get('clients'))
+        if self.metrics:
+            from ..metrics import Metrics
+            client.metrics = Metrics()
+        return client
+
+
+@click.group(cls=LazyPluginGroup)
 @click.option('--context', '-c')
 @click.option('--verbose', '-v', default=False, show_default=True)
 @click.option('--config-dir', '-d', default="~/.qtctl", show_default=True)
+@click.option('--dump-metrics', type=click.File('w'), default=None,
+              help="Write per endpoint request metrics as JSON to this file ('-' for stdout) on exit")
 @click.pass_context
-def cli(ctx, verbose, config_dir, context):
+def cli(ctx, verbose, config_dir, context, dump_metrics):
     root = logging.getLogger()
+    qtrade_log = logging.getLogger("qtrade")
     level = "DEBUG" if verbose else "INFO"
-
     ch = logging.StreamHandler(sys.stdout)
     ch.setLevel(level)
-    logging.getLogger("qtrade").setLevel(level)
-
     formatter = logging.Formatter(
         '%(asctime)s [%(name)-15s] [%(levelname)-5s] %(message)s')
     ch.setFormatter(formatter)
+
+    # The daemon runs every command in its own process, with sys.stdout
+    # captured for the reply. While a command runs its log goes only into
+    # its output, and its level doesn't outlast it.
+    if (ctx.obj or {}).get('daemon'):
+        handlers, old_level = root.handlers[:], qtrade_log.level
+
+        def restore():
+            root.handlers[:] = handlers
+            qtrade_log.setLevel(old_level)
+        ctx.call_on_close(restore)
+        root.handlers[:] = []
+    qtrade_log.setLevel(level)
     root.addHandler(ch)
 
-    contexts = {"dev_root":
-                Qtrade('http://localhost:9898',
-                       key='1:1111111111111111111111111111111111111111111111111111111111111111',
-                       origin="builtin")}
-    default_context = "dev_root"
-    cfg_root = os.path.expanduser(config_dir)
-    for filename in os.scandir(cfg_root):
-        if filename.name == ".default_context":
-            default_context = open(filename.path).read().strip()
-        if filename.name.startswith("."):  # Ignore "hidden" files
-            continue
-        try:
-            cfgs = yaml.load(open(filename.path))
-            assert isinstance(cfgs, dict)
-            for key, cfg in cfgs.items():
-                contexts[key] = Qtrade(origin=filename.path, **cfg)
-        except Exception as e:
-            log.warn("Failed to parse config {}: {}".format(filename, e))
-            continue
+    contexts, default_context = load_contexts(os.path.expanduser(config_dir))
+    if default_context is None:
+        default_context = "dev_root"
 
     # Default to our context if it exists
     active_context = contexts.get(default_context)
@@ -74,19 +235,49 @@ def cli(ctx, verbose, config_dir, context):
 
     if active_context is None:
         log.fatal("Failed to set context to {}: only have {}"
-                  .format(context, contexts.keys()))
+                  .format(context, list(contexts.keys())))
         sys.exit(1)
 
+    cfg = active_context["config"]
     print("using profile '{}' from '{}' => {} @ {}"
           .format(bcolors.BOLD + context + bcolors.ENDC,
-                  bcolors.BOLD + active_context.origin + bcolors.ENDC,
-                  bcolors.OKGREEN + active_context.email + bcolors.ENDC,
-                  bcolors.OKBLUE + active_context.endpoint + bcolors.ENDC,
+                  bcolors.BOLD + active_context["origin"] + bcolors.ENDC,
+                  bcolors.OKGREEN + cfg.get("email", "Unk") + bcolors.ENDC,
+                  bcolors.OKBLUE + cfg.get("endpoint", "") + bcolors.ENDC,
                   ))
-    ctx.obj['client'] = active_context
+    obj = ClientObj(active_context, metrics=dump_metrics is not None, **(ctx.obj or {}))
+    obj['contexts'] = contexts
+    obj['context_name'] = context
+    ctx.obj = obj
+
+    if dump_metrics is not None:
+        def dump():
+            # Nothing to report if the command never used the client
+            if 'client' in obj:
+                json.dump(obj['client'].metrics.snapshot(), dump_metrics, indent=2, sort_keys=True)
+                dump_metrics.write("\n")
+        ctx.call_on_close(dump)
+
+
+@cli.command('contexts')
+@click.pass_obj
+def list_contexts(obj):
+    """ List the configured contexts """
+    for name, context in sorted(obj['contexts'].items()):
+        marker = "*" if name == obj['context_name'] else " "
+        click.echo("{} {:<20} {:<40} {}".format(
+            marker, name, context["config"].get("endpoint", ""), context["origin"]))
+
+
+cli.add_command(fanout)
+cli.add_command(daemon)
+cli.add_command(shell)
 
 
 def entry():
+    code = forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
     cli(obj={})
 
 
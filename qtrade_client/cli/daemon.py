@@ -0,0 +1,248 @@
+""" `qtapi daemon`: a long running process that executes qtapi commands sent
+over a Unix socket, keeping clients (and with them the HTTP connections,
+market data caches and rate limiter state) warm between commands. While it
+is running, `qtapi` forwards commands to it instead of starting from
+scratch. `qtapi shell` offers the same warm state interactively. """
+import json
+import logging
+import os
+import shlex
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+import click
+
+log = logging.getLogger("qtrade-cli")
+
+SOCKET_ENV = "QTAPI_DAEMON_SOCKET"
+DEFAULT_SOCKET = "~/.qtctl/.daemon.sock"
+# Seconds to wait for the daemon to answer a forwarded command, and a
+# management request
+TIMEOUT_ENV = "QTAPI_DAEMON_TIMEOUT"
+COMMAND_TIMEOUT = 300
+REQUEST_TIMEOUT = 5
+
+
+def socket_path():
+    return os.path.expanduser(os.environ.get(SOCKET_ENV) or DEFAULT_SOCKET)
+
+
+def run_locally(check=True):
+    """ Marks a command (or a group, for all of its commands) that must not
+    be forwarded to the daemon, eg because it reads stdin, which the daemon
+    doesn't have. `check` may instead be a function of the command's params
+    returning whether this invocation must run locally. """
+    def mark(cmd):
+        cmd.run_locally = check
+        return cmd
+    return mark
+
+
+def _parse(cmd, name, args, parent=None):
+    """ The context of cmd for args and the args left for its subcommand,
+    without invoking or validating anything """
+    settings = dict(cmd.context_settings, resilient_parsing=True)
+    ctx = cmd.context_class(cmd, info_name=name, parent=parent, **settings)
+    with ctx.scope(cleanup=False):
+        # Command.parse_args rather than that of a group, which keeps the
+        # name of the subcommand to itself
+        return ctx, click.Command.parse_args(cmd, ctx, list(args))
+
+
+def _runs_locally(argv):
+    """ Whether the command argv resolves to is marked with run_locally """
+    from . import cli
+    cmd, name, args, parent = cli, 'qtapi', argv, None
+    while cmd is not None:
+        try:
+            ctx, args = _parse(cmd, name, args, parent)
+        except click.ClickException:
+            # Left for the daemon to report
+            return False
+        check = getattr(cmd, 'run_locally', False)
+        if check is True or (callable(check) and check(ctx.params)):
+            return True
+        if not isinstance(cmd, click.Group) or not args:
+            return False
+        name, cmd, args = cmd.resolve_command(ctx, args)
+        parent = ctx
+    return False
+
+
+class Runner(object):
+    """ Runs qtapi commands in this process, sharing one client per context
+    across them. Commands run one at a time, since their output is captured
+    by swapping sys.stdout. """
+
+    def __init__(self):
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def run(self, argv, cwd=None):
+        """ Returns (exit code, output) """
+        from click.testing import CliRunner
+        from . import cli
+        with self._lock:
+            if cwd is not None:
+                os.chdir(cwd)
+            res = CliRunner().invoke(cli, argv, obj={'clients': self.clients, 'daemon': True})
+        output = res.output
+        if res.exception is not None and not isinstance(res.exception, SystemExit):
+            output += "".join(traceback.format_exception(*res.exc_info))
+        return res.exit_code, output
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            req = json.loads(self.rfile.readline().decode('utf8'))
+        except ValueError:
+            return
+        if req.get('op') == 'stop':
+            self._reply({'exit_code': 0, 'output': "daemon stopping\n"})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        if req.get('op') == 'status':
+            self._reply({'exit_code': 0, 'output': "daemon running, pid {}, {} warm clients\n".format(
+                os.getpid(), len(self.server.runner.clients))})
+            return
+        code, output = self.server.runner.run(req['argv'], req.get('cwd'))
+        self._reply({'exit_code': code, 'output': output})
+
+    def _reply(self, res):
+        self.wfile.write(json.dumps(res).encode('utf8') + b"\n")
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """ Serves one command at a time over a Unix socket only the current
+    user may connect to """
+
+    def __init__(self, path, runner=None):
+        self.path = path
+        self.runner = runner if runner is not None else Runner()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            if request(path, {'op': 'status'}, timeout=REQUEST_TIMEOUT) is not None:
+                raise click.ClickException("A daemon is already listening on {}".format(path))
+            os.remove(path)
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def request(path, req, timeout=REQUEST_TIMEOUT):
+    """ Sends one request to the daemon and returns its reply, or None if
+    no daemon is listening. Raises a ClickException if the daemon doesn't
+    answer within `timeout` seconds. """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(path)
+    except (OSError, socket.error):
+        s.close()
+        return None
+    try:
+        s.sendall(json.dumps(req).encode('utf8') + b"\n")
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.timeout:
+        # The request may be running, so it must not be run again locally
+        raise click.ClickException(
+            "The daemon on {} did not answer within {} seconds. Stop it with "
+            "`qtapi daemon stop`, or set QTAPI_NO_DAEMON=1 to run without it.".format(path, timeout))
+    finally:
+        s.close()
+    return json.loads(b"".join(chunks).decode('utf8'))
+
+
+def forward(argv):
+    """ Runs the command on the daemon if one is running. Returns its exit
+    code, or None to run the command locally. """
+    if os.environ.get("QTAPI_NO_DAEMON") or _runs_locally(argv):
+        return None
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    timeout = float(os.environ.get(TIMEOUT_ENV) or COMMAND_TIMEOUT)
+    try:
+        res = request(path, {'argv': argv, 'cwd': os.getcwd()}, timeout=timeout)
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    if res is None:
+        return None
+    sys.stdout.write(res['output'])
+    sys.stdout.flush()
+    return res['exit_code']
+
+
+@run_locally()
+@click.group('daemon')
+def daemon():
+    """ Run commands in a persistent process with warm clients """
+
+
+@daemon.command('start')
+@click.option('--socket', 'path', default=None, help="Defaults to $QTAPI_DAEMON_SOCKET or " + DEFAULT_SOCKET)
+def start(path):
+    """ Serve commands in the foreground until stopped """
+    path = os.path.expanduser(path) if path else socket_path()
+    server = DaemonServer(path)
+    click.echo("qtapi daemon listening on {}".format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@daemon.command('stop')
+def stop():
+    """ Stop the running daemon """
+    res = request(socket_path(), {'op': 'stop'})
+    click.echo(res['output'].strip() if res else "no daemon running")
+
+
+@daemon.command('status')
+def status():
+    res = request(socket_path(), {'op': 'status'})
+    click.echo(res['output'].strip() if res else "no daemon running")
+    if res is None:
+        raise SystemExit(1)
+
+
+@run_locally()
+@click.command('shell')
+def shell():
+    """ Interactive prompt running qtapi commands with warm clients """
+    runner = Runner()
+    while True:
+        try:
+            line = input("qtapi> ")
+        except EOFError:
+            break
+        argv = shlex.split(line)
+        if not argv:
+            continue
+        if argv[0] in ('exit', 'quit'):
+            break
+        code, output = runner.run(argv)
+        sys.stdout.write(output)
@@ -0,0 +1,124 @@
+""" `qtapi fanout`: run one operation against many contexts at once """
+import fnmatch
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+
+from .daemon import run_locally
+
+
+def select_contexts(contexts, patterns):
+    """ Names of the contexts matching any of the names or globs, which may
+    also be given comma separated, in sorted order """
+    wanted = [p.strip() for pattern in patterns for p in pattern.split(",") if p.strip()]
+    names = sorted(n for n in contexts if any(fnmatch.fnmatchcase(n, p) for p in wanted))
+    unmatched = [p for p in wanted if not fnmatch.filter(names, p)]
+    if unmatched:
+        raise click.BadParameter("no context matches {}".format(", ".join(unmatched)))
+    return names
+
+
+def _balances(client):
+    return dict((k, v) for k, v in client.balances_merged().items() if v)
+
+
+def _orders(client):
+    return client.orders(open=True)
+
+
+def _cancel_all(client):
+    return client.cancel_all_orders(bulk=True)
+
+
+OPERATIONS = {
+    'balances': _balances,
+    'orders': _orders,
+    'cancel-all': _cancel_all,
+}
+
+
+def fan_out(contexts, names, operation, workers=16, cache=None):
+    """ Runs operation(client) for every named context concurrently. Yields
+    (name, result, error) as they complete; exactly one of result and
+    error is None. Clients come from and stay in `cache` if given, see
+    build_client. """
+    from . import build_client
+
+    def run(name):
+        client = build_client(contexts[name], cache)
+        try:
+            return operation(client)
+        finally:
+            if cache is None:
+                client.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(names)))) as pool:
+        futures = dict((pool.submit(run, name), name) for name in names)
+        for f in as_completed(futures):
+            try:
+                yield futures[f], f.result(), None
+            except Exception as e:
+                yield futures[f], None, e
+
+
+def _rows(op, name, result):
+    if op == 'balances':
+        return [(name, currency, str(amount)) for currency, amount in sorted(result.items())]
+    if op == 'orders':
+        return [(name, o['id'], o['market_id'], o['order_type'], o['price'],
+                 o['market_amount_remaining']) for o in result]
+    return [(name, r['id'], r['result']) for r in result]
+
+
+HEADERS = {
+    'balances': ('context', 'currency', 'balance'),
+    'orders': ('context', 'id', 'market', 'type', 'price', 'remaining'),
+    'cancel-all': ('context', 'id', 'result'),
+}
+
+
+def _table(headers, rows):
+    rows = [tuple(str(c) for c in r) for r in rows]
+    widths = [max(len(r[i]) for r in [headers] + rows) for i in range(len(headers))]
+    fmt = "  ".join("{:<%d}" % w for w in widths)
+    lines = [fmt.format(*headers)]
+    lines.extend(fmt.format(*r) for r in rows)
+    return "\n".join(lines)
+
+
+@run_locally(lambda params: params.get('operation') == 'cancel-all' and not params.get('yes'))
+@click.command('fanout')
+@click.argument('operation', type=click.Choice(sorted(OPERATIONS)))
+@click.option('--select', '-s', 'patterns', multiple=True, required=True,
+              help="Context name or glob, repeatable or comma separated")
+@click.option('--json', 'as_json', is_flag=True, help="Print one JSON object per context as they finish")
+@click.option('--workers', default=16, show_default=True)
+@click.option('--yes', is_flag=True, help="Don't ask before cancel-all")
+@click.pass_obj
+def fanout(obj, operation, patterns, as_json, workers, yes):
+    """ Run OPERATION (balances, orders or cancel-all) on every selected
+    context concurrently and merge the results """
+    contexts = obj['contexts']
+    names = select_contexts(contexts, patterns)
+    if operation == 'cancel-all' and not yes:
+        click.confirm("Cancel all open orders of {}?".format(", ".join(names)), abort=True)
+
+    rows, errors = [], []
+    for name, result, error in fan_out(contexts, names, OPERATIONS[operation], workers=workers,
+                                       cache=obj.get('clients')):
+        if error is not None:
+            errors.append((name, error))
+        if as_json:
+            click.echo(json.dumps({'context': name, 'result': result,
+                                   'error': None if error is None else str(error)},
+                                  default=str, sort_keys=True))
+        elif error is None:
+            rows.extend(_rows(operation, name, result))
+    if not as_json:
+        rows.sort(key=lambda r: r[0])
+        click.echo(_table(HEADERS[operation], rows))
+        for name, error in sorted(errors, key=lambda e: e[0]):
+            click.echo("{}: failed: {}".format(name, error), err=True)
+    if errors:
+        raise SystemExit(1)
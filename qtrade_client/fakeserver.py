@@ -0,0 +1,342 @@
+""" A local stand-in for the qTrade API, for end to end tests and load
+benchmarks of the client without touching a real exchange.
+
+    server = FakeQtradeServer(keys={"1": "secret"}).start()
+    api = QtradeAPI(server.url, key="1:secret")
+    ...
+    server.stop()
+
+It serves /v1/common, /v1/tickers, order history and lookup, limit order
+placement, cancel_order and the balance endpoints with the response shapes of
+the real API. Every response carries X-Ratelimit-* headers from a fixed
+window limit per key, and once a key has spent its window requests are
+answered with 429. With `keys` set, /v1/user endpoints require a valid HMAC
+signature. Orders never fill. """
+import base64
+import hmac
+import json
+import re
+import threading
+import time
+from decimal import Decimal
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+PAGE_SIZE = 100
+COIN = Decimal('.00000001')
+
+_ORDER_PATH = re.compile(r"^/v1/user/order/(\d+)$")
+
+
+class _HTTPError(Exception):
+
+    def __init__(self, status, code):
+        super(_HTTPError, self).__init__(code)
+        self.status = status
+        self.code = code
+
+
+class FakeExchange(object):
+    """ The state behind FakeQtradeServer: markets, balances and the orders
+    placed. All methods are thread safe. """
+
+    def __init__(self, markets=("LTC_BTC", "BCH_BTC", "NYZO_BTC"), balances=None):
+        self._lock = threading.Lock()
+        currencies = set()
+        self.markets = []
+        for i, name in enumerate(markets, 1):
+            market, base = name.split("_")
+            currencies.update((market, base))
+            self.markets.append({
+                "id": i, "market_currency": market, "base_currency": base,
+                "maker_fee": "0.0025", "taker_fee": "0.0025", "metadata": {},
+                "can_trade": True, "can_cancel": True, "can_view": True,
+            })
+        self.currencies = [{"code": c, "long_name": c, "type": "bitcoin_like", "precision": 8,
+                            "status": "ok", "can_withdraw": True, "config": {}, "metadata": {}}
+                           for c in sorted(currencies)]
+        self.balances = dict((c, Decimal(1000)) for c in currencies)
+        self.balances.update(balances or {})
+        self.orders = {}
+        self._next_id = 1
+
+    def common(self):
+        return {"currencies": self.currencies, "markets": self.markets}
+
+    def tickers(self):
+        return {"markets": [{
+            "id": m["id"], "id_hr": "{market_currency}_{base_currency}".format(**m),
+            "ask": "0.01000000", "bid": "0.00900000", "last": "0.00950000",
+            "day_avg_price": "0.00950000", "day_change": "0", "day_high": "0.01000000",
+            "day_low": "0.00900000", "day_open": "0.00950000", "day_volume_base": "1.00000000",
+            "day_volume_market": "100.00000000"} for m in self.markets]}
+
+    def _market(self, market_id):
+        for m in self.markets:
+            if m["id"] == market_id:
+                return m
+        raise _HTTPError(400, "invalid_market")
+
+    def _held(self, order):
+        """ The currency and amount an open order reserves """
+        m = self._market(order["market_id"])
+        remaining = Decimal(order["market_amount_remaining"])
+        if order["order_type"] == "sell_limit":
+            return m["market_currency"], remaining
+        return m["base_currency"], (remaining * Decimal(order["price"])).quantize(COIN)
+
+    def order_balances(self):
+        held = {}
+        for o in self.orders.values():
+            if o["open"]:
+                currency, amount = self._held(o)
+                held[currency] = held.get(currency, 0) + amount
+        return held
+
+    def balances_all(self):
+        with self._lock:
+            held = self.order_balances()
+            return {
+                "balances": [{"currency": c, "balance": str(b - held.get(c, 0))}
+                             for c, b in sorted(self.balances.items())],
+                "order_balances": [{"currency": c, "balance": str(b)}
+                                   for c, b in sorted(held.items())],
+            }
+
+    def place(self, order_type, body):
+        try:
+            amount = Decimal(body["amount"])
+            price = Decimal(body["price"])
+            market_id = int(body["market_id"])
+        except Exception:
+            raise _HTTPError(400, "invalid_order")
+        if amount <= 0 or price <= 0:
+            raise _HTTPError(400, "invalid_order")
+        with self._lock:
+            order = {
+                "id": self._next_id, "market_amount": str(amount),
+                "market_amount_remaining": str(amount),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "price": str(price), "order_type": order_type, "market_id": market_id,
+                "open": True, "trades": [],
+            }
+            currency, needed = self._held(order)
+            if self.balances[currency] - self.order_balances().get(currency, 0) < needed:
+                raise _HTTPError(400, "insufficient_funds")
+            self.orders[order["id"]] = order
+            self._next_id += 1
+            return {"order": dict(order)}
+
+    def cancel(self, order_id):
+        with self._lock:
+            order = self.orders.get(order_id)
+            if order is None:
+                raise _HTTPError(404, "not_found")
+            if not order["open"]:
+                raise _HTTPError(400, "order_not_open")
+            order["open"] = False
+            order["close_reason"] = "canceled"
+            return {}
+
+    def order(self, order_id):
+        with self._lock:
+            if order_id not in self.orders:
+                raise _HTTPError(404, "not_found")
+            # Copies, since cancels modify orders while responses are encoded
+            return {"order": dict(self.orders[order_id])}
+
+    def list_orders(self, open=None, older_than=None, newer_than=None):
+        """ Newest first, a page at a time. newer_than returns the newest
+        page of the orders above the given id. """
+        with self._lock:
+            ids = sorted(self.orders, reverse=True)
+            if open is not None:
+                ids = [i for i in ids if self.orders[i]["open"] == open]
+            if older_than is not None:
+                ids = [i for i in ids if i < older_than][:PAGE_SIZE]
+            elif newer_than is not None:
+                ids = [i for i in ids if i > newer_than][:PAGE_SIZE]
+            else:
+                ids = ids[:PAGE_SIZE]
+            return {"orders": [dict(self.orders[i]) for i in ids]}
+
+
+class _RateLimit(object):
+    """ Fixed window request counter per key """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._windows = {}
+        self.served = 0
+        self.rejected = 0
+
+    def take(self, key):
+        """ Returns (allowed, remaining, seconds until the window resets) """
+        now = time.time()
+        with self._lock:
+            start, used = self._windows.get(key, (now, 0))
+            if now - start >= self.window:
+                start, used = now, 0
+            allowed = used < self.limit
+            if allowed:
+                used += 1
+                self.served += 1
+            else:
+                self.rejected += 1
+            self._windows[key] = (start, used)
+            return allowed, self.limit - used, max(0, int(start + self.window - now + 0.999))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API behind its load balancer
+    protocol_version = "HTTP/1.1"
+    # Don't let Nagle's algorithm and delayed ACKs add 40ms to responses
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        url = urlsplit(self.path)
+        headers = {}
+        try:
+            key_id = None
+            if url.path.startswith("/v1/user/"):
+                key_id = fake.authenticate(method, self.path, body, self.headers)
+            allowed, remaining, reset = fake.ratelimit.take(key_id or self.client_address[0])
+            headers = {"X-Ratelimit-Limit": str(fake.ratelimit.limit),
+                       "X-Ratelimit-Remaining": str(remaining),
+                       "X-Ratelimit-Reset": str(reset)}
+            if not allowed:
+                raise _HTTPError(429, "too_many_requests")
+            if fake.latency:
+                time.sleep(fake.latency)
+            query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+            data = fake.handle(method, url.path, query, json.loads(body.decode("utf8")) if body else {})
+            self._send(200, {"data": data}, headers)
+        except _HTTPError as e:
+            self._send(e.status, {"errors": [{"code": e.code, "title": e.code}]}, headers)
+        except Exception as e:
+            self._send(500, {"errors": [{"code": "internal_error", "title": str(e)}]}, headers)
+
+    def _send(self, status, payload, headers):
+        raw = json.dumps(payload).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(raw)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeQtradeServer(object):
+    """ Serves a FakeExchange over HTTP on a background thread.
+
+    keys maps HMAC key ids to keys; without keys requests aren't
+    authenticated. Each key (or client address for public endpoints) may make
+    `ratelimit` requests per `ratelimit_window` seconds. `latency` adds a
+    fixed delay to every accepted request. """
+
+    def __init__(self, host="127.0.0.1", port=0, keys=None, ratelimit=120, ratelimit_window=60,
+                 latency=0, exchange=None, max_clock_skew=30):
+        self.keys = dict(keys or {})
+        self.ratelimit = _RateLimit(ratelimit, ratelimit_window)
+        self.latency = latency
+        self.max_clock_skew = max_clock_skew
+        self.exchange = exchange if exchange is not None else FakeExchange()
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,),
+                                        name="fake-qtrade")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def authenticate(self, method, uri, body, headers):
+        """ Checks the HMAC headers of a request the way the API does and
+        returns the key id """
+        if not self.keys:
+            return None
+        auth = headers.get("Authorization") or ""
+        timestamp = headers.get("HMAC-Timestamp") or ""
+        if not auth.startswith("HMAC-SHA256 ") or ":" not in auth:
+            raise _HTTPError(401, "unauthorized")
+        key_id, signature = auth[len("HMAC-SHA256 "):].split(":", 1)
+        key = self.keys.get(key_id)
+        try:
+            skew = abs(time.time() - int(timestamp))
+        except ValueError:
+            raise _HTTPError(401, "unauthorized")
+        if key is None or skew > self.max_clock_skew:
+            raise _HTTPError(401, "unauthorized")
+        details = b"\n".join((method.encode("ascii"), uri.encode("utf8"), timestamp.encode("ascii"),
+                              body, key.encode("utf8")))
+        expected = base64.b64encode(sha256(details).digest()).decode("ascii")
+        if not hmac.compare_digest(expected, signature):
+            raise _HTTPError(401, "unauthorized")
+        return key_id
+
+    def handle(self, method, path, query, body):
+        ex = self.exchange
+        if method == "GET":
+            if path == "/v1/common":
+                return ex.common()
+            if path == "/v1/tickers":
+                return ex.tickers()
+            if path == "/v1/user/orders":
+                open = query.get("open")
+                return ex.list_orders(
+                    open=None if open is None else open == "true",
+                    older_than=int(query["older_than"]) if "older_than" in query else None,
+                    newer_than=int(query["newer_than"]) if "newer_than" in query else None)
+            if path == "/v1/user/balances_all":
+                return ex.balances_all()
+            if path == "/v1/user/balances":
+                return {"balances": ex.balances_all()["balances"]}
+            match = _ORDER_PATH.match(path)
+            if match:
+                return ex.order(int(match.group(1)))
+        elif method == "POST":
+            if path in ("/v1/user/buy_limit", "/v1/user/sell_limit"):
+                return ex.place(path.rsplit("/", 1)[1], body)
+            if path == "/v1/user/cancel_order":
+                return ex.cancel(body.get("id"))
+        raise _HTTPError(404, "not_found")
@@ -0,0 +1,63 @@
+""" Fixed point helpers representing amounts as int multiples of COIN (1e-8).
+Rounding is half to even, like Decimal.quantize(COIN) in the default
+context. """
+from decimal import Decimal
+
+COIN_SATS = 10 ** 8
+_PLACES = 8
+
+
+def div_round(n, d):
+    """ n / d rounded half to even, for int n and positive int d """
+    q, r = divmod(n, d)
+    r2 = 2 * r
+    if r2 > d or (r2 == d and q & 1):
+        q += 1
+    return q
+
+
+def to_sats(value):
+    """ Converts a value to an int number of 1e-8 units. ints are taken to
+    be in 1e-8 units already, strings are parsed without going through
+    Decimal. """
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        return _parse(value)
+    if isinstance(value, float):
+        # Match Decimal(value).quantize(COIN), which uses the exact binary
+        # value of the float rather than its repr
+        value = Decimal(value)
+    if isinstance(value, Decimal):
+        sign, digits, exp = value.quantize(Decimal(1).scaleb(-_PLACES)).as_tuple()
+        n = int(''.join(map(str, digits))) * 10 ** (exp + _PLACES)
+        return -n if sign else n
+    raise TypeError("Can't convert {!r} to sats".format(value))
+
+
+def _parse(s):
+    s = s.strip()
+    if 'e' in s or 'E' in s:
+        return to_sats(Decimal(s))
+    neg = s.startswith('-')
+    if neg or s.startswith('+'):
+        s = s[1:]
+    whole, _, frac = s.partition('.')
+    if not (whole or frac) or not (whole + frac).isdigit():
+        raise ValueError("Invalid amount {!r}".format(s))
+    n = int(whole or '0') * COIN_SATS + int(frac[:_PLACES].ljust(_PLACES, '0'))
+    rest = frac[_PLACES:].rstrip('0')
+    if rest:
+        # Digits of equal length compare like the numbers they spell
+        half = '5'.ljust(len(rest), '0')
+        if rest > half or (rest == half and n & 1):
+            n += 1
+    return -n if neg else n
+
+
+def from_sats(n):
+    """ Formats an int number of 1e-8 units like str() of a quantized
+    Decimal, eg 500000 -> '0.00500000' """
+    sign = '-' if n < 0 else ''
+    whole, frac = divmod(abs(n), COIN_SATS)
+    return "{}{}.{:08d}".format(sign, whole, frac)
@@ -0,0 +1,169 @@
+""" Per endpoint request instrumentation. Assign a Metrics to a client's
+`metrics` attribute to enable it; with the default of None the client does
+no timing work at all. """
+import bisect
+import re
+import threading
+import time
+from collections import deque
+
+# Upper bounds in seconds of the histogram buckets, the last bucket is open
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PHASES = ('queue', 'ratelimit', 'network', 'decode')
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_template(endpoint):
+    """ Replaces numeric path segments with {id}, so that eg
+    /v1/user/order/123 and /v1/user/order/456 are counted together """
+    return _ID_SEGMENT.sub("/{id}", endpoint)
+
+
+class Histogram(object):
+    """ Fixed bucket histogram of durations in seconds """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile, or the largest
+        value seen for the open bucket """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': self.counts[:],
+        }
+
+
+class EndpointStats(object):
+    """ What Metrics keeps for one endpoint template """
+
+    __slots__ = ('calls', 'status', 'retries', 'circuit_open', 'errors') + PHASES
+
+    def __init__(self):
+        self.calls = 0
+        self.status = {}
+        # Retries by what caused them, a status code or 'connection'
+        self.retries = {}
+        self.circuit_open = 0
+        self.errors = 0
+        for phase in PHASES:
+            setattr(self, phase, Histogram())
+
+    def snapshot(self):
+        snap = {'calls': self.calls, 'status': dict(self.status), 'retries': dict(self.retries),
+                'retries_429': self.retries.get('429', 0), 'circuit_open': self.circuit_open,
+                'errors': self.errors}
+        for phase in PHASES:
+            snap[phase] = getattr(self, phase).snapshot()
+        return snap
+
+
+class Metrics(object):
+    """ Collects request measurements by endpoint template and passes every
+    sample on to the registered hooks.
+
+    A sample is a dict with the method, endpoint (the template), status
+    (None if no response was received), attempt (1 for the first try of a
+    request, 2 for its first retry and so on), retry (attempt > 1), and the
+    seconds spent in each phase: queue (taking a rate limit token),
+    ratelimit (sleeping for the rate limit), network (sending the request
+    and receiving the response) and decode (parsing the JSON body). After
+    each response the rate limit state is sampled into `rl_remaining`, a
+    bounded series of (timestamp, remaining) pairs.
+
+    Retries are also counted by cause, and requests refused by an open
+    circuit breaker (see qtrade_client.retry) by endpoint. """
+
+    def __init__(self, history=1000):
+        self._lock = threading.Lock()
+        self._history = history
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self.rl_remaining = deque(maxlen=self._history)
+            self.started_at = time.time()
+
+    def add_hook(self, hook):
+        """ hook(sample) is called for every request, in the requesting
+        thread. It must be quick and must not raise. """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _stats(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    def record(self, sample):
+        with self._lock:
+            stats = self._stats(sample['endpoint'])
+            stats.calls += 1
+            status = sample['status']
+            if status is None:
+                stats.errors += 1
+            else:
+                stats.status[status] = stats.status.get(status, 0) + 1
+            for phase in PHASES:
+                value = sample[phase]
+                if value is not None:
+                    getattr(stats, phase).observe(value)
+        for hook in self.hooks:
+            hook(sample)
+
+    def record_retry(self, endpoint, cause):
+        with self._lock:
+            retries = self._stats(endpoint).retries
+            retries[cause] = retries.get(cause, 0) + 1
+
+    def record_circuit_open(self, endpoint):
+        with self._lock:
+            self._stats(endpoint).circuit_open += 1
+
+    def record_ratelimit(self, remaining):
+        with self._lock:
+            self.rl_remaining.append((time.time(), remaining))
+
+    def snapshot(self):
+        """ Everything collected so far as plain, JSON serializable data """
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'buckets': list(BUCKETS),
+                'endpoints': dict((k, v.snapshot()) for k, v in self.endpoints.items()),
+                'rl_remaining': list(self.rl_remaining),
+            }
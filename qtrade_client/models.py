@@ -0,0 +1,194 @@
+from decimal import Decimal
+from fractions import Fraction
+
+from .fixedpoint import to_sats
+
+
+def _decimal(value):
+    return None if value is None else Decimal(value)
+
+
+class Model(object):
+    """ Compact, slotted representation of an API object. Fields are parsed
+    once when the object is built and read as attributes. For compatibility
+    with code written against the raw JSON dicts, they can also be read by
+    key, which returns the values as the API sent them, and a model equals
+    the dict it was built from. Fields the model doesn't know about are kept
+    in `extra`, the API values of the fields in `_parsers` in `raw`. Fields
+    missing from the API object read as None but are not keys. """
+
+    __slots__ = ('extra', 'raw')
+    _fields = ()
+    # field: function parsing its API value
+    _parsers = {}
+
+    def __init__(self, **fields):
+        extra, raw = {}, {}
+        for k, v in fields.items():
+            if k in self._fields:
+                if k in self._parsers:
+                    raw[k] = v
+                    v = self._parsers[k](v)
+                setattr(self, k, v)
+            else:
+                extra[k] = v
+        self.extra = extra
+        self.raw = raw
+
+    def __getattr__(self, name):
+        # Only called for unset slots
+        if name in self._fields:
+            return None
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        # Unset fields must stay unset, rather than come back as None
+        slots = [k for cls in type(self).__mro__ for k in getattr(cls, '__slots__', ())]
+        return dict((k, getattr(self, k)) for k in slots if self._has(k))
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def _has(self, key):
+        try:
+            object.__getattribute__(self, key)
+        except AttributeError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        if key in self.raw:
+            return self.raw[key]
+        if key in self._fields:
+            if not self._has(key):
+                raise KeyError(key)
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            if key in self._parsers:
+                self.raw[key] = value
+                value = self._parsers[key](value)
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return (key in self._fields and self._has(key)) or key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [k for k in self._fields if self._has(k)] + list(self.extra)
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def _api_dict(self):
+        """ The API object the model was built from """
+        return self.to_dict()
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return self._api_dict() == other or self.to_dict() == other
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, self._label())
+
+    def _label(self):
+        return ""
+
+
+class Currency(Model):
+
+    _fields = ('code', 'long_name', 'type', 'status', 'precision', 'can_withdraw', 'config', 'metadata')
+    __slots__ = _fields
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+    def _label(self):
+        return self.code
+
+
+class Market(Model):
+    """ A market, with its base and market currencies resolved to Currency
+    objects and the fees parsed to Decimal attributes. `fee_mult` is one
+    plus the larger of the two fees, as used when converting an order value
+    to an amount, and `fee_ratio` the same as an exact (numerator,
+    denominator) pair of ints for fixed point math. """
+
+    _fields = ('id', 'string', 'market_currency', 'base_currency', 'maker_fee', 'taker_fee',
+               'can_trade', 'can_cancel', 'can_view', 'metadata')
+    __slots__ = _fields + ('fee_mult', 'fee_ratio')
+    _parsers = {'maker_fee': _decimal, 'taker_fee': _decimal}
+
+    @classmethod
+    def from_json(cls, data, currencies):
+        data = dict(data)
+        for k in ('market_currency', 'base_currency'):
+            data[k] = currencies[data[k]]
+        data['string'] = "{}_{}".format(data['market_currency'].code, data['base_currency'].code)
+        m = cls(**data)
+        m.fee_mult = max(m.taker_fee, m.maker_fee) + 1
+        ratio = Fraction(m.fee_mult)
+        m.fee_ratio = (ratio.numerator, ratio.denominator)
+        return m
+
+    def _api_dict(self):
+        data = self.to_dict()
+        del data['string']
+        for k in ('market_currency', 'base_currency'):
+            data[k] = data[k].code
+        return data
+
+    def _label(self):
+        return self.string
+
+
+class Ticker(Model):
+    """ A market ticker with prices and volumes parsed to Decimal attributes.
+    Prices are None for markets that haven't traded. `ask_sats` and
+    `bid_sats` hold the ask and bid as ints of 1e-8 units for fixed point
+    math. """
+
+    _prices = ('ask', 'bid', 'last', 'day_avg_price', 'day_change', 'day_high', 'day_low',
+               'day_open', 'day_volume_base', 'day_volume_market')
+    _fields = ('id', 'id_hr') + _prices
+    __slots__ = _fields + ('ask_sats', 'bid_sats')
+    _parsers = dict((k, _decimal) for k in _prices)
+
+    @classmethod
+    def from_json(cls, data):
+        t = cls(**data)
+        ask, bid = data.get('ask'), data.get('bid')
+        t.ask_sats = None if ask is None else to_sats(ask)
+        t.bid_sats = None if bid is None else to_sats(bid)
+        return t
+
+    def __setitem__(self, key, value):
+        super(Ticker, self).__setitem__(key, value)
+        if key in ('ask', 'bid'):
+            setattr(self, key + '_sats', None if value is None else to_sats(value))
+
+    def _label(self):
+        return self.id_hr
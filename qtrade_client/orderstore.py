@@ -0,0 +1,199 @@
+""" Local SQLite copy of a user's order history, kept current incrementally
+so that reconciliation queries don't page through the API. """
+import calendar
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    market_id INTEGER,
+    open INTEGER NOT NULL,
+    created_at REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_open_market ON orders (open, market_id);
+CREATE INDEX IF NOT EXISTS orders_market ON orders (market_id);
+CREATE TABLE IF NOT EXISTS fills (
+    id INTEGER PRIMARY KEY,
+    order_id INTEGER NOT NULL,
+    market_id INTEGER,
+    created_at REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fills_created ON fills (created_at);
+CREATE INDEX IF NOT EXISTS fills_order ON fills (order_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def _timestamp(value):
+    """ Parses the API's ISO 8601 UTC timestamps to epoch seconds """
+    if value is None:
+        return None
+    value = value.rstrip('Z')
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if '.' in value else "%Y-%m-%dT%H:%M:%S"
+    dt = datetime.strptime(value, fmt)
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class OrderStore(object):
+    """ Persistent store of the orders of one account, indexed by order id,
+    market and open status, with the trades of each order kept as fills.
+
+    sync() brings the store up to date: orders newer than the newest one
+    stored are fetched with `newer_than`, walking down with `older_than`
+    from a full page in case it holds the newest orders rather than those
+    just above, then only orders still open locally are refreshed. The first sync backfills the history newest first and
+    records how far it got, so an interrupted backfill is resumed by the next
+    sync. Queries are answered from the local database. """
+
+    # Orders written per transaction while backfilling
+    backfill_chunk = 500
+    # Length of a full page of /v1/user/orders
+    page_size = 100
+
+    def __init__(self, path, api):
+        self.path = path
+        self.api = api
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _meta(self, key):
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def _store(self, orders, meta=None):
+        """ Writes orders and their fills, and the `meta` dict if given, in
+        one transaction """
+        rows, fills = [], []
+        for o in orders:
+            created = _timestamp(o.get('created_at'))
+            rows.append((o['id'], o.get('market_id'), int(bool(o.get('open'))), created,
+                         json.dumps(o)))
+            for t in o.get('trades') or ():
+                fills.append((t['id'], o['id'], o.get('market_id'),
+                              _timestamp(t.get('created_at')), json.dumps(t)))
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.executemany("INSERT OR REPLACE INTO fills VALUES (?, ?, ?, ?, ?)", fills)
+            if meta:
+                self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+        return len(rows)
+
+    def newest_id(self):
+        return self._query("SELECT max(id) FROM orders")[0][0]
+
+    def backfill_complete(self):
+        """ Whether the whole order history has been fetched """
+        return bool(self._meta('backfill_complete'))
+
+    def _backfill(self):
+        """ Fetches the history older than the oldest order reached so far,
+        recording progress with every chunk written """
+        written = 0
+        # Stores from before progress was recorded resume below their oldest order
+        oldest = self._meta('backfill_oldest') or self._query("SELECT min(id) FROM orders")[0][0]
+        page = []
+        for o in self.api.iter_orders(older_than=oldest):
+            page.append(o)
+            if len(page) >= self.backfill_chunk:
+                written += self._store(page, {'backfill_oldest': min(o['id'] for o in page)})
+                page = []
+        meta = {'backfill_complete': 1}
+        if page:
+            meta['backfill_oldest'] = min(o['id'] for o in page)
+        return written + self._store(page, meta)
+
+    def _fill_gap(self, below, newest):
+        """ Fetches the orders between the stored `newest` and `below`,
+        walking down the history """
+        written = 0
+        page = []
+        for o in self.api.iter_orders(older_than=below, prefetch=False):
+            if o['id'] <= newest:
+                break
+            page.append(o)
+            if len(page) >= self.backfill_chunk:
+                written += self._store(page)
+                page = []
+        return written + self._store(page)
+
+    def sync(self):
+        """ Fetches new orders, completes the backfill if needed and
+        refreshes the orders open locally. Returns the number of orders
+        written. """
+        written = 0
+        newest = self.newest_id()
+        if newest is not None:
+            while True:
+                page = self.api.orders(newer_than=newest)
+                if not page:
+                    break
+                written += self._store(page)
+                ids = [o['id'] for o in page]
+                if len(page) < self.page_size or max(ids) <= newest:
+                    break
+                written += self._fill_gap(min(ids), newest)
+                newest = max(ids)
+        if not self.backfill_complete():
+            written += self._backfill()
+
+        # Orders the API still lists as open are current, the rest of the
+        # locally open ones have closed since and are fetched one by one
+        local_open = set(r[0] for r in self._query("SELECT id FROM orders WHERE open = 1"))
+        still_open = list(self.api.iter_orders(open=True))
+        written += self._store(o for o in still_open if o['id'] in local_open)
+        closed = local_open - set(o['id'] for o in still_open)
+        written += self._store(self.api.get("/v1/user/order/{}".format(order_id))['order']
+                               for order_id in sorted(closed))
+        return written
+
+    def order(self, order_id):
+        rows = self._query("SELECT data FROM orders WHERE id = ?", (order_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def open_orders(self, market_id=None):
+        """ Open orders, newest first, optionally on one market only """
+        if market_id is None:
+            rows = self._query("SELECT data FROM orders WHERE open = 1 ORDER BY id DESC")
+        else:
+            rows = self._query("SELECT data FROM orders WHERE open = 1 AND market_id = ? "
+                               "ORDER BY id DESC", (market_id,))
+        return [json.loads(r[0]) for r in rows]
+
+    def fills_since(self, since, market_id=None):
+        """ Trades executed at or after the epoch timestamp `since`, oldest
+        first, with the order_id and market_id of their order added """
+        sql = "SELECT order_id, market_id, data FROM fills WHERE created_at >= ?"
+        args = [since]
+        if market_id is not None:
+            sql += " AND market_id = ?"
+            args.append(market_id)
+        fills = []
+        for r in self._query(sql + " ORDER BY created_at, id", args):
+            fill = json.loads(r['data'])
+            fill['order_id'] = r['order_id']
+            fill['market_id'] = r['market_id']
+            fills.append(fill)
+        return fills
+
+    def recent_fills(self, seconds, market_id=None):
+        """ Trades of the last `seconds` seconds """
+        return self.fills_since(time.time() - seconds, market_id=market_id)
@@ -0,0 +1,281 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger("qtrade")
+
+
+# Request priorities. Urgent requests (cancels, order placement) may spend
+# the whole budget, normal ones leave `urgent_reserve` of it and low priority
+# ones (market data, history) only use the share below `soft_threshold`.
+URGENT = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {URGENT: 'urgent', NORMAL: 'normal', LOW: 'low'}
+
+
+class RateLimitExceeded(Exception):
+    """ Raised instead of waiting when a low priority request is dropped """
+
+
+class RateLimiter(object):
+    """ Token bucket tracking the backend's rate limit for one API key.
+
+    The bucket holds `remaining` requests until `reset_at`, when it refills
+    to `limit`. Every request takes a token up front via reserve(), and every
+    response corrects the estimate from its X-Ratelimit-* headers via
+    update(), less the requests of this process still in flight, which the
+    backend may not have counted yet. A request that took a token but got no
+    response must release() it. This implementation keeps its state in
+    process memory, see SharedRateLimiter for one that several processes can
+    share.
+
+    Requests that may not spend the budget left for their priority are
+    deferred until the reset without taking a token, so they never hold up
+    more urgent requests. After waiting they go through the same check
+    again, and wait on if the requests deferred with them used up the new
+    window. With drop_low=True low priority requests raise RateLimitExceeded
+    instead of waiting. """
+
+    def __init__(self, limit=120, remaining=99, reset_at=None, soft_threshold=0.5,
+                 urgent_reserve=0.1, drop_low=False):
+        self._lock = threading.Lock()
+        # Fraction of the limit low priority requests may use. Set to 1 to
+        # let them burst through the whole budget, 0 to always defer them.
+        self.soft_threshold = soft_threshold
+        # Fraction of the limit kept for urgent requests only
+        self.urgent_reserve = urgent_reserve
+        self.drop_low = drop_low
+        # Length of the backend's window, the longest X-Ratelimit-Reset seen.
+        # A bucket refilled locally lasts this long.
+        self._window = 0
+        # Requests of this process that took a token and await a response
+        self._inflight = 0
+        self._stats = dict((p, {'calls': 0, 'waiting': 0, 'waits': 0, 'wait_total': 0.0,
+                                'wait_max': 0.0, 'dropped': 0})
+                           for p in PRIORITY_NAMES)
+        self._init_state(remaining, time.time() if reset_at is None else reset_at, limit)
+
+    def _init_state(self, remaining, reset_at, limit):
+        self._state = (remaining, reset_at, limit)
+
+    # State storage, overridden by backends. Only called with the lock held.
+    def _load(self):
+        return self._state
+
+    def _store(self, remaining, reset_at, limit):
+        self._state = (remaining, reset_at, limit)
+
+    def _acquire(self):
+        self._lock.acquire()
+
+    def _release(self):
+        self._lock.release()
+
+    def _get(self, idx):
+        self._acquire()
+        try:
+            return self._load()[idx]
+        finally:
+            self._release()
+
+    def _set(self, idx, value):
+        self._acquire()
+        try:
+            state = list(self._load())
+            state[idx] = value
+            self._store(*state)
+        finally:
+            self._release()
+
+    remaining = property(lambda self: self._get(0), lambda self, v: self._set(0, v))
+    reset_at = property(lambda self: self._get(1), lambda self, v: self._set(1, v))
+    limit = property(lambda self: self._get(2), lambda self, v: self._set(2, v))
+
+    def _floor(self, priority, limit):
+        """ How many tokens must be left in the bucket for a request of the
+        given priority to take one """
+        if priority == URGENT:
+            return 0
+        elif priority == LOW:
+            return max(0, int(limit * (1 - self.soft_threshold)))
+        return int(limit * self.urgent_reserve)
+
+    def _take(self, priority, waited=False):
+        """ Takes a token if the priority may have one and returns None,
+        otherwise returns the seconds until the reset. Only called with the
+        lock held. """
+        remaining, reset_at, limit = self._load()
+        now = time.time()
+        # The window has passed, so the backend's budget is full again until
+        # the end of the next one
+        if now >= reset_at and remaining < limit - self._inflight:
+            remaining, reset_at = limit - self._inflight, now + self._window
+            self._store(remaining, reset_at, limit)
+        floor = self._floor(priority, limit)
+        if waited:
+            # A request that waited may take the first token of a window even
+            # if its priority gets no share of the budget (soft_threshold 0)
+            floor = min(floor, limit - 1)
+        # Before the first response tells the window there is nothing to
+        # wait for
+        if remaining > floor or now >= reset_at:
+            self._store(remaining - 1, reset_at, limit)
+            self._inflight += 1
+            return None
+        return reset_at - now
+
+    def _count_wait(self, priority, must_wait):
+        if must_wait >= 5:
+            log.info("Ratelimit hit for %s request, sleeping for %s",
+                     PRIORITY_NAMES[priority], must_wait)
+        stats = self._stats[priority]
+        stats['waits'] += 1
+        stats['wait_total'] += must_wait
+        stats['wait_max'] = max(stats['wait_max'], must_wait)
+
+    def reserve(self, priority=NORMAL):
+        """ Takes one request from the bucket and returns 0, or returns how
+        many seconds the caller must wait first. A caller told to wait must
+        call consume() once it has waited. """
+        self._acquire()
+        try:
+            stats = self._stats[priority]
+            stats['calls'] += 1
+            must_wait = self._take(priority)
+            if must_wait is None:
+                return 0
+            if priority == LOW and self.drop_low:
+                stats['dropped'] += 1
+                raise RateLimitExceeded(
+                    "Low priority request dropped, {} requests left".format(self._load()[0]))
+            stats['waiting'] += 1
+            self._count_wait(priority, must_wait)
+            return must_wait
+        finally:
+            self._release()
+
+    def consume(self, priority=NORMAL):
+        """ Takes the token of a request that waited after reserve() and
+        returns 0, or returns how many more seconds it must wait if the
+        bucket is still empty, eg because the requests that waited for the
+        same reset used it up. consume() again after that wait. """
+        self._acquire()
+        try:
+            must_wait = self._take(priority, waited=True)
+            if must_wait is None:
+                self._stats[priority]['waiting'] -= 1
+                return 0
+            self._count_wait(priority, must_wait)
+            return must_wait
+        finally:
+            self._release()
+
+    def cancel(self, priority=NORMAL):
+        """ Gives up a reservation told to wait, instead of consume() """
+        with self._lock:
+            self._stats[priority]['waiting'] -= 1
+
+    def release(self):
+        """ Gives back the token of a request that ended without a
+        response, eg on a connection error """
+        with self._lock:
+            self._inflight = max(0, self._inflight - 1)
+
+    def stats(self):
+        """ Per priority counters: calls, waiting (current queue depth),
+        waits, wait_total and wait_max (seconds) and dropped. Counters are
+        kept per process, also for SharedRateLimiter. """
+        self._lock.acquire()
+        try:
+            return dict((PRIORITY_NAMES[p], dict(s)) for p, s in self._stats.items())
+        finally:
+            self._lock.release()
+
+    def update(self, headers):
+        """ Learn the rate limit state from the headers of the response to
+        a request that took a token """
+        now = time.time()
+        reset = int(headers.get('X-Ratelimit-Reset', 0))
+        reset_at = now + reset
+        limit = int(headers.get('X-Ratelimit-Limit', 100))
+        remaining = int(headers.get('X-Ratelimit-Remaining', 99))
+        self._acquire()
+        try:
+            self._window = max(self._window, reset)
+            self._inflight = max(0, self._inflight - 1)
+            remaining -= self._inflight
+            known, known_reset_at = self._load()[:2]
+            # Responses arrive out of order, so one from the current window
+            # (give or take the second X-Ratelimit-Reset is rounded to) may
+            # be older than the estimate and can only lower it
+            if known_reset_at > now and reset_at <= known_reset_at + 1:
+                remaining = min(remaining, known)
+                reset_at = max(reset_at, known_reset_at)
+            self._store(remaining, reset_at, limit)
+        finally:
+            self._release()
+
+
+class SharedRateLimiter(RateLimiter):
+    """ RateLimiter whose bucket lives in a small memory mapped file, so that
+    every process on the host using the same path (and so the same API key)
+    draws from one budget. Access is serialized with flock, which makes this
+    backend Unix only. """
+
+    _format = struct.Struct("<qdq")
+
+    def __init__(self, path, limit=120, remaining=99, reset_at=None, **kwargs):
+        if fcntl is None:
+            raise RuntimeError("SharedRateLimiter requires fcntl (Unix only)")
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        super(SharedRateLimiter, self).__init__(
+            limit=limit, remaining=remaining, reset_at=reset_at, **kwargs)
+
+    def _init_state(self, remaining, reset_at, limit):
+        self._acquire()
+        try:
+            # The first process to open the file sizes and seeds it, the
+            # rest adopt whatever state is already there
+            fresh = os.fstat(self._fd).st_size < self._format.size
+            if fresh:
+                os.ftruncate(self._fd, self._format.size)
+            self._mm = mmap.mmap(self._fd, self._format.size)
+            if fresh:
+                self._store(remaining, reset_at, limit)
+        finally:
+            self._release()
+
+    def _load(self):
+        return self._format.unpack_from(self._mm, 0)
+
+    def _store(self, remaining, reset_at, limit):
+        self._format.pack_into(self._mm, 0, int(remaining), float(reset_at), int(limit))
+
+    def _acquire(self):
+        # flock only excludes other open files, so threads of this process
+        # are serialized by the regular lock first
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._lock.release()
+            raise
+
+    def _release(self):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
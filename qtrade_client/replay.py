@@ -0,0 +1,209 @@
+""" Record and replay of HTTP traffic at the transport level, for offline
+profiling and performance regression tests of the client.
+
+RecordingAdapter saves every request/response pair a QtradeAPI makes, with
+its rate limit headers and timing, to a gzipped JSON lines file. Auth headers
+are not recorded. ReplayAdapter answers requests from such a file without
+any network, optionally with the recorded latencies, and replay_load() re-issues
+the recorded requests through a client at their recorded pace, reproducing
+a production load pattern against its caching, rate limiting and decoding. """
+import base64
+import gzip
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+from urllib.parse import parse_qsl, urlsplit
+
+FORMAT_VERSION = 1
+
+
+def _path_qs(url):
+    parts = urlsplit(url)
+    return parts.path + ("?" + parts.query if parts.query else "")
+
+
+def _encode(data):
+    """ Bytes as a JSON friendly (text, is_base64) pair """
+    if data is None:
+        return None, False
+    if not isinstance(data, bytes):
+        return data, False
+    try:
+        return data.decode('utf8'), False
+    except UnicodeDecodeError:
+        return base64.b64encode(data).decode('ascii'), True
+
+
+def _decode(text, b64):
+    if text is None:
+        return None
+    return base64.b64decode(text) if b64 else text.encode('utf8')
+
+
+class RecordingAdapter(requests.adapters.BaseAdapter):
+    """ Passes requests on to the adapter it wraps and appends each exchange
+    to `path`. Use mount() to install it on a client. """
+
+    def __init__(self, path, adapter=None):
+        super(RecordingAdapter, self).__init__()
+        self.path = path
+        self.adapter = adapter
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._file = gzip.open(path, 'wt')
+        self._write({'version': FORMAT_VERSION, 'recorded_at': self._started})
+
+    def mount(self, api):
+        """ Installs this adapter on the client, wrapping its current one """
+        if self.adapter is None:
+            self.adapter = api.rs.get_adapter(api.endpoint)
+        api.rs.mount('https://', self)
+        api.rs.mount('http://', self)
+        return self
+
+    def _write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, separators=(',', ':')))
+            self._file.write("\n")
+
+    def send(self, request, **kwargs):
+        sent = time.time()
+        res = self.adapter.send(request, **kwargs)
+        # Reads the whole body, also of streaming responses
+        content, content_b64 = _encode(res.content)
+        body, body_b64 = _encode(request.body)
+        self._write({
+            't': sent - self._started,
+            'elapsed': time.time() - sent,
+            'method': request.method,
+            'url': _path_qs(request.url),
+            'body': body, 'body_b64': body_b64,
+            'status': res.status_code,
+            'reason': res.reason,
+            'headers': dict(res.headers),
+            'content': content, 'content_b64': content_b64,
+        })
+        return res
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+        if self.adapter is not None:
+            self.adapter.close()
+
+
+def load(path):
+    """ Returns the header and the entries of a recording """
+    with gzip.open(path, 'rt') as f:
+        lines = [json.loads(ln) for ln in f if ln.strip()]
+    if not lines or lines[0].get('version') != FORMAT_VERSION:
+        raise ValueError("{} is not a version {} recording".format(path, FORMAT_VERSION))
+    return lines[0], lines[1:]
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """ Answers requests from a recording. A request gets the next unused
+    response recorded for the same method, path, query and body, or failing
+    that for the same method and path. Requests without a recorded response
+    raise ConnectionError.
+
+    Each response is delayed by its recorded latency divided by `speed`;
+    speed=None answers immediately. """
+
+    def __init__(self, path, speed=1.0):
+        super(ReplayAdapter, self).__init__()
+        self.path = path
+        self.speed = speed
+        self.header, self.entries = load(path)
+        self._lock = threading.Lock()
+        self._exact = {}
+        self._loose = {}
+        for e in self.entries:
+            self._exact.setdefault((e['method'], e['url'], e['body']), deque()).append(e)
+            self._loose.setdefault((e['method'], e['url'].split('?')[0]), deque()).append(e)
+        self._used = set()
+        self.misses = 0
+
+    def mount(self, api):
+        api.rs.mount('https://', self)
+        api.rs.mount('http://', self)
+        return self
+
+    def _take(self, queue):
+        while queue:
+            e = queue.popleft()
+            if id(e) not in self._used:
+                self._used.add(id(e))
+                return e
+        return None
+
+    def send(self, request, **kwargs):
+        url = _path_qs(request.url)
+        body, _ = _encode(request.body)
+        with self._lock:
+            entry = self._take(self._exact.get((request.method, url, body), deque()))
+            if entry is None:
+                entry = self._take(self._loose.get((request.method, url.split('?')[0]), deque()))
+            if entry is None:
+                self.misses += 1
+        if entry is None:
+            raise requests.exceptions.ConnectionError(
+                "No recorded response for {} {}".format(request.method, url), request=request)
+        if self.speed:
+            time.sleep(entry['elapsed'] / self.speed)
+
+        res = requests.Response()
+        res.status_code = entry['status']
+        res.reason = entry.get('reason')
+        res.headers = CaseInsensitiveDict(entry['headers'])
+        res._content = _decode(entry['content'], entry['content_b64']) or b""
+        res._content_consumed = True
+        res.encoding = 'utf-8'
+        res.url = request.url
+        res.request = request
+        res.elapsed = timedelta(seconds=entry['elapsed'])
+        return res
+
+    def close(self):
+        pass
+
+
+def replay_load(api, path, speed=1.0, workers=8):
+    """ Re-issues the requests of a recording through api, each at its
+    recorded offset from the start divided by speed (speed=None issues them
+    as fast as possible), from up to `workers` threads. Mount a ReplayAdapter
+    on api first to run offline. Returns a (entry, result or exception) pair
+    per request, in recorded order. """
+    header, entries = load(path)
+
+    def issue(entry):
+        parts = urlsplit(entry['url'])
+        params = dict(parse_qsl(parts.query)) or None
+        body = _decode(entry['body'], entry['body_b64'])
+        try:
+            if entry['method'] == 'GET':
+                return api._req('get', parts.path, params=params or {})
+            return api._req(entry['method'].lower(), parts.path, params=params,
+                            json=json.loads(body.decode('utf8')) if body else {})
+        except Exception as e:
+            return e
+
+    start = time.time()
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry in entries:
+            if speed:
+                delay = start + entry['t'] / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append((entry, pool.submit(issue, entry)))
+    return [(entry, f.result()) for entry, f in futures]
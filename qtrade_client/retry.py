@@ -0,0 +1,159 @@
+""" Retry policies and circuit breaking for client requests.
+
+Requests fall into idempotency classes with their own RetryPolicy, see
+`request_class`: reads and cancels may be repeated freely, while an order
+placed twice is two orders, so orders are only retried when the server
+certainly did not act on the first attempt. A CircuitBreaker tracks
+failures per endpoint and rejects requests to an endpoint that keeps
+failing until it had time to recover. """
+import random
+import threading
+import time
+
+# Idempotency classes
+READ = 'read'
+CANCEL = 'cancel'
+ORDER = 'order'
+
+# Statuses worth trying again. 429 is retried as soon as the rate limiter
+# allows, the others after a backoff.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def request_class(method, endpoint):
+    """ Idempotency class of a request """
+    if method.lower() == 'get':
+        return READ
+    if endpoint.startswith('/v1/user/cancel_order'):
+        return CANCEL
+    return ORDER
+
+
+class RetryPolicy(object):
+    """ How a class of requests is retried.
+
+    `attempts` is the total number of tries, so 1 disables retries. Retry n
+    waits a random time between (1 - jitter) and 1 times min(max_backoff,
+    backoff * 2 ** (n - 1)) seconds. No retry is started that would end
+    later than `deadline` seconds after the first attempt started. With
+    `unsent_only`, failed connections are only retried if the request was
+    never sent, and of the statuses only 429 is retried, which the server
+    answers without acting on the request. """
+
+    def __init__(self, attempts=2, backoff=0.1, max_backoff=5.0, jitter=0.5, deadline=None,
+                 statuses=RETRY_STATUSES, unsent_only=False):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.statuses = frozenset([429]) if unsent_only else frozenset(statuses)
+        self.unsent_only = unsent_only
+
+    def backoff_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def retry_delay(self, attempt, elapsed, status=None, unsent=False):
+        """ Seconds to wait before retrying a request whose attempt number
+        `attempt` failed with `status`, or with a connection error if status
+        is None, `elapsed` seconds after the first attempt started. None if
+        it must not be retried. """
+        if attempt >= self.attempts:
+            return None
+        if status is None:
+            if self.unsent_only and not unsent:
+                return None
+            delay = self.backoff_delay(attempt)
+        elif status in self.statuses:
+            delay = 0 if status == 429 else self.backoff_delay(attempt)
+        else:
+            return None
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+
+def default_policies():
+    """ A RetryPolicy per idempotency class, retrying once """
+    return {
+        READ: RetryPolicy(),
+        CANCEL: RetryPolicy(),
+        ORDER: RetryPolicy(unsent_only=True),
+    }
+
+
+class CircuitBreaker(object):
+    """ Counts consecutive failures (connection errors and 5xx responses)
+    per key. Once `failure_threshold` is reached the circuit opens and
+    `allow` refuses requests for `reset_timeout` seconds. After that a
+    single trial request is let through: its success closes the circuit,
+    its failure opens it again. A trial that ends without either must be
+    given up with `release`; one that is never reported lets another trial
+    through after `reset_timeout`. """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        # key: [consecutive failures, opened at or None, trial started at or None]
+        self._circuits = {}
+
+    @property
+    def failing(self):
+        """ Whether any key has failures counted, cheap to check before
+        working out a key """
+        return bool(self._circuits)
+
+    def allow(self, key):
+        circuit = self._circuits.get(key)
+        if circuit is None or circuit[1] is None:
+            return True
+        with self._lock:
+            if circuit[1] is None:
+                return True
+            now = time.time()
+            if now - circuit[1] < self.reset_timeout:
+                return False
+            if circuit[2] is not None and now - circuit[2] < self.reset_timeout:
+                return False
+            circuit[2] = now
+            return True
+
+    def success(self, key):
+        if key in self._circuits:
+            with self._lock:
+                self._circuits.pop(key, None)
+
+    def release(self, key):
+        """ Gives up the trial of an open circuit, eg when the request
+        was abandoned before its outcome was known """
+        circuit = self._circuits.get(key)
+        if circuit is not None and circuit[2] is not None:
+            with self._lock:
+                circuit[2] = None
+
+    def failure(self, key):
+        """ Returns True if this failure opened the circuit """
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None:
+                circuit = self._circuits[key] = [0, None, None]
+            circuit[0] += 1
+            if circuit[2] is not None or (circuit[1] is None and circuit[0] >= self.failure_threshold):
+                circuit[1] = time.time()
+                circuit[2] = None
+                return True
+            return False
+
+    def state(self, key):
+        circuit = self._circuits.get(key)
+        if circuit is None or circuit[1] is None:
+            return self.CLOSED
+        if circuit[2] is not None or time.time() - circuit[1] >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
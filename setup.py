@@ -6,10 +6,14 @@ setup(
         'click',
         'requests'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'fast': ['orjson'],
+    },
     version='0.1',
     packages=['qtrade_client', 'qtrade_client.cli'],
-    python_requires='>=2.7.0',
+    python_requires='>=3.7',
     entry_points={
-        'console_scripts': ['qtapi = qtrade.cli:entry'],
+        'console_scripts': ['qtapi = qtrade_client.cli:entry'],
     },
 )
@@ -0,0 +1,19 @@
+import json
+import unittest.mock as mock
+
+import pytest
+
+
+@pytest.fixture
+def response():
+    """ Factory of stand-ins for the requests.Response of a Session.request,
+    carrying `body` as the data of a success, or an error with code `error`
+    for statuses above 299 """
+    def make(status=200, body=None, headers=None, error="unavailable"):
+        res = mock.MagicMock(status_code=status, headers=headers or {})
+        if status > 299:
+            res.content = json.dumps({"errors": [{"code": error}]}).encode()
+        else:
+            res.content = json.dumps({"data": body or {}}).encode()
+        return res
+    return make
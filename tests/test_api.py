@@ -2,6 +2,8 @@ import pytest
 import json
 import requests
 import copy
+import os
+import socket
 
 try:
     import unittest.mock as mock
@@ -10,7 +12,7 @@ except ImportError:
 import time
 from decimal import Decimal
 
-from qtrade_client.api import QtradeAPI, QtradeAuth, APIException
+from qtrade_client.api import QtradeAPI, QtradeAuth, APIException, DeadlineExceeded, LOW
 
 
 @pytest.fixture
@@ -20,10 +22,10 @@ def api():
 @pytest.fixture
 def api_with_market():
     api = QtradeAPI("http://localhost:9898/")
-# manually set lazily loaded properties
-    api._markets_map = {
-        "LTC_BTC": {
-            "base_currency": {
+    # manually load lazily loaded properties
+    api._index_common({
+        "currencies": [
+            {
                 "can_withdraw": True,
                 "code": "BTC",
                 "config": {
@@ -44,12 +46,7 @@ def api_with_market():
                 "status": "ok",
                 "type": "bitcoin_like",
             },
-            "can_cancel": True,
-            "can_trade": True,
-            "can_view": True,
-            "id": 1,
-            "maker_fee": "0",
-            "market_currency": {
+            {
                 "can_withdraw": True,
                 "code": "LTC",
                 "config": {
@@ -71,80 +68,23 @@ def api_with_market():
                 "status": "ok",
                 "type": "bitcoin_like",
             },
-            "metadata": {},
-            "string": "LTC_BTC",
-            "taker_fee": "0.005",
-        },
-        1: {
-            "base_currency": {
-                "can_withdraw": True,
-                "code": "BTC",
-                "config": {
-                    "address_version": 0,
-                    "default_signer": 6,
-                    "explorerAddressURL": "https: //live.blockcypher.com/btc/address/",
-                    "explorerTransactionURL": "https: //live.blockcypher.com/btc/tx/",
-                    "p2sh_address_version": 5,
-                    "price": 8614.27,
-                    "required_confirmations": 2,
-                    "required_generate_confirmations": 100,
-                    "satoshi_per_byte": 15,
-                    "withdraw_fee": "0.0005",
-                },
-                "long_name": "Bitcoin",
-                "metadata": {"withdraw_notices": []},
-                "precision": 8,
-                "status": "ok",
-                "type": "bitcoin_like",
-            },
-            "can_cancel": True,
-            "can_trade": True,
-            "can_view": True,
-            "id": 1,
-            "maker_fee": "0",
-            "market_currency": {
-                "can_withdraw": True,
-                "code": "LTC",
-                "config": {
-                    "additional_versions": [5],
-                    "address_version": 48,
-                    "default_signer": 5,
-                    "explorerAddressURL": "https: //live.blockcypher.com/ltc/address/",
-                    "explorerTransactionURL": "https: //live.blockcypher.com/ltc/tx/",
-                    "p2sh_address_version": 50,
-                    "price": 58.73,
-                    "required_confirmations": 10,
-                    "required_generate_confirmations": 100,
-                    "satoshi_per_byte": 105,
-                    "withdraw_fee": "0.001",
-                },
-                "long_name": "Litecoin",
+        ],
+        "markets": [
+            {
+                "base_currency": "BTC",
+                "can_cancel": True,
+                "can_trade": True,
+                "can_view": True,
+                "id": 1,
+                "maker_fee": "0",
+                "market_currency": "LTC",
                 "metadata": {},
-                "precision": 8,
-                "status": "ok",
-                "type": "bitcoin_like",
+                "taker_fee": "0.005",
             },
-            "metadata": {},
-            "string": "LTC_BTC",
-            "taker_fee": "0.005",
-        },
-    }
-    api._tickers = {
-        1: {
-            "ask": "0.00707017",
-            "bid": "0.00664751",
-            "day_avg_price": "0.0071579647440367",
-            "day_change": "0.0173330516998029",
-            "day_high": "0.00727268",
-            "day_low": "0.00713415",
-            "day_open": "0.00714877",
-            "day_volume_base": "0.00169664",
-            "day_volume_market": "0.23702827",
-            "id": 1,
-            "id_hr": "LTC_BTC",
-            "last": "0.00727268",
-        },
-        "LTC_BTC": {
+        ],
+    })
+    api._index_tickers({"markets": [
+        {
             "ask": "0.00707017",
             "bid": "0.00664751",
             "day_avg_price": "0.0071579647440367",
@@ -158,7 +98,7 @@ def api_with_market():
             "id_hr": "LTC_BTC",
             "last": "0.00727268",
         },
-    }
+    ]})
 
     # prevent lazily loaded properties from updating and making http calls
     def ret(*args, **kwargs):
@@ -181,30 +121,47 @@ def test_hmac():
     )
 
 
-@mock.patch("time.time", mock.MagicMock(return_value=10))
-def test_hard_limit(api):
+@mock.patch("time.time", mock.MagicMock(return_value=12345))
+def test_sign_bytes_and_str():
+    auth = QtradeAuth("256:vwj043jtrw4o5igw4oi5jwoi45g")
+    body = '{"amount": "1"}'
+    assert (auth.sign("POST", "/v1/user/sell_limit?x=1", body) ==
+            auth.sign("POST", b"/v1/user/sell_limit?x=1", body.encode("utf8")))
+    assert auth.sign("GET", "/", None) == auth.sign("GET", "/", b"")
+    assert auth.sign("GET", "/")["Authorization"] == "HMAC-SHA256 256:iyfC4n+bE+3hLgMJns1Z67FKA7O5qm5PgDvZHGraMTQ="
+
+
+def sleeping(clock):
+    """ A time.sleep that advances the mocked time.time clock """
+    def sleep(seconds):
+        clock.return_value += seconds
+    return mock.MagicMock(side_effect=sleep)
+
+
+@mock.patch("time.time", return_value=10)
+def test_hard_limit(clock, api):
     api.rl_remaining = 0
     api.rl_reset_at = 15
-    time.sleep = mock.MagicMock()
     # Just to not bomb out on an actual request
     api.rs.request = mock.MagicMock(return_value=mock.MagicMock(status_code=200))
-    api.get("/v1/common")
+    with mock.patch("time.sleep", sleeping(clock)) as sleep:
+        api.get("/v1/common")
     # Test that the rate limit sleep was called
-    time.sleep.assert_called_with(5)
+    sleep.assert_called_with(5)
 
 
-@mock.patch("time.time", mock.MagicMock(return_value=10))
-def test_soft_limit(api):
+@mock.patch("time.time", return_value=10)
+def test_soft_limit(clock, api):
     api.rl_remaining = 1
     api.rl_reset_at = 12
     api.rl_limit = 60
     api.rl_soft_threshold = -30
-    time.sleep = mock.MagicMock()
     # Just to not bomb out on an actual request
     api.rs.request = mock.MagicMock(return_value=mock.MagicMock(status_code=200))
-    api.get("/v1/common")
+    with mock.patch("time.sleep", sleeping(clock)) as sleep:
+        api.get("/v1/common")
     # Test that the rate limit sleep was called
-    time.sleep.assert_called_with(2)
+    sleep.assert_called_with(2)
 
 
 def test_300_status(api):
@@ -421,6 +378,7 @@ def test_refresh_common(api):
         "metadata": {"labels": []},
         "taker_fee": "0.005"}]}
     api._req = mock.MagicMock(return_value=ret)
+    sent = copy.deepcopy(ret)
     assert api.markets["GRIN_BTC"] == ret["markets"][0]
     assert api.markets["LTC_BTC"] == ret["markets"][1]
     assert api.markets["BIS_BTC"] == ret["markets"][2]
@@ -428,6 +386,10 @@ def test_refresh_common(api):
     assert api.currencies["LTC"] == ret["currencies"][1]
     assert api.currencies["BTC"] == ret["currencies"][2]
     assert api.currencies["BIS"] == ret["currencies"][3]
+    # the response may be shared with other callers and is left as it was
+    assert ret == sent
+    assert api.markets["BIS_BTC"]["base_currency"] is api.currencies["BTC"]
+    assert api.markets["BIS_BTC"]["string"] == "BIS_BTC"
 
 
 def test_refresh_tickers(api):
@@ -622,6 +584,15 @@ def test_clone(api):
     assert c.rs.auth is None
 
 
+def test_base_set_hmac():
+    from qtrade_client.api import BaseQtradeAPI
+    # the key is set up the same for every transport
+    base = BaseQtradeAPI("http://localhost:9898/", key="1:11111111111")
+    assert base.auth.key_id == "1"
+    api = QtradeAPI("http://localhost:9898/", key="1:11111111111")
+    assert api.rs.auth is api.auth
+
+
 def test_cancel_all_orders(api):
     api._req = mock.MagicMock()
     ords = [
@@ -734,3 +705,568 @@ def test_cancel_market_orders_no_string_id(api):
 def test_cancel_market_orders_both_string_id(api):
     with pytest.raises(ValueError):
         api.cancel_market_orders(market_string="LTC_BTC", market_id=36)
+
+
+def test_cancel_orders_bulk(api):
+    def cancel(method, endpoint, json):
+        if json['id'] == 2:
+            raise APIException("Invalid return code from backend", 400, ['order_not_open'])
+        if json['id'] == 3:
+            raise APIException("Invalid return code from backend", 500, [])
+        if json['id'] == 4:
+            raise reset
+
+    reset = requests.exceptions.ConnectionError("Connection reset by peer")
+    api._req = mock.MagicMock(side_effect=cancel)
+    api.orders = mock.MagicMock(return_value=[{'id': 1}, {'id': 2}, {'id': 3}, {'id': 4}])
+    res = api.cancel_all_orders(bulk=True, workers=3)
+    assert res == [
+        {'id': 1, 'result': 'cancelled'},
+        {'id': 2, 'result': 'closed', 'code': 400, 'errors': ['order_not_open']},
+        {'id': 3, 'result': 'failed', 'code': 500, 'errors': []},
+        {'id': 4, 'result': 'failed', 'code': None, 'errors': [], 'error': reset},
+    ]
+    assert api._req.call_count == 4
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=10))
+def test_ratelimit_reservation(api):
+    api.rl_remaining = 2
+    api.rl_reset_at = 20
+    api.rl_limit = 2
+    api.rl_soft_threshold = 1
+    # each request reserves part of the budget before its response arrives,
+    # so the third concurrent caller waits for the reset
+    assert api._reserve_ratelimit() == 0
+    assert api._reserve_ratelimit() == 0
+    assert api._reserve_ratelimit() == 10
+
+
+def test_order_batch(api_with_market):
+    api = api_with_market
+
+    def place(method, endpoint, **kwargs):
+        if kwargs['price'] == "0.00500000":
+            raise APIException("Invalid return code from backend", 400, ['insufficient_funds'])
+        return {'order': dict(kwargs)}
+
+    api._req = mock.MagicMock(side_effect=place)
+    res = api.order_batch([
+        {'order_type': 'sell_limit', 'price': 1, 'value': 0.01, 'market_id': 1},
+        {'order_type': 'buy_limit', 'price': 0.005, 'value': 0.01, 'market_id': 1},
+        {'order_type': 'buy_limit', 'price': 0.1, 'value': 0.01, 'market_id': 1, 'prevent_taker': True},
+        {'order_type': 'buy_limit', 'price': 0.001, 'amount': 5, 'market_string': 'LTC_BTC'},
+    ])
+    # results come back in input order
+    assert res[0]['result'] == {'order': {'amount': '0.01000000', 'price': '1.00000000', 'market_id': 1}}
+    assert res[0]['error'] is None
+    assert res[1]['result'] is None
+    assert res[1]['error'].errors == ['insufficient_funds']
+    assert res[2]['result'] == "order not placed"
+    assert res[3]['result'] == {'order': {'amount': '5', 'price': '0.00100000', 'market_id': 1}}
+    assert all(r['elapsed'] >= 0 for r in res)
+    assert api._req.call_count == 3
+
+
+def test_order_batch_transport_error(api_with_market):
+    api = api_with_market
+    reset = requests.exceptions.ConnectionError("Connection reset by peer")
+
+    def place(method, endpoint, **kwargs):
+        if kwargs['price'] == "0.00500000":
+            raise reset
+        return {'order': {'id': 1}}
+
+    api._req = mock.MagicMock(side_effect=place)
+    res = api.order_batch([
+        {'order_type': 'buy_limit', 'price': 0.005, 'value': 0.01, 'market_id': 1},
+        {'order_type': 'sell_limit', 'price': 1, 'value': 0.01, 'market_id': 1},
+    ])
+    # the order that was placed is still reported
+    assert res[0]['result'] is None and res[0]['error'] is reset
+    assert res[1]['result'] == {'order': {'id': 1}} and res[1]['error'] is None
+
+
+def test_order_batch_validates_first(api_with_market):
+    api = api_with_market
+    api._req = mock.MagicMock()
+    with pytest.raises(ValueError):
+        api.order_batch([
+            {'order_type': 'sell_limit', 'price': 1, 'value': 0.01, 'market_id': 1},
+            {'order_type': 'sell_limit', 'price': 1, 'market_id': 1},
+        ])
+    # nothing is sent if any of the orders is invalid
+    assert api._req.call_count == 0
+
+
+def test_background_refresh(api):
+    import threading
+    api.background_refresh = True
+    api._tickers = {1: {"id": 1, "id_hr": "LTC_BTC", "last": "1"}}
+    api._tickers_age = 0
+    refreshed = threading.Event()
+
+    def get(method, endpoint, **kwargs):
+        refreshed.wait(5)
+        return {"markets": [{"id": 1, "id_hr": "LTC_BTC", "last": "2"}]}
+
+    api._req = mock.MagicMock(side_effect=get)
+    # the expired snapshot is served without waiting on the request
+    assert api.tickers[1]["last"] == "1"
+    assert api.tickers[1]["last"] == "1"
+    refreshed.set()
+    for _ in range(500):
+        if not api._refreshing:
+            break
+        threading.Event().wait(0.01)
+    assert api.tickers[1]["last"] == "2"
+    # concurrent expiries only start one refresh
+    assert api._req.call_count == 1
+
+
+def test_prevent_taker_max_staleness(api_with_market):
+    api = api_with_market
+    api._req = mock.MagicMock(return_value=order_return)
+    api._tickers_age = time.time() - 120
+    api.tickers_max_staleness = 60
+    o = api.order("sell_limit", 1, value=0.01, market_id=1, prevent_taker=True)
+    assert o == "order not placed"
+    # without prevent_taker the ticker age doesn't matter
+    o = api.order("sell_limit", 1, value=0.01, market_id=1)
+    assert o == order_return
+
+
+
+def test_background_refresh_max_staleness(api_with_market):
+    api = api_with_market
+    api._req = mock.MagicMock(return_value=order_return)
+    api.background_refresh = True
+    api._start_refresh = mock.MagicMock(return_value=False)
+    # background refreshes that don't land can't keep old tickers in use
+    api._tickers_age = time.time() - 2 * api.tickers_update_interval - 1
+    o = api.order("sell_limit", 1, value=0.01, market_id=1, prevent_taker=True)
+    assert o == "order not placed"
+    api._tickers_age = time.time() - api.tickers_update_interval - 1
+    o = api.order("sell_limit", 1, value=0.01, market_id=1, prevent_taker=True)
+    assert o == order_return
+
+def common_payload():
+    return {
+        "currencies": [{"code": "BTC", "precision": 8}, {"code": "LTC", "precision": 8}],
+        "markets": [{"id": 1, "base_currency": "BTC", "market_currency": "LTC",
+                     "maker_fee": "0", "taker_fee": "0.005"}],
+    }
+
+
+def test_common_disk_cache(tmp_path):
+    path = str(tmp_path / "common.cache")
+    api = QtradeAPI("http://localhost:9898/", common_cache_path=path)
+    api._req = mock.MagicMock(return_value=common_payload())
+    assert api.markets["LTC_BTC"]["id"] == 1
+
+    # a fresh client starts from the cache without a request
+    cold = QtradeAPI("http://localhost:9898/", common_cache_path=path)
+    cold._req = mock.MagicMock()
+    assert cold.markets[1]["string"] == "LTC_BTC"
+    assert cold.markets[1]["base_currency"] is cold.currencies["BTC"]
+    assert cold._req.call_count == 0
+    assert os.stat(path).st_mode & 0o077 == 0
+    with open(path) as f:
+        assert json.load(f)["common"] == common_payload()
+
+    # caches for other endpoints or past their ttl are ignored
+    other = QtradeAPI("http://localhost:9999/", common_cache_path=path)
+    other._req = mock.MagicMock(return_value=common_payload())
+    other.markets
+    assert other._req.call_count == 1
+    expired = QtradeAPI("http://localhost:9898/", common_cache_path=path)
+    expired.common_cache_ttl = -1
+    expired._req = mock.MagicMock(return_value=common_payload())
+    expired.markets
+    assert expired._req.call_count == 1
+
+
+def test_common_disk_cache_corrupt(tmp_path):
+    path = tmp_path / "common.cache"
+    path.write_bytes(b"garbage")
+    api = QtradeAPI("http://localhost:9898/", common_cache_path=str(path))
+    api._req = mock.MagicMock(return_value=common_payload())
+    assert api.markets["LTC_BTC"]["id"] == 1
+    assert api._req.call_count == 1
+
+
+def test_order_reload_priority(api, response):
+    # under the soft threshold, where LOW requests wait for the reset
+    api.rl_limit = 120
+    api.rl_remaining = 50
+    api.rl_reset_at = time.time() + 40
+    api.ratelimiter.drop_low = True
+    tickers = {"markets": [{"id": 1, "id_hr": "LTC_BTC", "ask": "2", "bid": "0.5"}]}
+
+    def respond(method, url, **kwargs):
+        if url.endswith("/v1/common"):
+            return response(body=common_payload())
+        if url.endswith("/v1/tickers"):
+            return response(body=tickers)
+        return response(body=order_return)
+    api.rs.request = mock.MagicMock(side_effect=respond)
+    with mock.patch("time.sleep") as sleep:
+        # the markets and tickers the order needs load without waiting
+        assert api.order("sell_limit", 1, value=0.01, market_string="LTC_BTC", prevent_taker=True) == order_return
+    assert sleep.call_count == 0
+    assert api.rs.request.call_count == 3
+
+
+def test_clone_shares_markets(api_with_market):
+    c = api_with_market.clone()
+    assert c._markets_map is api_with_market._markets_map
+
+
+def test_balances_fixed_point(api):
+    api.fixed_point = True
+    api._req = mock.MagicMock(return_value={
+        "balances": [{"currency": "BTC", "balance": "0.1970952"}],
+        "order_balances": [{"currency": "BTC", "balance": "0.1708"}],
+    })
+    assert api.balances_all() == {"spendable": {"BTC": 19709520}, "in_orders": {"BTC": 17080000}}
+    assert api.balances_merged() == {"BTC": 36789520}
+
+
+def test_buy_order_fixed_point(api_with_market):
+    api = api_with_market
+    api.fixed_point = True
+    api._req = mock.MagicMock(return_value=order_return)
+    api.order("buy_limit", 500000, value=1000000, market_id=1)
+    api._req.assert_called_with("post", "/v1/user/buy_limit", amount="1.99004975",
+                                price="0.00500000", market_id=1)
+    # prevent_taker compares against the ask in sats
+    assert api.order("buy_limit", 10000000, value=1000000, market_id=1, prevent_taker=True) == "order not placed"
+
+
+def test_no_logging_work_when_disabled(api):
+    api.rs.request = mock.MagicMock(return_value=mock.MagicMock(
+        status_code=200, content=b'{"data": {}}'))
+    with mock.patch("qtrade_client.api._json.dumps") as dumps:
+        api.post("/v1/user/cancel_order", id=1)
+    assert dumps.call_count == 0
+
+
+def test_token_header_not_shared(api):
+    api.token = "abc"
+    api.rs.request = mock.MagicMock(return_value=mock.MagicMock(status_code=200))
+    api.get("/v1/user/me")
+    headers = api.rs.request.call_args[1]["headers"]
+    assert headers == {"Authorization": "Bearer abc"}
+    api.token = None
+    api.get("/v1/user/me")
+    assert api.rs.request.call_args[1]["headers"] is None
+
+
+class StreamResponse(object):
+
+    def __init__(self, *chunks, **kwargs):
+        self.chunks = chunks
+        self.error = kwargs.get("error")
+        self.status_code = 200
+        self.headers = {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for c in self.chunks:
+            yield c
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_records(api):
+    res = StreamResponse(b'{"id": 1}\n{"id"', b': 2}\n\n{"id": 3}')
+    api.rs.request = mock.MagicMock(return_value=res)
+    records = api.stream("/v1/user/orders/stream")
+    # nothing is requested until the first record is asked for
+    assert api.rs.request.call_count == 0
+    assert list(records) == [{"id": 1}, {"id": 2}, {"id": 3}]
+    assert res.closed
+
+
+def test_stream_resume(api):
+    api.rs.request = mock.MagicMock(side_effect=[
+        StreamResponse(b'{"id": 1}\n{"id": 2}\n{"id": 3', error=requests.exceptions.ChunkedEncodingError()),
+        StreamResponse(b'{"id": 3}\n'),
+    ])
+    records = list(api.stream("/v1/feed", resume=lambda rec: {"newer_than": rec["id"]}, reconnect_delay=0))
+    assert records == [{"id": 1}, {"id": 2}, {"id": 3}]
+    assert api.rs.request.call_args[1]["params"] == {"newer_than": 2}
+
+
+def test_stream_max_line(api):
+    api.stream_max_line = 10
+    api.rs.request = mock.MagicMock(return_value=StreamResponse(b'{"id": 1}\n{"data": "xxxxxxxxxx'))
+    records = api.stream("/v1/feed")
+    assert next(records) == {"id": 1}
+    with pytest.raises(APIException):
+        next(records)
+
+
+def test_iter_orders(api):
+    pages = {None: [{"id": 9}, {"id": 8}], 8: [{"id": 7}, {"id": 5}], 5: []}
+
+    def get(method, endpoint, older_than=None, **kwargs):
+        return {"orders": pages[older_than]}
+
+    api._req = mock.MagicMock(side_effect=get)
+    for prefetch in (True, False):
+        assert [o["id"] for o in api.iter_orders(prefetch=prefetch)] == [9, 8, 7, 5]
+    api._req.assert_called_with("get", "/v1/user/orders", priority=LOW, open=None,
+                                older_than=5, newer_than=None)
+
+
+def test_iter_orders_is_lazy(api):
+    api._req = mock.MagicMock(return_value={"orders": [{"id": 3}, {"id": 2}]})
+    orders = api.iter_orders(prefetch=False)
+    assert next(orders)["id"] == 3
+    assert api._req.call_count == 1
+    orders.close()
+
+
+def _concurrently(func, n=8):
+    import threading
+    results = [None] * n
+
+    def run(i):
+        try:
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, results
+
+
+def test_coalesce_gets(api):
+    import threading
+    release = threading.Event()
+    ret = {"balances": []}
+
+    def slow(*args, **kwargs):
+        release.wait(5)
+        return ret
+    api._req = mock.MagicMock(side_effect=slow)
+    threads, results = _concurrently(lambda: api.get("/v1/user/balances"))
+    # let every thread reach the in flight request before it completes
+    while len(api._inflight) == 0:
+        threading.Event().wait(0.001)
+    threading.Event().wait(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    assert api._req.call_count == 1
+    assert all(r is ret for r in results)
+    assert api._inflight == {}
+    # once it's done, the next request goes out again
+    api.get("/v1/user/balances")
+    assert api._req.call_count == 2
+
+
+def test_coalesce_gets_error(api):
+    api._req = mock.MagicMock(side_effect=APIException("bad", 500, []))
+    with pytest.raises(APIException):
+        api.get("/v1/common")
+    assert api._inflight == {}
+
+
+def test_coalesce_leader_out_of_budget(api):
+    import threading
+    release = threading.Event()
+    ret = {"balances": []}
+    scopes = []
+
+    def req(*args, **kwargs):
+        scopes.append(api._scope_expires())
+        if len(scopes) == 1:
+            release.wait(5)
+            raise DeadlineExceeded("GET /v1/user/balances can't finish within its deadline", None, [])
+        return ret
+    api._req = mock.MagicMock(side_effect=req)
+    errors = []
+
+    def lead():
+        try:
+            api.get("/v1/user/balances")
+        except DeadlineExceeded as e:
+            errors.append(e)
+    leader = threading.Thread(target=lead)
+    leader.start()
+    while not api._inflight:
+        threading.Event().wait(0.001)
+    threading.Timer(0.05, release.set).start()
+    # the joiner has time left, so it makes the request again itself
+    with api.deadline(5):
+        assert api.get("/v1/user/balances") is ret
+    leader.join()
+    assert len(errors) == 1
+    assert api._req.call_count == 2
+    assert scopes[0] is None and scopes[1] is not None
+    assert api._inflight == {}
+
+
+def test_coalesce_distinct_params(api):
+    api._req = mock.MagicMock(return_value={"orders": []})
+    api.coalesce_gets = False
+    api.get("/v1/user/orders", open="true")
+    api.coalesce_gets = True
+    api.get("/v1/user/orders", open="false")
+    # unhashable arguments are sent without coalescing
+    api.get("/v1/user/orders", headers={"X": "1"})
+    assert api._req.call_count == 3
+
+
+def test_tickers_loaded_once(api):
+    import threading
+    api._tickers = None
+    release = threading.Event()
+
+    def slow(*args, **kwargs):
+        release.wait(5)
+        return {"markets": [{"id": 1, "id_hr": "LTC_BTC"}]}
+    api._req = mock.MagicMock(side_effect=slow)
+    threads, results = _concurrently(lambda: api.tickers)
+    threading.Event().wait(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    assert api._req.call_count == 1
+    assert all(r is results[0] and r["LTC_BTC"] is r[1] for r in results)
+
+
+def test_transport_config():
+    api = QtradeAPI("http://localhost:9898/", pool_maxsize=32, pool_block=True, timeout=5,
+                    tcp_keepalive=True)
+    adapter = api.rs.get_adapter("https://api.qtrade.io/")
+    assert adapter is api.rs.get_adapter("http://localhost:9898/")
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == 32
+    assert adapter.poolmanager.connection_pool_kw["block"] is True
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in \
+        adapter.poolmanager.connection_pool_kw["socket_options"]
+
+    api.rs.request = mock.MagicMock(return_value=mock.MagicMock(status_code=200))
+    api.get("/v1/common")
+    assert api.rs.request.call_args[1]["timeout"] == 5
+    # a per call timeout wins
+    api.get("/v1/tickers", timeout=1)
+    assert api.rs.request.call_args[1]["timeout"] == 1
+
+
+def test_clone_share_pool():
+    api = QtradeAPI("http://localhost:9898/", pool_maxsize=4, timeout=3)
+    c = api.clone()
+    assert c.timeout == 3
+    assert c.rs.get_adapter("http://x/") is not api.rs.get_adapter("http://x/")
+    assert c.rs.get_adapter("http://x/").poolmanager.connection_pool_kw["maxsize"] == 4
+    shared = api.clone(share_pool=True)
+    assert shared.rs.get_adapter("http://x/") is api.rs.get_adapter("http://x/")
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=100))
+def test_deadline_ratelimit_wait(api, response):
+    api.rl_remaining = 0
+    api.rl_reset_at = 130
+    api.rs.request = mock.MagicMock(return_value=response())
+    # waiting 30s for the rate limit can't fit a 5s budget, so don't wait
+    with mock.patch("time.sleep") as sleep, pytest.raises(DeadlineExceeded):
+        api.get("/v1/user/me", deadline=5)
+    assert sleep.call_count == 0
+    assert api.rs.request.call_count == 0
+    assert api.ratelimiter.stats()["normal"]["waiting"] == 0
+
+
+def test_deadline_caps_timeout(api, response):
+    api.timeout = (3, 10)
+    api.rs.request = mock.MagicMock(return_value=response())
+    api.get("/v1/common", deadline=5)
+    connect, read = api.rs.request.call_args[1]["timeout"]
+    assert connect == 3 and 4.9 < read <= 5
+    api.get("/v1/common")
+    assert api.rs.request.call_args[1]["timeout"] == (3, 10)
+    api.default_deadline = 2
+    api.get("/v1/common")
+    connect, read = api.rs.request.call_args[1]["timeout"]
+    assert connect <= 2 and read <= 2
+
+
+def test_deadline_scope(api):
+    api.rs.request = mock.MagicMock(side_effect=requests.exceptions.ReadTimeout())
+    with api.deadline(1):
+        with api.deadline(10):
+            assert api.rs.request.call_count == 0
+            # the timeout came from the deadline, so it is reported as such
+            with pytest.raises(DeadlineExceeded):
+                api.get("/v1/common")
+    assert api.rs.request.call_args[1]["timeout"] <= 1
+    assert api._scope_expires() is None
+    # without a deadline the timeout is the transport's
+    api.rs.request = mock.MagicMock(side_effect=requests.exceptions.ReadTimeout())
+    with mock.patch("time.sleep"), pytest.raises(requests.exceptions.ReadTimeout):
+        api.get("/v1/common")
+
+
+def test_deadline_stops_retries(api):
+    from qtrade_client.retry import READ, RetryPolicy
+    api.retry_policies[READ] = RetryPolicy(attempts=5, backoff=1, jitter=0)
+    res = mock.MagicMock(status_code=503, headers={}, content=b'{"errors": [{"code": "unavailable"}]}')
+    api.rs.request = mock.MagicMock(return_value=res)
+    with mock.patch("time.sleep"), pytest.raises(APIException) as e:
+        api.get("/v1/common", deadline=0.5)
+    # the backoff of 1s doesn't fit, the 503 is reported
+    assert e.value.code == 503
+    assert api.rs.request.call_count == 1
+
+
+def test_deadline_scope_workers(api, response):
+    api.rs.request = mock.MagicMock(return_value=response())
+    with api.deadline(0):
+        results = api.cancel_orders([1, 2])
+    assert [r["result"] for r in results] == ["failed", "failed"]
+    assert api.rs.request.call_count == 0
+
+
+def test_deadline_coalesced_wait(api, response):
+    import threading
+    release = threading.Event()
+
+    def slow(*args, **kwargs):
+        release.wait(5)
+        return response()
+    api.rs.request = mock.MagicMock(side_effect=slow)
+    leader = threading.Thread(target=api.get, args=("/v1/common",))
+    leader.start()
+    while not api._inflight:
+        threading.Event().wait(0.001)
+    with api.deadline(0.05), pytest.raises(DeadlineExceeded):
+        api.get("/v1/common")
+    release.set()
+    leader.join()
+    assert api.rs.request.call_count == 1
+
+
+def test_deadline_circuit_trial(api, response):
+    from qtrade_client.retry import CircuitBreaker
+    api.circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    api.rs.request = mock.MagicMock(side_effect=requests.exceptions.ConnectionError())
+    with mock.patch("time.sleep"), pytest.raises(requests.exceptions.ConnectionError):
+        api.get("/v1/common")
+    opened = api.circuit_breaker._circuits["/v1/common"][1]
+    # the trial runs into its deadline, which fails it like any timeout
+    api.rs.request = mock.MagicMock(side_effect=requests.exceptions.ReadTimeout())
+    with mock.patch("time.time", return_value=opened + 31):
+        with pytest.raises(DeadlineExceeded):
+            api.get("/v1/common", deadline=1)
+        assert api.circuit_breaker.state("/v1/common") == CircuitBreaker.OPEN
+    # the next trial goes through and closes the circuit
+    api.rs.request = mock.MagicMock(return_value=response())
+    with mock.patch("time.time", return_value=opened + 62):
+        api.get("/v1/common")
+    assert api.circuit_breaker.state("/v1/common") == CircuitBreaker.CLOSED
@@ -0,0 +1,273 @@
+import pytest
+import asyncio
+import json
+import time
+import unittest.mock as mock
+from decimal import Decimal
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from qtrade_client.api import APIException, DeadlineExceeded
+from qtrade_client.async_api import AsyncQtradeAPI
+
+
+class FakeResponse(object):
+
+    def __init__(self, status=200, body=None, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def read(self):
+        if self.body is None:
+            return b""
+        return json.dumps(self.body).encode()
+
+
+class FakeSession(object):
+    """ Stands in for aiohttp.ClientSession, replaying responses in order and
+    recording the requests made. Exceptions among the responses are raised. """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        res = self.responses.pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    async def close(self):
+        pass
+
+
+COMMON = {
+    "currencies": [{"code": "BTC"}, {"code": "LTC"}],
+    "markets": [{"id": 1, "base_currency": "BTC", "market_currency": "LTC",
+                 "maker_fee": "0", "taker_fee": "0.005"}],
+}
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def api():
+    return AsyncQtradeAPI("http://localhost:9898/")
+
+
+def test_get(api):
+    api._session = FakeSession(FakeResponse(body={"data": {"orders": []}}, headers={
+        "X-Ratelimit-Remaining": "10", "X-Ratelimit-Limit": "60", "X-Ratelimit-Reset": "30"}))
+    assert run(api.orders(open=True)) == []
+    method, url, kwargs = api._session.calls[0]
+    assert method == "get"
+    assert str(url) == "http://localhost:9898/v1/user/orders?open=true"
+    # rate limit state is learned exactly like the sync client
+    assert api.rl_remaining == 10
+    assert api.rl_limit == 60
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=12345))
+def test_hmac_signed(api):
+    api.set_hmac("256:vwj043jtrw4o5igw4oi5jwoi45g")
+    api._session = FakeSession(FakeResponse(body={"data": {}}))
+    run(api.get("/v1/user/me"))
+    headers = api._session.calls[0][2]["headers"]
+    assert headers["Authorization"] == api.auth.sign("GET", "/v1/user/me")["Authorization"]
+    assert headers["HMAC-Timestamp"] == "12345"
+
+
+@mock.patch("time.time", return_value=10)
+def test_hard_limit(clock, api):
+    api.rl_remaining = 0
+    api.rl_reset_at = 15
+    api._session = FakeSession(FakeResponse(body={"data": {}}))
+
+    async def sleep(seconds):
+        clock.return_value += seconds
+    with mock.patch("asyncio.sleep", mock.AsyncMock(side_effect=sleep)) as sleep:
+        run(api.get("/v1/common"))
+    sleep.assert_called_with(5)
+
+
+def test_429_status(api):
+    api._session = FakeSession(FakeResponse(status=429), FakeResponse(status=429))
+    with pytest.raises(APIException):
+        run(api.get("/v1/common"))
+    # the client should retry once on a 429
+    assert len(api._session.calls) == 2
+
+
+def test_retry_policy(api):
+    api._session = FakeSession(FakeResponse(status=503), FakeResponse(body={"data": {"ok": 1}}))
+    with mock.patch("asyncio.sleep", mock.AsyncMock()) as sleep:
+        assert run(api.get("/v1/user/me")) == {"ok": 1}
+    assert len(api._session.calls) == 2
+    assert sleep.call_count == 1
+
+    # order placement is not repeated once it may have reached the server
+    api._session = FakeSession(FakeResponse(status=503))
+    with pytest.raises(APIException):
+        run(api.post("/v1/user/sell_limit", price="1", amount="1", market_id=1))
+    assert len(api._session.calls) == 1
+
+
+def test_deadline(api):
+    api.timeout = 10
+    api._session = FakeSession(FakeResponse(body={"data": {}}))
+
+    async def within_scope():
+        with api.deadline(2):
+            await api.get("/v1/user/me")
+    run(within_scope())
+    assert api._session.calls[0][2]["timeout"].total <= 2
+
+    # a rate limit wait past the deadline fails without waiting
+    api.rl_remaining = 0
+    api.rl_reset_at = time.time() + 30
+    with mock.patch("asyncio.sleep", mock.AsyncMock()) as sleep:
+        with pytest.raises(DeadlineExceeded):
+            run(api.get("/v1/user/me", deadline=5))
+    assert sleep.call_count == 0
+    assert len(api._session.calls) == 1
+
+
+def test_error_codes(api):
+    api._session = FakeSession(FakeResponse(status=400, body={"errors": [{"code": "bad_request"}]}))
+    with pytest.raises(APIException) as e:
+        run(api.post("/v1/user/cancel_order", id=1))
+    assert e.value.code == 400
+    assert e.value.errors == ["bad_request"]
+
+
+def test_balances_all(api):
+    api._session = FakeSession(FakeResponse(body={"data": {
+        "balances": [{"currency": "BTC", "balance": "0.1970952"}],
+        "order_balances": [{"currency": "BTC", "balance": "0.1708"}],
+    }}))
+    assert run(api.balances_merged()) == {"BTC": Decimal("0.3678952")}
+
+
+def test_sell_order(api):
+    api._index_common(COMMON)
+    api._session = FakeSession(FakeResponse(body={"data": {"order": {}}}))
+    run(api.order("sell_limit", 1, value=0.01, market_id=1))
+    method, url, kwargs = api._session.calls[0]
+    assert str(url) == "http://localhost:9898/v1/user/sell_limit"
+    assert json.loads(kwargs["data"].decode()) == {
+        "amount": "0.01000000", "price": "1.00000000", "market_id": 1}
+
+
+def test_cancel_orders_bulk(api):
+    reset = aiohttp.ClientConnectionError("reset")
+    api._session = FakeSession(
+        FakeResponse(body={"data": {}}),
+        FakeResponse(status=400, body={"errors": [{"code": "order_not_open"}]}),
+        aiohttp.ClientConnectionError("reset"), reset)
+    with mock.patch("asyncio.sleep", mock.AsyncMock()):
+        assert run(api.cancel_orders([1, 2, 3], concurrency=1)) == [
+            {'id': 1, 'result': 'cancelled'},
+            {'id': 2, 'result': 'closed', 'code': 400, 'errors': ['order_not_open']},
+            # failed after a retry
+            {'id': 3, 'result': 'failed', 'code': None, 'errors': [], 'error': reset},
+        ]
+
+
+def test_order_batch(api):
+    api._index_common(COMMON)
+    api._session = FakeSession(
+        FakeResponse(body={"data": {"order": {"id": 1}}}),
+        FakeResponse(body={"data": {"order": {"id": 2}}}))
+    res = run(api.order_batch([
+        {'order_type': 'sell_limit', 'price': 1, 'value': 0.01, 'market_id': 1},
+        {'order_type': 'sell_limit', 'price': 2, 'amount': 1, 'market_id': 1},
+    ], concurrency=1))
+    assert [r['result'] for r in res] == [{"order": {"id": 1}}, {"order": {"id": 2}}]
+
+
+def test_iter_orders(api):
+    api._session = FakeSession(
+        FakeResponse(body={"data": {"orders": [{"id": 9}, {"id": 8}]}}),
+        FakeResponse(body={"data": {"orders": [{"id": 7}]}}),
+        FakeResponse(body={"data": {"orders": []}}))
+
+    async def collect():
+        return [o["id"] async for o in api.iter_orders()]
+    assert run(collect()) == [9, 8, 7]
+    assert str(api._session.calls[2][1]).endswith("/v1/user/orders?older_than=7")
+
+
+def test_coalesce_gets(api):
+    api._session = FakeSession(FakeResponse(body={"data": {"balances": []}}))
+
+    async def both():
+        return await asyncio.gather(api.get("/v1/user/balances"), api.get("/v1/user/balances"))
+    a, b = run(both())
+    assert a is b
+    assert len(api._session.calls) == 1
+    assert api._inflight == {}
+
+
+def test_coalesce_leader_out_of_budget(api):
+    from qtrade_client.ratelimit import RateLimitExceeded
+    ret = {"orders": []}
+    calls = []
+
+    async def req(method, endpoint, **kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            await asyncio.sleep(0.01)
+            raise RateLimitExceeded("Low priority request dropped, 0 requests left")
+        return ret
+    api._req = req
+
+    async def both():
+        return await asyncio.gather(api.get("/v1/user/orders"), api.get("/v1/user/orders"),
+                                    return_exceptions=True)
+    first, second = run(both())
+    assert isinstance(first, RateLimitExceeded)
+    assert second is ret
+    assert len(calls) == 2
+    assert api._inflight == {}
+
+
+def test_background_refresh_task(api):
+    api.background_refresh = True
+    api._tickers = {1: {"id": 1, "id_hr": "LTC_BTC", "last": "1"}}
+    api._tickers_age = 0
+    api._session = FakeSession(FakeResponse(body={"data": {"markets": [
+        {"id": 1, "id_hr": "LTC_BTC", "last": "2"}]}}))
+
+    async def check():
+        assert (await api.tickers)[1]["last"] == "1"
+        # the running refresh is referenced until it's done
+        task = api._refresh_tasks["tickers"]
+        await task
+        await asyncio.sleep(0)
+        assert api._refresh_tasks == {}
+        return (await api.tickers)[1]["last"]
+    assert run(check()) == "2"
+
+
+def test_metrics(api):
+    from qtrade_client.metrics import Metrics
+    api.metrics = Metrics()
+    api._session = FakeSession(FakeResponse(body={"data": {}}, headers={"X-Ratelimit-Remaining": "7"}))
+    run(api.get("/v1/user/order/5"))
+    stats = api.metrics.snapshot()["endpoints"]["/v1/user/order/{id}"]
+    assert stats["status"] == {200: 1}
+    assert stats["decode"]["count"] == 1
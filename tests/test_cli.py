@@ -0,0 +1,221 @@
+import json
+import unittest.mock as mock
+
+import pytest
+
+click = pytest.importorskip("click")
+from click.testing import CliRunner
+
+from qtrade_client import cli as cli_mod
+from qtrade_client.api import QtradeAPI
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    (tmp_path / "prod.yml").write_text(
+        "prod:\n  endpoint: https://api.qtrade.io\n  key: '2:abc'\n  email: ops@example.com\n"
+        "staging:\n  endpoint: https://staging.qtrade.io\n")
+    (tmp_path / ".default_context").write_text("staging\n")
+    return tmp_path
+
+
+def invoke(config_dir, *args):
+    return CliRunner().invoke(cli_mod.cli, ["-d", str(config_dir)] + list(args), obj={})
+
+
+def test_contexts(config_dir):
+    res = invoke(config_dir, "contexts")
+    assert res.exit_code == 0, res.output
+    assert "* staging" in res.output
+    assert "prod" in res.output and "dev_root" in res.output
+
+
+def test_config_cache(config_dir):
+    parse = mock.MagicMock(wraps=cli_mod._parse_config_dir)
+    with mock.patch.object(cli_mod, "_parse_config_dir", parse):
+        first = cli_mod.load_contexts(str(config_dir))
+        assert cli_mod.load_contexts(str(config_dir)) == first
+        assert parse.call_count == 1
+        # editing a file invalidates the cache
+        (config_dir / "other.yml").write_text("other:\n  endpoint: http://x\n")
+        contexts, default = cli_mod.load_contexts(str(config_dir))
+        assert parse.call_count == 2
+    assert contexts["other"]["config"] == {"endpoint": "http://x"}
+    assert default == "staging"
+    assert json.loads((config_dir / cli_mod.CONFIG_CACHE).read_text())["contexts"]["prod"]["origin"] \
+        == str(config_dir / "prod.yml")
+
+
+def test_config_cache_private(config_dir):
+    import os
+    import stat
+    old_umask = os.umask(0o022)
+    try:
+        cli_mod.load_contexts(str(config_dir))
+    finally:
+        os.umask(old_umask)
+    cache = config_dir / cli_mod.CONFIG_CACHE
+    assert stat.S_IMODE(cache.stat().st_mode) == 0o600
+    # a cache left readable by others is not trusted, but replaced
+    cache.chmod(0o644)
+    parse = mock.MagicMock(wraps=cli_mod._parse_config_dir)
+    with mock.patch.object(cli_mod, "_parse_config_dir", parse):
+        cli_mod.load_contexts(str(config_dir))
+    assert parse.call_count == 1
+    assert stat.S_IMODE(cache.stat().st_mode) == 0o600
+
+
+def test_client_only_for_selected_context(config_dir):
+    built = []
+
+    @cli_mod.cli.command("whoami")
+    @click.pass_obj
+    def whoami(obj):
+        built.append(obj["client"])
+
+    try:
+        res = invoke(config_dir, "-c", "prod", "whoami")
+    finally:
+        cli_mod.cli.commands.pop("whoami")
+    assert res.exit_code == 0, res.output
+    assert len(built) == 1
+    assert isinstance(built[0], QtradeAPI)
+    assert built[0].endpoint == "https://api.qtrade.io"
+    assert built[0].email == "ops@example.com"
+
+
+def test_client_not_built_unless_used(config_dir):
+    with mock.patch.object(cli_mod, "build_client") as build:
+        assert invoke(config_dir, "contexts").exit_code == 0
+    assert build.call_count == 0
+
+
+def test_plugins_loaded_lazily(config_dir):
+    @click.command()
+    def hello():
+        click.echo("hello from plugin")
+    wanted, other = mock.MagicMock(), mock.MagicMock()
+    wanted.name, other.name = "hello", "other"
+    wanted.load.return_value = hello
+    with mock.patch.object(cli_mod, "_entry_points", return_value=[wanted, other]):
+        group = cli_mod.LazyPluginGroup(commands={})
+        assert group.get_command(None, "hello") is hello
+    assert other.load.call_count == 0
+
+
+def test_select_contexts():
+    from qtrade_client.cli.fanout import select_contexts
+    contexts = dict.fromkeys(["prod-a", "prod-b", "staging", "dev_root"])
+    assert select_contexts(contexts, ["prod-*"]) == ["prod-a", "prod-b"]
+    assert select_contexts(contexts, ["staging,prod-b"]) == ["prod-b", "staging"]
+    with pytest.raises(click.BadParameter):
+        select_contexts(contexts, ["nope*"])
+
+
+def test_fanout(config_dir):
+    from qtrade_client.fakeserver import FakeQtradeServer
+    key = "1:1111111111111111111111111111111111111111111111111111111111111111"
+    with FakeQtradeServer(keys=dict([key.split(":")])) as server:
+        for name in ("acct-a", "acct-b"):
+            (config_dir / (name + ".yml")).write_text(
+                "{}:\n  endpoint: {}\n  key: '{}'\n".format(name, server.url, key))
+        (config_dir / "broken.yml").write_text("acct-c:\n  endpoint: http://127.0.0.1:1\n")
+        QtradeAPI(server.url, key=key).order("sell_limit", "0.01", amount="2", market_id=1)
+
+        res = invoke(config_dir, "fanout", "orders", "-s", "acct-a,acct-b")
+        assert res.exit_code == 0, res.output
+        table = res.output.splitlines()[1:]
+        assert table[0].split() == ["context", "id", "market", "type", "price", "remaining"]
+        assert [r.split()[:2] for r in table[1:]] == [["acct-a", "1"], ["acct-b", "1"]]
+
+        res = invoke(config_dir, "fanout", "balances", "-s", "acct-*", "--json")
+        lines = [json.loads(ln) for ln in res.output.splitlines()[1:]]
+        assert res.exit_code == 1
+        by_name = dict((ln["context"], ln) for ln in lines)
+        assert by_name["acct-a"]["result"]["LTC"] == "1000"
+        assert by_name["acct-c"]["error"]
+
+        res = invoke(config_dir, "fanout", "cancel-all", "-s", "acct-a", "--yes")
+        assert res.exit_code == 0, res.output
+        assert "cancelled" in res.output
+
+
+@pytest.fixture
+def daemon_server(tmp_path, monkeypatch):
+    import threading
+    from qtrade_client.cli.daemon import DaemonServer, SOCKET_ENV
+    path = str(tmp_path / "d.sock")
+    monkeypatch.setenv(SOCKET_ENV, path)
+    server = DaemonServer(path)
+    t = threading.Thread(target=server.serve_forever, args=(0.05,))
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    t.join()
+
+
+def test_daemon_forwarding(config_dir, daemon_server, capsys):
+    from qtrade_client.cli.daemon import forward, request
+    from qtrade_client.fakeserver import FakeQtradeServer
+    assert forward(["-d", str(config_dir), "contexts"]) == 0
+    assert "* staging" in capsys.readouterr().out
+
+    key = "1:1111111111111111111111111111111111111111111111111111111111111111"
+    with FakeQtradeServer(keys=dict([key.split(":")])) as server:
+        (config_dir / "acct.yml").write_text("acct:\n  endpoint: {}\n  key: '{}'\n".format(server.url, key))
+        for _ in range(2):
+            assert forward(["-d", str(config_dir), "fanout", "balances", "-s", "acct"]) == 0
+            assert "LTC" in capsys.readouterr().out
+    # the second command reused the client of the first
+    assert len(daemon_server.runner.clients) == 1
+    assert "1 warm clients" in request(daemon_server.path, {"op": "status"})["output"]
+
+
+def test_forward_prompting_locally(config_dir, daemon_server):
+    from qtrade_client.cli.daemon import forward
+    # the daemon can't ask for confirmation
+    assert forward(["-d", str(config_dir), "fanout", "cancel-all", "-s", "acct"]) is None
+    assert forward(["-d", str(config_dir), "-v", "1", "daemon", "status"]) is None
+    assert forward(["-d", str(config_dir), "shell"]) is None
+
+
+def test_daemon_command_logging(config_dir):
+    import logging
+    from qtrade_client.cli.daemon import Runner
+    root, qtrade_log = logging.getLogger(), logging.getLogger("qtrade")
+    handlers, level = root.handlers[:], qtrade_log.level
+    runner = Runner()
+    code, output = runner.run(["-d", str(config_dir), "-c", "nope", "contexts"])
+    assert code == 1
+    assert "Failed to set context to nope" in output
+    code, output = runner.run(["-d", str(config_dir), "-v", "1", "contexts"])
+    assert code == 0, output
+    # a command's handler and level don't outlast it
+    assert root.handlers == handlers
+    assert qtrade_log.level == level
+
+
+def test_forward_timeout(tmp_path, monkeypatch, capsys):
+    import socket
+    from qtrade_client.cli.daemon import forward, SOCKET_ENV, TIMEOUT_ENV
+    path = str(tmp_path / "wedged.sock")
+    # accepts connections but never answers
+    wedged = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    wedged.bind(path)
+    wedged.listen(1)
+    monkeypatch.setenv(SOCKET_ENV, path)
+    monkeypatch.setenv(TIMEOUT_ENV, "0.1")
+    try:
+        assert forward(["contexts"]) == 1
+    finally:
+        wedged.close()
+    assert "did not answer within 0.1 seconds" in capsys.readouterr().err
+
+
+def test_forward_without_daemon(tmp_path, monkeypatch):
+    from qtrade_client.cli.daemon import forward, SOCKET_ENV
+    monkeypatch.setenv(SOCKET_ENV, str(tmp_path / "missing.sock"))
+    assert forward(["contexts"]) is None
+    # daemon management always runs locally
+    assert forward(["daemon", "stop"]) is None
@@ -0,0 +1,83 @@
+import json
+import logging
+import unittest.mock as mock
+from decimal import Decimal
+
+import pytest
+
+from qtrade_client.api import QtradeAPI, QtradeAuth, APIException
+from qtrade_client.codec import JSONCodec, OrjsonCodec, default_codec, orjson
+
+codecs = [JSONCodec()]
+if orjson is not None:
+    codecs.append(OrjsonCodec())
+
+
+@pytest.mark.parametrize("codec", codecs, ids=lambda c: c.name)
+def test_roundtrip(codec):
+    body = codec.dumps({"amount": Decimal("0.01000000"), "market_id": 1})
+    assert isinstance(body, bytes)
+    assert json.loads(body.decode()) == {"amount": "0.01000000", "market_id": 1}
+    assert codec.loads(body) == codec.loads(body.decode()) == {"amount": "0.01000000", "market_id": 1}
+    with pytest.raises(TypeError):
+        codec.dumps({"x": object()})
+
+
+def test_decimal_numbers():
+    assert JSONCodec(use_decimal=True).loads(b'{"price": 0.1}') == {"price": Decimal("0.1")}
+
+
+def test_default_codec():
+    assert default_codec().name == ("orjson" if orjson is not None else "json")
+
+
+def test_client_encodes_with_codec():
+    api = QtradeAPI("http://localhost:9898/")
+    api.codec = mock.MagicMock(wraps=JSONCodec())
+    api.rs.request = mock.MagicMock(return_value=mock.MagicMock(
+        status_code=200, content=b'{"data": {"order": {"id": 1}}}'))
+    assert api.post("/v1/user/sell_limit", amount="1", price="0.01", market_id=1) == {"order": {"id": 1}}
+    kwargs = api.rs.request.call_args[1]
+    assert kwargs["data"] == b'{"amount":"1","price":"0.01","market_id":1}'
+    assert kwargs["headers"] == {"Content-Type": "application/json"}
+    assert api.codec.loads.call_count == 1
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=12345))
+def test_signed_body_matches_sent_body():
+    import requests
+    api = QtradeAPI("http://localhost:9898/", key="256:vwj043jtrw4o5igw4oi5jwoi45g")
+    prepared = []
+
+    def send(request, **kwargs):
+        prepared.append(request)
+        raise RuntimeError("not sent")
+    with mock.patch.object(requests.adapters.HTTPAdapter, "send", side_effect=send):
+        with pytest.raises(RuntimeError):
+            api.post("/v1/user/cancel_order", id=1)
+    req = prepared[0]
+    assert req.headers["Content-Type"] == "application/json"
+    expected = QtradeAuth("256:vwj043jtrw4o5igw4oi5jwoi45g").sign("POST", "/v1/user/cancel_order", req.body)
+    assert req.headers["Authorization"] == expected["Authorization"]
+
+
+def _response(status, body):
+    return mock.MagicMock(status_code=status, headers={}, content=json.dumps(body).encode(),
+                          text=json.dumps(body))
+
+
+def test_decimal_body_logged_on_error():
+    api = QtradeAPI("http://localhost:9898/")
+    api.rs.request = mock.MagicMock(return_value=_response(400, {"errors": [{"code": "bad_amount"}]}))
+    with pytest.raises(APIException) as e:
+        api.post("/v1/user/sell_limit", amount=Decimal("1"), price=Decimal("0.01"), market_id=1)
+    assert e.value.errors == ["bad_amount"]
+
+
+def test_decimal_body_logged_on_debug(caplog):
+    api = QtradeAPI("http://localhost:9898/")
+    api.rs.request = mock.MagicMock(return_value=_response(200, {"data": {"order": {"id": 1}}}))
+    with caplog.at_level(logging.DEBUG, logger="qtrade"):
+        res = api.post("/v1/user/sell_limit", amount=Decimal("1"), price=Decimal("0.01"), market_id=1)
+    assert res == {"order": {"id": 1}}
+    assert '"amount": "1"' in caplog.text
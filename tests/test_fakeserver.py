@@ -0,0 +1,76 @@
+import pytest
+from decimal import Decimal
+
+from qtrade_client.api import QtradeAPI, APIException
+from qtrade_client.fakeserver import FakeQtradeServer
+
+KEY = "1:1111111111111111111111111111111111111111111111111111111111111111"
+
+
+@pytest.fixture
+def server():
+    with FakeQtradeServer(keys=dict([KEY.split(":")])) as server:
+        yield server
+
+
+@pytest.fixture
+def api(server):
+    api = QtradeAPI(server.url, key=KEY, timeout=5)
+    yield api
+    api.close()
+
+
+def test_market_data(api):
+    assert api.markets["LTC_BTC"].base_currency.code == "BTC"
+    assert api.tickers["LTC_BTC"].ask == Decimal("0.01")
+    assert api.rl_limit == 120
+    assert api.rl_remaining == 118
+
+
+def test_order_lifecycle(api):
+    placed = api.order("sell_limit", "0.01", amount="2", market_string="LTC_BTC")["order"]
+    assert placed["open"] is True
+    assert [o["id"] for o in api.orders(open=True)] == [placed["id"]]
+    assert api.balances_merged()["LTC"] == Decimal(1000)
+    assert api.balances_all()["in_orders"]["LTC"] == Decimal(2)
+
+    assert api.cancel_orders([placed["id"], placed["id"]], workers=1) == [
+        {"id": placed["id"], "result": "cancelled"},
+        {"id": placed["id"], "result": "closed", "code": 400, "errors": ["order_not_open"]},
+    ]
+    assert api.get("/v1/user/order/{}".format(placed["id"]))["order"]["open"] is False
+
+
+def test_bad_signature(server):
+    api = QtradeAPI(server.url, key="1:wrong")
+    with pytest.raises(APIException) as e:
+        api.balances()
+    assert e.value.code == 401
+    # public endpoints don't need a key
+    assert api.markets
+
+
+def test_ratelimit(server):
+    server.ratelimit.limit = 3
+    api = QtradeAPI(server.url, key=KEY)
+    api.honor_ratelimit = False
+    for _ in range(3):
+        api.balances()
+    with pytest.raises(APIException) as e:
+        api.balances()
+    assert e.value.code == 429
+    assert api.rl_remaining == 0
+    assert server.ratelimit.rejected == 2
+
+
+def test_bulk_cancel_ratelimited(server):
+    server.ratelimit.limit = 10
+    server.ratelimit.window = 1
+    for _ in range(30):
+        server.exchange.place("sell_limit", {"amount": "0.01", "price": "1", "market_id": 1})
+    api = QtradeAPI(server.url, key=KEY)
+
+    results = api.cancel_all_orders(bulk=True)
+    assert [r["result"] for r in results] == ["cancelled"] * 30
+    assert api.orders(open=True) == []
+    assert server.ratelimit.rejected == 0
@@ -0,0 +1,56 @@
+import pytest
+import random
+from decimal import Decimal
+
+from qtrade_client.api import QtradeAPI, COIN
+from qtrade_client.fixedpoint import to_sats, from_sats, div_round
+from qtrade_client.models import Currency, Market
+
+
+def test_to_sats():
+    assert to_sats("1") == 100000000
+    assert to_sats("0.005") == 500000
+    assert to_sats("-0.00000001") == -1
+    assert to_sats(".5") == 50000000
+    assert to_sats("1e-3") == 100000
+    assert to_sats(Decimal("0.123456789")) == 12345679
+    assert to_sats(0.005) == 500000
+    assert to_sats(42) == 42
+    with pytest.raises(ValueError):
+        to_sats("1.2.3")
+
+
+def test_rounding_matches_decimal():
+    for s in ["0.000000005", "0.000000015", "0.0000000051", "0.0000000149999",
+              "-0.000000005", "-0.000000015", "12.345678905000"]:
+        assert to_sats(s) == to_sats(Decimal(s).quantize(COIN)), s
+
+
+def test_from_sats():
+    assert from_sats(500000) == str(Decimal("0.005").quantize(COIN))
+    assert from_sats(-100000001) == "-1.00000001"
+
+
+def test_div_round():
+    assert div_round(5, 2) == 2
+    assert div_round(7, 2) == 4
+    assert div_round(-5, 2) == -2
+    assert div_round(10, 3) == 3
+
+
+def test_order_sizing_matches_decimal():
+    currencies = {"BTC": Currency.from_json({"code": "BTC"}), "LTC": Currency.from_json({"code": "LTC"})}
+    rnd = random.Random(1)
+    for _ in range(500):
+        fee = "0.00{}".format(rnd.randint(0, 99))
+        market = Market.from_json({"id": 1, "base_currency": "BTC", "market_currency": "LTC",
+                                   "maker_fee": "0", "taker_fee": fee}, currencies)
+        price = "{}.{:08d}".format(rnd.randint(0, 3), rnd.randint(1, 10 ** 8 - 1))
+        value = "{}.{:08d}".format(rnd.randint(0, 50), rnd.randint(0, 10 ** 8 - 1))
+        for order_type in ("buy_limit", "sell_limit"):
+            dec = QtradeAPI("http://localhost:9898/")
+            fixed = QtradeAPI("http://localhost:9898/")
+            fixed.fixed_point = True
+            markets = {1: market}
+            assert (dec._prepare_order(markets, None, order_type, price, value=value, market_id=1) ==
+                    fixed._prepare_order(markets, None, order_type, price, value=value, market_id=1))
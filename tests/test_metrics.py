@@ -0,0 +1,80 @@
+import json
+import unittest.mock as mock
+
+import pytest
+import requests
+
+from qtrade_client.api import QtradeAPI, APIException
+from qtrade_client.metrics import Histogram, Metrics, endpoint_template
+
+
+def limits(remaining="50"):
+    return {"X-Ratelimit-Remaining": remaining, "X-Ratelimit-Limit": "60", "X-Ratelimit-Reset": "30"}
+
+
+@pytest.fixture
+def api():
+    api = QtradeAPI("http://localhost:9898/")
+    api.metrics = Metrics()
+    return api
+
+
+def test_endpoint_template():
+    assert endpoint_template("/v1/user/order/123") == "/v1/user/order/{id}"
+    assert endpoint_template("/v1/user/orders") == "/v1/user/orders"
+    assert endpoint_template("/v1/market/1/trades") == "/v1/market/{id}/trades"
+
+
+def test_histogram():
+    h = Histogram()
+    for v in (0.002, 0.002, 0.002, 0.3, 100):
+        h.observe(v)
+    assert h.count == 5
+    assert h.quantile(0.5) == 0.0025
+    assert h.quantile(0.99) == 100
+    assert h.snapshot()["max"] == 100
+
+
+def test_records_requests(api, response):
+    samples = []
+    api.metrics.add_hook(samples.append)
+    api.rs.request = mock.MagicMock(side_effect=[response(headers=limits()),
+                                                 response(headers=limits("49"))])
+    api.get("/v1/user/order/1")
+    api.get("/v1/user/order/2")
+    snap = api.metrics.snapshot()
+    stats = snap["endpoints"]["/v1/user/order/{id}"]
+    assert stats["calls"] == 2
+    assert stats["status"] == {200: 2}
+    for phase in ("queue", "ratelimit", "network", "decode"):
+        assert stats[phase]["count"] == 2
+    assert [r for t, r in snap["rl_remaining"]] == [50, 49]
+    assert [s["status"] for s in samples] == [200, 200]
+    json.dumps(snap)
+
+
+def test_records_429_and_errors(api, response):
+    api.rs.request = mock.MagicMock(side_effect=[
+        response(429, headers=limits(), error="too_many_requests") for _ in range(2)])
+    with pytest.raises(APIException):
+        api.get("/v1/common")
+    stats = api.metrics.snapshot()["endpoints"]["/v1/common"]
+    assert stats["status"] == {429: 2}
+    assert stats["retries_429"] == 1
+    assert stats["retries"] == {"429": 1}
+
+    api.rs.request = mock.MagicMock(side_effect=requests.exceptions.ConnectionError())
+    with mock.patch("time.sleep"), pytest.raises(requests.exceptions.ConnectionError):
+        api.get("/v1/tickers")
+    stats = api.metrics.snapshot()["endpoints"]["/v1/tickers"]
+    assert stats["errors"] == 2
+    assert stats["retries"] == {"connection": 1}
+
+
+def test_disabled_by_default(response):
+    api = QtradeAPI("http://localhost:9898/")
+    assert api.metrics is None
+    api.rs.request = mock.MagicMock(return_value=response(headers=limits()))
+    with mock.patch("qtrade_client.api._clock") as clock:
+        api.get("/v1/common")
+    assert clock.call_count == 0
@@ -0,0 +1,68 @@
+import pickle
+from decimal import Decimal
+
+from qtrade_client.models import Currency, Market, Ticker
+
+
+def currencies():
+    return {
+        "BTC": Currency.from_json({"code": "BTC", "precision": 8, "new_field": 1}),
+        "LTC": Currency.from_json({"code": "LTC", "precision": 8}),
+    }
+
+
+def test_dict_access():
+    m = Market.from_json({"id": 1, "base_currency": "BTC", "market_currency": "LTC",
+                          "maker_fee": "0.001", "taker_fee": "0.005"}, currencies())
+    assert m["string"] == m.string == "LTC_BTC"
+    assert m["base_currency"]["code"] == "BTC"
+    # unknown fields stay reachable
+    assert m["base_currency"]["new_field"] == 1
+    assert "new_field" in m["base_currency"]
+    assert m.get("missing", 5) == 5
+    m["can_trade"] = False
+    assert m.can_trade is False
+
+
+def test_market_equals_api_dict():
+    data = {"id": 1, "base_currency": "BTC", "market_currency": "LTC",
+            "maker_fee": "0.001", "taker_fee": "0.005"}
+    m = Market.from_json(data, currencies())
+    assert m == data and data == m
+    # so does the dict with the currencies resolved, as older versions kept it
+    assert m == dict(data, string="LTC_BTC", base_currency=m.base_currency,
+                     market_currency=m.market_currency)
+    assert m != dict(data, market_currency="BTC")
+
+def test_raw_values_by_key():
+    data = {"id": 1, "id_hr": "LTC_BTC", "ask": "0.10", "bid": None, "new_field": 1}
+    t = Ticker.from_json(data)
+    # keys give what the API sent, attributes the parsed values
+    assert t["ask"] == "0.10"
+    assert t.ask == Decimal("0.1")
+    assert t == data and data == t
+    assert not t != data
+    assert "last" not in t and t.last is None
+    t["ask"] = "0.2"
+    assert t.ask == Decimal("0.2") and t.ask_sats == 20000000
+    assert t["ask"] == "0.2"
+
+
+def test_parsed_once():
+    m = Market.from_json({"id": 1, "base_currency": "BTC", "market_currency": "LTC",
+                          "maker_fee": "0.001", "taker_fee": "0.005"}, currencies())
+    assert m.taker_fee == Decimal("0.005")
+    assert m.fee_mult == Decimal("1.005")
+    t = Ticker.from_json({"id": 1, "id_hr": "LTC_BTC", "ask": "0.1", "bid": None})
+    assert t.ask == Decimal("0.1")
+    assert t.bid is None
+
+
+def test_pickle():
+    c = currencies()
+    m = Market.from_json({"id": 1, "base_currency": "BTC", "market_currency": "LTC",
+                          "maker_fee": "0", "taker_fee": "0.005"}, c)
+    m2, c2 = pickle.loads(pickle.dumps((m, c), pickle.HIGHEST_PROTOCOL))
+    assert m2 == m
+    assert m2.fee_mult == m.fee_mult
+    assert m2.base_currency is c2["BTC"]
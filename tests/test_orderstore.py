@@ -0,0 +1,126 @@
+import pytest
+import requests
+import unittest.mock as mock
+
+from qtrade_client.api import QtradeAPI
+from qtrade_client.orderstore import OrderStore, _timestamp
+
+
+def order(id, market_id=1, open=True, trades=None):
+    return {"id": id, "market_id": market_id, "open": open, "order_type": "sell_limit",
+            "created_at": "2019-11-14T16:34:20.424601Z", "trades": trades}
+
+
+def trade(id, created_at):
+    return {"id": id, "market_amount": "0.1", "price": "0.01", "base_amount": "0.001",
+            "base_fee": "0", "created_at": created_at}
+
+
+class FakeBackend(object):
+    """ Serves /v1/user/orders and /v1/user/order/{id} from a dict of
+    orders, with pages of `page_size` like the API. newer_than returns the
+    newest page above the id, or with newest_first=False the page just
+    above it. """
+
+    def __init__(self, orders, page_size=2, newest_first=True):
+        self.orders = dict((o["id"], o) for o in orders)
+        self.page_size = page_size
+        self.newest_first = newest_first
+        self.calls = []
+
+    def __call__(self, method, endpoint, open=None, older_than=None, newer_than=None, **kwargs):
+        self.calls.append((endpoint, open, older_than, newer_than))
+        if endpoint.startswith("/v1/user/order/"):
+            return {"order": self.orders[int(endpoint.rsplit("/", 1)[1])]}
+        ids = sorted(self.orders, reverse=True)
+        if open is not None:
+            ids = [i for i in ids if self.orders[i]["open"] == (open == "true")]
+        if older_than is not None:
+            ids = [i for i in ids if i < older_than]
+        if newer_than is not None:
+            ids = [i for i in ids if i > newer_than]
+            if not self.newest_first:
+                ids = ids[-self.page_size:]
+        return {"orders": [self.orders[i] for i in ids[:self.page_size]]}
+
+
+@pytest.fixture
+def backend():
+    return FakeBackend([order(1, open=False), order(2, market_id=2), order(3), order(4)])
+
+
+@pytest.fixture
+def store(tmp_path, backend):
+    api = QtradeAPI("http://localhost:9898/")
+    api._req = mock.MagicMock(side_effect=backend)
+    s = OrderStore(str(tmp_path / "orders.db"), api)
+    s.page_size = backend.page_size
+    yield s
+    s.close()
+
+
+def test_initial_sync(store):
+    assert store.sync() == 4 + 3
+    assert [o["id"] for o in store.open_orders()] == [4, 3, 2]
+    assert [o["id"] for o in store.open_orders(market_id=1)] == [4, 3]
+    assert store.order(1)["open"] is False
+
+
+@pytest.mark.parametrize("newest_first", [True, False])
+def test_incremental_sync(store, backend, newest_first):
+    backend.newest_first = newest_first
+    store.sync()
+    backend.orders[4] = order(4, open=False, trades=[trade(10, "2019-11-14T17:00:00Z")])
+    for i in (5, 6, 7, 8):
+        backend.orders[i] = order(i)
+    del backend.calls[:]
+    store.sync()
+    # new orders are fetched from the newest one stored onwards, and below
+    # a full page down to it...
+    assert [c[3] for c in backend.calls if c[3] is not None] == [4, 8] if newest_first else [4, 6, 8]
+    assert [c[2] for c in backend.calls if c[1] is None and c[2] is not None] == (
+        [7, 5] if newest_first else [5, 7])
+    # ...and the order that closed is looked up on its own
+    assert ("/v1/user/order/4", None, None, None) in backend.calls
+    assert [o["id"] for o in store.open_orders()] == [8, 7, 6, 5, 3, 2]
+    fills = store.fills_since(_timestamp("2019-11-14T16:00:00Z"))
+    assert [(f["id"], f["order_id"], f["market_id"]) for f in fills] == [(10, 4, 1)]
+    assert store.fills_since(_timestamp("2019-11-14T18:00:00Z")) == []
+
+
+def test_backfill_resumed(store, backend):
+    store.backfill_chunk = 2
+    fetch = backend.__call__
+
+    def interrupted(method, endpoint, older_than=None, **kwargs):
+        if older_than == 3:
+            raise requests.exceptions.ConnectionError()
+        return fetch(method, endpoint, older_than=older_than, **kwargs)
+    store.api._req.side_effect = interrupted
+    with pytest.raises(requests.exceptions.ConnectionError):
+        store.sync()
+    assert store.newest_id() == 4
+    assert not store.backfill_complete()
+
+    store.api._req.side_effect = backend
+    del backend.calls[:]
+    store.sync()
+    # the history is fetched from where the first sync stopped
+    assert ("/v1/user/orders", None, 3, None) in backend.calls
+    assert store.order(1)["open"] is False
+    assert store.backfill_complete()
+    del backend.calls[:]
+    store.sync()
+    assert not [c for c in backend.calls if c[1] is None and c[2] is not None]
+
+
+def test_reopen(tmp_path, store):
+    store.sync()
+    again = OrderStore(store.path, store.api)
+    assert again.newest_id() == 4
+    again.close()
+
+
+def test_timestamp():
+    assert _timestamp("1970-01-01T00:01:00Z") == 60
+    assert _timestamp("1970-01-01T00:00:01.5Z") == 1.5
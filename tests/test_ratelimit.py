@@ -0,0 +1,157 @@
+import pytest
+import multiprocessing
+import time
+import unittest.mock as mock
+from concurrent.futures import ThreadPoolExecutor
+
+from qtrade_client.api import QtradeAPI
+from qtrade_client.ratelimit import RateLimiter, RateLimitExceeded, SharedRateLimiter, fcntl, URGENT, NORMAL, LOW
+
+needs_fcntl = pytest.mark.skipif(fcntl is None, reason="SharedRateLimiter is Unix only")
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=100))
+def test_update_from_headers():
+    rl = RateLimiter()
+    rl.update({'X-Ratelimit-Reset': '30', 'X-Ratelimit-Limit': '60', 'X-Ratelimit-Remaining': '12'})
+    assert (rl.remaining, rl.reset_at, rl.limit) == (12, 130, 60)
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=100))
+def test_refill_after_reset():
+    rl = RateLimiter(limit=60, remaining=0, reset_at=90)
+    # the window passed, so the bucket is full again and nothing waits
+    assert rl.reserve() == 0
+    assert rl.remaining == 59
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=100))
+def test_client_uses_limiter():
+    rl = RateLimiter()
+    api = QtradeAPI("http://localhost:9898/", ratelimiter=rl)
+    api.rl_remaining = 7
+    assert rl.remaining == 7
+    api._update_ratelimit({'X-Ratelimit-Remaining': '3'})
+    assert api.rl_remaining == 3
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=100))
+def test_priority_lanes():
+    rl = RateLimiter(limit=10, remaining=5, reset_at=130, soft_threshold=0.5, urgent_reserve=0.2)
+    # half the budget is used, so market data waits for the reset...
+    assert rl.reserve(LOW) == 30
+    # ...without taking a token, and normal requests may go on until only
+    # the urgent reserve is left
+    assert rl.reserve(NORMAL) == 0
+    assert rl.reserve(NORMAL) == 0
+    assert rl.reserve(NORMAL) == 0
+    assert rl.reserve(NORMAL) == 30
+    assert rl.reserve(URGENT) == 0
+    assert rl.reserve(URGENT) == 0
+    assert rl.reserve(URGENT) == 30
+    stats = rl.stats()
+    assert stats['low'] == {'calls': 1, 'waiting': 1, 'waits': 1, 'wait_total': 30,
+                            'wait_max': 30, 'dropped': 0}
+    assert stats['normal']['calls'] == 4
+    assert stats['urgent']['waiting'] == 1
+    # woken before the reset, it waits on
+    assert rl.consume(LOW) == 30
+    with mock.patch("time.time", return_value=130):
+        assert rl.consume(LOW) == 0
+    assert rl.stats()['low']['waiting'] == 0
+    rl.cancel(URGENT)
+    assert rl.stats()['urgent']['waiting'] == 0
+
+
+@mock.patch("time.time", return_value=100)
+def test_waiters_recheck(clock):
+    rl = RateLimiter(limit=2, remaining=0, reset_at=110, soft_threshold=1)
+    rl.update({'X-Ratelimit-Reset': '10', 'X-Ratelimit-Limit': '2', 'X-Ratelimit-Remaining': '0'})
+    assert [rl.reserve(URGENT) for _ in range(3)] == [10, 10, 10]
+    clock.return_value = 110
+    # only as many of the waiters as the new window has room for go on,
+    # the others wait for the next one
+    assert [rl.consume(URGENT) for _ in range(3)] == [0, 0, 10]
+    assert rl.stats()['urgent']['waiting'] == 1
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=100))
+def test_update_in_flight():
+    rl = RateLimiter(limit=10, remaining=10, reset_at=130)
+    for _ in range(3):
+        rl.reserve()
+    # the backend hasn't seen the other two requests yet
+    rl.update({'X-Ratelimit-Reset': '30', 'X-Ratelimit-Limit': '10', 'X-Ratelimit-Remaining': '9'})
+    assert rl.remaining == 7
+    # an older response arriving late doesn't give back tokens
+    rl.update({'X-Ratelimit-Reset': '30', 'X-Ratelimit-Limit': '10', 'X-Ratelimit-Remaining': '9'})
+    assert rl.remaining == 7
+    rl.release()
+    assert rl._inflight == 0
+
+
+def test_no_429_under_load():
+    from qtrade_client.fakeserver import FakeQtradeServer
+    with FakeQtradeServer(ratelimit=8, ratelimit_window=1) as server:
+        api = QtradeAPI(server.url)
+        api.coalesce_gets = False
+        api.get("/v1/common", priority=URGENT)
+        # many concurrent requests wait for the same resets
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: api.get("/v1/tickers", priority=URGENT), range(24)))
+        api.close()
+    assert server.ratelimit.rejected == 0
+    assert len(results) == 24
+
+
+@mock.patch("time.time", mock.MagicMock(return_value=100))
+def test_drop_low():
+    rl = RateLimiter(limit=10, remaining=2, reset_at=130, drop_low=True)
+    with pytest.raises(RateLimitExceeded):
+        rl.reserve(LOW)
+    assert rl.stats()['low']['dropped'] == 1
+    assert rl.remaining == 2
+
+
+def test_endpoint_priority():
+    assert QtradeAPI._priority("/v1/user/cancel_order") == URGENT
+    assert QtradeAPI._priority("/v1/user/sell_limit") == URGENT
+    assert QtradeAPI._priority("/v1/tickers") == LOW
+    assert QtradeAPI._priority("/v1/user/balances") == NORMAL
+
+
+@needs_fcntl
+def test_shared_state(tmp_path):
+    path = str(tmp_path / "key.rl")
+    a = SharedRateLimiter(path, limit=10, remaining=10, reset_at=time.time() + 60)
+    # a second limiter on the same file adopts the existing bucket
+    b = SharedRateLimiter(path, limit=99, remaining=99)
+    assert b.remaining == 10
+    a.reserve()
+    b.reserve()
+    assert a.remaining == b.remaining == 8
+    b.update({'X-Ratelimit-Remaining': '4', 'X-Ratelimit-Limit': '10', 'X-Ratelimit-Reset': '60'})
+    assert a.remaining == 4
+    a.close()
+    b.close()
+
+
+def _drain(path, count, queue):
+    rl = SharedRateLimiter(path, soft_threshold=1)
+    queue.put(sum(1 for _ in range(count) if rl.reserve(URGENT) == 0))
+    rl.close()
+
+
+@needs_fcntl
+def test_shared_across_processes(tmp_path):
+    path = str(tmp_path / "key.rl")
+    SharedRateLimiter(path, limit=20, remaining=20, reset_at=time.time() + 600, soft_threshold=1).close()
+    queue = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_drain, args=(path, 10, queue)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    # 40 requests were reserved but only the 20 in the budget went out
+    # without waiting
+    assert sum(queue.get() for _ in procs) == 20
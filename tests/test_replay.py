@@ -0,0 +1,63 @@
+import pytest
+import requests
+
+from qtrade_client.api import QtradeAPI
+from qtrade_client.fakeserver import FakeQtradeServer
+from qtrade_client.replay import RecordingAdapter, ReplayAdapter, load, replay_load
+
+KEY = "1:1111111111111111111111111111111111111111111111111111111111111111"
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = str(tmp_path / "traffic.jsonl.gz")
+    with FakeQtradeServer(keys=dict([KEY.split(":")])) as server:
+        api = QtradeAPI(server.url, key=KEY)
+        RecordingAdapter(path).mount(api)
+        api.markets
+        order = api.order("sell_limit", "0.01", amount="1", market_id=1)["order"]
+        api.orders(open=True)
+        api.cancel_orders([order["id"]])
+        api.close()
+    return path
+
+
+def test_recording(recording):
+    header, entries = load(recording)
+    assert header["version"] == 1
+    assert [(e["method"], e["url"]) for e in entries] == [
+        ("GET", "/v1/common"),
+        ("POST", "/v1/user/sell_limit"),
+        ("GET", "/v1/user/orders?open=true"),
+        ("POST", "/v1/user/cancel_order"),
+    ]
+    assert entries[1]["headers"]["X-Ratelimit-Limit"] == "120"
+    # credentials stay out of the file
+    assert "Authorization" not in str(entries)
+
+
+def test_replay_offline(recording):
+    api = QtradeAPI("http://localhost:1/", key=KEY)
+    adapter = ReplayAdapter(recording, speed=None).mount(api)
+    assert api.markets["LTC_BTC"].id == 1
+    assert api.order("sell_limit", "0.01", amount="1", market_id=1)["order"]["id"] == 1
+    assert api.orders(open=True)[0]["id"] == 1
+    # rate limit state comes from the recorded headers, which only ever
+    # lower the estimate within a window
+    assert api.rl_limit == 120
+    assert api.rl_remaining <= 118
+    # the one recorded /v1/common response is used up
+    api._markets_map = None
+    with pytest.raises(requests.exceptions.ConnectionError):
+        api.markets
+    # once more for the retry of the GET
+    assert adapter.misses == 2
+
+
+def test_replay_load(recording):
+    api = QtradeAPI("http://localhost:1/", key=KEY)
+    ReplayAdapter(recording, speed=None).mount(api)
+    results = replay_load(api, recording, speed=None, workers=1)
+    assert [e["url"] for e, r in results][0] == "/v1/common"
+    assert not any(isinstance(r, Exception) for e, r in results)
+    assert results[1][1]["order"]["market_amount"] == "1"
@@ -0,0 +1,179 @@
+import unittest.mock as mock
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from qtrade_client.api import QtradeAPI, APIException, CircuitOpenError
+from qtrade_client.metrics import Metrics
+from qtrade_client.retry import (CircuitBreaker, RetryPolicy, request_class,
+                                 READ, CANCEL, ORDER)
+
+
+def refused():
+    reason = NewConnectionError(None, "Connection refused")
+    return requests.exceptions.ConnectionError(MaxRetryError(None, "/", reason=reason))
+
+
+@pytest.fixture
+def api():
+    api = QtradeAPI("http://localhost:9898/")
+    api.metrics = Metrics()
+    with mock.patch("time.sleep"):
+        yield api
+
+
+def test_request_class():
+    assert request_class("get", "/v1/user/orders") == READ
+    assert request_class("post", "/v1/user/cancel_order") == CANCEL
+    assert request_class("post", "/v1/user/sell_limit") == ORDER
+
+
+def test_policy():
+    p = RetryPolicy(attempts=3, backoff=1, jitter=0)
+    assert p.retry_delay(1, 0, status=503) == 1
+    assert p.retry_delay(2, 0, status=503) == 2
+    assert p.retry_delay(3, 0, status=503) is None
+    assert p.retry_delay(1, 0, status=429) == 0
+    assert p.retry_delay(1, 0, status=400) is None
+    assert p.retry_delay(1, 0) == 1
+
+    p = RetryPolicy(attempts=5, backoff=1, max_backoff=3, jitter=0.5, deadline=10)
+    assert 1.5 <= p.retry_delay(4, 0, status=500) <= 3
+    assert p.retry_delay(1, 9.5, status=500) is None
+
+    p = RetryPolicy(unsent_only=True)
+    assert p.retry_delay(1, 0, status=503) is None
+    assert p.retry_delay(1, 0, status=429) == 0
+    assert p.retry_delay(1, 0) is None
+    assert p.retry_delay(1, 0, unsent=True) is not None
+
+
+def test_circuit_breaker():
+    b = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    assert not b.failing
+    assert b.failure("a") is False
+    assert b.allow("a")
+    assert b.failure("a") is True
+    assert b.state("a") == b.OPEN
+    assert not b.allow("a")
+    assert b.allow("b")
+
+    with mock.patch("time.time", return_value=b._circuits["a"][1] + 31):
+        assert b.state("a") == b.HALF_OPEN
+        # one trial at a time
+        assert b.allow("a")
+        assert not b.allow("a")
+        assert b.failure("a") is True
+    assert not b.allow("a")
+
+    opened = b._circuits["a"][1]
+    with mock.patch("time.time", return_value=opened + 31):
+        assert b.allow("a")
+        # a released trial makes way for the next one
+        b.release("a")
+        assert b.allow("a")
+    # one never reported is given up after reset_timeout
+    with mock.patch("time.time", return_value=opened + 62):
+        assert b.allow("a")
+
+    b.success("a")
+    assert b.state("a") == b.CLOSED
+    assert not b.failing
+
+
+def test_get_retries_5xx(api, response):
+    api.rs.request = mock.MagicMock(side_effect=[response(503), response(body={"ok": 1})])
+    assert api.get("/v1/user/order/1") == {"ok": 1}
+    assert api.rs.request.call_count == 2
+    stats = api.metrics.snapshot()["endpoints"]["/v1/user/order/{id}"]
+    assert stats["status"] == {503: 1, 200: 1}
+    assert stats["retries"] == {"503": 1}
+
+
+def test_order_not_retried_once_sent(api, response):
+    api.rs.request = mock.MagicMock(side_effect=requests.exceptions.ReadTimeout())
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        api.post("/v1/user/sell_limit", price="1", amount="1", market_id=1)
+    assert api.rs.request.call_count == 1
+
+    api.rs.request = mock.MagicMock(side_effect=[response(503)])
+    with pytest.raises(APIException):
+        api.post("/v1/user/sell_limit", price="1", amount="1", market_id=1)
+    assert api.rs.request.call_count == 1
+
+
+def test_order_retried_if_unsent(api, response):
+    api.rs.request = mock.MagicMock(side_effect=[refused(), response(body={"order": {"id": 1}})])
+    assert api.post("/v1/user/sell_limit", price="1", amount="1", market_id=1) == {"order": {"id": 1}}
+    assert api.rs.request.call_count == 2
+
+
+def test_cancel_retried(api, response):
+    api.rs.request = mock.MagicMock(side_effect=[requests.exceptions.ReadTimeout(), response()])
+    api.post("/v1/user/cancel_order", id=5)
+    assert api.rs.request.call_count == 2
+
+
+def test_retry_policy_configurable(api, response):
+    api.retry_policies[READ] = RetryPolicy(attempts=4)
+    api.rs.request = mock.MagicMock(return_value=response(502))
+    with pytest.raises(APIException):
+        api.get("/v1/tickers")
+    assert api.rs.request.call_count == 4
+
+    api.retry_policies[READ] = RetryPolicy(attempts=1)
+    api.rs.request = mock.MagicMock(return_value=response(502))
+    with pytest.raises(APIException):
+        api.get("/v1/common")
+    assert api.rs.request.call_count == 1
+
+
+def test_circuit_opens(api, response):
+    api.circuit_breaker = CircuitBreaker(failure_threshold=3)
+    api.rs.request = mock.MagicMock(return_value=response(500))
+    with pytest.raises(APIException):
+        api.get("/v1/user/order/1")
+    with pytest.raises(APIException):
+        api.get("/v1/user/order/2")
+    assert api.rs.request.call_count == 3
+    # fails fast without a request
+    with pytest.raises(CircuitOpenError):
+        api.get("/v1/user/order/3")
+    assert api.rs.request.call_count == 3
+    # other endpoints are unaffected
+    api.rs.request = mock.MagicMock(return_value=response(body={"balances": []}))
+    api.get("/v1/user/balances")
+    stats = api.metrics.snapshot()["endpoints"]["/v1/user/order/{id}"]
+    assert stats["circuit_open"] == 1
+
+
+def test_circuit_breaker_disabled(api, response):
+    api.circuit_breaker = None
+    api.rs.request = mock.MagicMock(return_value=response(500))
+    for _ in range(5):
+        with pytest.raises(APIException):
+            api.get("/v1/tickers")
+    assert api.rs.request.call_count == 10
+
+
+def test_circuit_trial_released(api, response):
+    from qtrade_client.ratelimit import LOW, RateLimitExceeded
+    api.circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    api.rs.request = mock.MagicMock(return_value=response(500))
+    with pytest.raises(APIException):
+        api.get("/v1/tickers")
+    opened = api.circuit_breaker._circuits["/v1/tickers"][1]
+    with mock.patch("time.time", return_value=opened + 31):
+        # the trial is let through but dropped by the rate limiter
+        api.ratelimiter.drop_low = True
+        api.rl_remaining = 0
+        api.rl_reset_at = opened + 60
+        with pytest.raises(RateLimitExceeded):
+            api.get("/v1/tickers", priority=LOW)
+        api.ratelimiter.drop_low = False
+        api.rl_remaining = 100
+        # so the next request is the trial, and closes the circuit
+        api.rs.request = mock.MagicMock(return_value=response(body={"ok": 1}))
+        assert api.get("/v1/tickers") == {"ok": 1}
+    assert api.circuit_breaker.state("/v1/tickers") == CircuitBreaker.CLOSED